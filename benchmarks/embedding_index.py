@@ -0,0 +1,109 @@
+## Benchmark for the encoder state embedding index (phonorm.embeddings)
+##  Run from the root of the repository: python -m benchmarks.embedding_index --bundle models/model.phonorm
+##  The cmudict words that the model can encode are indexed. Queries are known words with random edits.
+
+import argparse
+import random
+import time
+import numpy as np
+
+from benchmarks.similarity_index import perturb
+from phonorm.bundle import load_model
+from phonorm.embeddings import EmbeddingIndex, encode_words
+from phonorm.lexicon import read_cmudict
+
+def run(bundle, pathname = "data/raw/cmudict/cmudict_SPHINX_40.txt", n_queries = 1000, k = 10, dtype = "float32",
+        n_tables = 16, n_bits = 16, multiprobe = False, seed = 1):
+
+    '''
+    Measure encoding throughput, memory and exact/approximate query latency on the cmudict vocabulary
+
+    :param bundle: path to a model bundle
+    :param pathname: path to the cmudict file
+    :param n_queries: number of queries. Defaults to 1000
+    :param k: number of words returned per query. Defaults to 10
+    :param dtype: 'float32' or 'float16'. Defaults to 'float32'
+    :param n_tables: number of hash tables (see EmbeddingIndex.build_lsh()). Defaults to 16
+    :param n_bits: number of hyperplanes per table. Defaults to 16
+    :param multiprobe: if True, also probe the buckets that differ in one bit. Defaults to False
+    :param seed: random seed. Defaults to 1
+    :return: dictionary with the measurements
+    '''
+
+    model = load_model(bundle)
+    mapping = model.mapping_input
+
+    words = [word for word, _ in read_cmudict(pathname)]
+    words = [word for word in words if len(word) <= mapping.max_length and all(char in mapping.char2index for char in word)]
+
+    start = time.perf_counter()
+    index = EmbeddingIndex.from_model(model, words, dtype = dtype)
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.build_lsh(n_tables = n_tables, n_bits = n_bits)
+    build = time.perf_counter() - start
+
+    ## Queries are known words with one or two random edits
+    rng = random.Random(seed)
+    symbols = sorted(set("".join(words)))
+    sample = rng.sample(range(len(index)), n_queries)
+    queries = [perturb(words[i], symbols, rng.randint(1, 2), rng)[:mapping.max_length] for i in sample]
+    query_vectors = encode_words(model, queries)
+
+    ## All queries at once
+    start = time.perf_counter()
+    _, exact = index.search_vectors(query_vectors, k = k)
+    exact_batch = time.perf_counter() - start
+
+    ## One query at a time
+    latencies = {"exact": [], "approximate": []}
+    approximate = []
+    for row in range(n_queries):
+
+        for mode in ["exact", "approximate"] if row < 100 else ["approximate"]:
+
+            start = time.perf_counter()
+            _, ids = index.search_vectors(query_vectors[row:row + 1], k = k, approximate = mode == "approximate", multiprobe = multiprobe)
+            latencies[mode].append(time.perf_counter() - start)
+
+        approximate.append(ids[0])
+
+    latencies = {mode: np.array(values) * 1000. for mode, values in latencies.items()}
+
+    recall = np.mean([len(set(a[a >= 0]) & set(e)) / len(e) for a, e in zip(approximate, exact)])
+    hit_rate = np.mean([i in row for i, row in zip(sample, exact)])
+
+    out = {
+        "n_words": len(index),
+        "dim": index.vectors.shape[1],
+        "encode_words_per_second": len(index) / encode,
+        "lsh_build_seconds": build,
+        "index_megabytes": index.nbytes() / 1e6,
+        "exact_p50_ms": float(np.percentile(latencies["exact"], 50)),
+        "exact_batch_ms_per_query": exact_batch * 1000. / n_queries,
+        "approximate_p50_ms": float(np.percentile(latencies["approximate"], 50)),
+        "approximate_p99_ms": float(np.percentile(latencies["approximate"], 99)),
+        "recall_at_k": float(recall),
+        "source_hit_rate": float(hit_rate)
+    }
+
+    for key, value in out.items():
+        print("{:<26} {}".format(key, round(value, 4) if isinstance(value, float) else value))
+
+    return out
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmark the encoder state embedding index")
+    parser.add_argument("--bundle", required = True, help = "path to the model bundle (see Seq2Seq.save_bundle())")
+    parser.add_argument("--cmudict", default = "data/raw/cmudict/cmudict_SPHINX_40.txt", help = "path to the cmudict file")
+    parser.add_argument("--queries", type = int, default = 1000, help = "number of queries")
+    parser.add_argument("--dtype", default = "float32", choices = ["float32", "float16"], help = "dtype of the vectors")
+    parser.add_argument("--tables", type = int, default = 16, help = "number of hash tables")
+    parser.add_argument("--bits", type = int, default = 16, help = "number of hyperplanes per table")
+    parser.add_argument("--multiprobe", action = "store_true", help = "also probe the buckets that differ in one bit")
+    args = parser.parse_args()
+
+    run(args.bundle, pathname = args.cmudict, n_queries = args.queries, dtype = args.dtype, n_tables = args.tables,
+        n_bits = args.bits, multiprobe = args.multiprobe)
@@ -0,0 +1,110 @@
+## Micro-benchmark for the vectorized one_hot_encode()
+##  Run from the root of the repository: python -m benchmarks.one_hot_encode
+
+import time
+import numpy as np
+
+from phonorm.utilities import create_mapping, one_hot_encode, index_encode
+
+def one_hot_encode_loop(data, mapping, one_timestep_ahead = False, split = False):
+
+    '''
+    Reference implementation: one dictionary lookup and one scalar assignment per character.
+    This is the implementation that one_hot_encode() used before it was vectorized.
+    '''
+
+    out_ohe = np.zeros((len(data), mapping.max_length, mapping.n_chars), dtype='float32')
+
+    for entry_pos, entry in enumerate(data):
+
+        chars = entry.split(" ") if split else entry
+
+        for char_pos, char in enumerate(chars):
+
+            char_integer_repr = mapping.char2index[char]
+
+            if one_timestep_ahead:
+
+                if char_pos > 0:
+                    out_ohe[entry_pos, char_pos - 1, char_integer_repr] = 1.
+
+            else:
+
+                out_ohe[entry_pos, char_pos, char_integer_repr] = 1.
+
+    return(out_ohe)
+
+def load_pairs(dataset):
+
+    '''Load the dev and test pairs of a preprocessed dataset'''
+
+    return np.concatenate([np.load("data/preprocessed/{}_dev.npy".format(dataset)),
+                           np.load("data/preprocessed/{}_test.npy".format(dataset))])
+
+def time_function(function, *args, repeat = 3, **kwargs):
+
+    '''Return the best wall time out of repeat runs'''
+
+    timings = []
+    for _ in range(repeat):
+
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+def run(sizes = (10000, 100000), repeat = 3):
+
+    '''
+    Compare the loop and the vectorized implementation on the cmudict and wiktionary splits
+
+    :param sizes: number of words to encode. The preprocessed pairs are repeated to reach this size
+    :param repeat: number of runs per measurement. The fastest run is reported
+    :return: list of dictionaries with the timings
+    '''
+
+    results = []
+    for dataset, split in [("cmudict_multichar", True), ("cmudict_singlechar", False), ("wikt2pron", False)]:
+
+        pairs = load_pairs(dataset)
+        input_mapping, output_mapping = create_mapping("input", "output", pairs, split = split)
+
+        for size in sizes:
+
+            sample = np.resize(pairs, (size, 2))
+            words = list(sample[:, 0])
+            pronunciations = list(sample[:, 1])
+
+            for column, data, mapping, column_split in [("input", words, input_mapping, False),
+                                                        ("output", pronunciations, output_mapping, split)]:
+
+                ## Both implementations must give the same result
+                for ahead in [False, True]:
+                    assert np.array_equal(one_hot_encode(data[:1000], mapping, one_timestep_ahead = ahead, split = column_split),
+                                          one_hot_encode_loop(data[:1000], mapping, one_timestep_ahead = ahead, split = column_split))
+
+                loop = time_function(one_hot_encode_loop, data, mapping, split = column_split, repeat = repeat)
+                vectorized = time_function(one_hot_encode, data, mapping, split = column_split, repeat = repeat)
+
+                ## Same lookups without filling the dense (N, max_length, n_chars) array
+                index = time_function(index_encode, data, mapping, split = column_split, repeat = repeat)
+
+                results.append({
+                    "dataset": dataset,
+                    "column": column,
+                    "n_words": size,
+                    "loop_seconds": loop,
+                    "vectorized_seconds": vectorized,
+                    "index_seconds": index,
+                    "speedup": loop / vectorized
+                })
+
+                print("{:<20} {:<7} {:>7} words: loop {:.3f}s, vectorized {:.3f}s ({:.1f}x), index_encode {:.3f}s".format(
+                    dataset, column, size, loop, vectorized, loop / vectorized, index))
+
+    return results
+
+if __name__ == "__main__":
+
+    run()
@@ -0,0 +1,382 @@
+## Benchmark suite for the hot paths of phonorm
+##  Run from the root of the repository:
+##   python -m benchmarks.run --output benchmarks/results/$(git rev-parse --short HEAD).json
+##  Compare two runs (exits with status 1 if a timing got slower by more than the threshold):
+##   python -m benchmarks.run --compare benchmarks/results/old.json benchmarks/results/new.json
+##
+##  The models are small and untrained, with fixed seeds, so that the suite runs on a CPU in a few minutes
+##  and every run decodes the same sequences. The pairs come from data/preprocessed.
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.one_hot_encode import load_pairs, time_function
+from benchmarks.similarity_index import perturb
+from phonorm.utilities import create_mapping, one_hot_encode, index_encode
+from phonorm.evaluate import load_split, reference_pronunciation, bleu_batch, evaluate_model
+
+## Settings of the full suite and of a quick run (e.g. on every commit in CI)
+SETTINGS = {
+    "full": {"encode_sizes": [10000, 100000], "decode_words": 256, "single_words": 20, "batch_sizes": [16, 64, 256],
+             "load_repeat": 3, "train_steps": 20, "bleu_pairs": 20000, "repeat": 3},
+    "quick": {"encode_sizes": [1000, 10000], "decode_words": 64, "single_words": 5, "batch_sizes": [16, 64],
+              "load_repeat": 1, "train_steps": 5, "bleu_pairs": 2000, "repeat": 1}
+}
+
+HIDDEN_DIM = 32
+BATCH_SIZE = 64
+
+## Loads a saved model in a fresh interpreter. Prints the timings and the first prediction as json
+COLD_START = '''
+import json, time
+start = time.perf_counter()
+{imports}
+imported = time.perf_counter()
+{load}
+loaded = time.perf_counter()
+prediction = model.predict_batch(["phonorm"])[0]
+print(json.dumps({{"import_seconds": imported - start, "load_seconds": loaded - imported,
+                  "first_prediction_seconds": time.perf_counter() - loaded, "prediction": prediction}}))
+'''
+
+COLD_START_ENGINES = {
+    "keras_h5": ("from phonorm.Seq2Seq import Seq2Seq", "model = Seq2Seq(None, None, None); model.load({pathname!r})"),
+    "keras_bundle": ("from phonorm.bundle import load_model", "model = load_model({pathname!r}, engine = 'keras')"),
+    "numpy_bundle": ("from phonorm.bundle import load_model", "model = load_model({pathname!r})"),
+    "numpy_npz": ("from phonorm.inference import load_npz", "model = load_npz({pathname!r})")
+}
+
+def synthetic_model(mapping_input, mapping_output, input_mode = "one_hot", hidden_dim = HIDDEN_DIM, seed = 1):
+
+    '''
+    Compile an untrained Seq2Seq model with fixed initial weights
+
+    :param mapping_input: charmap for the input words
+    :param mapping_output: charmap for the output words
+    :param input_mode: 'one_hot' or 'index'. Defaults to 'one_hot'
+    :param hidden_dim: number of hidden units. Defaults to HIDDEN_DIM
+    :param seed: seed of the weight initialization. Defaults to 1
+    :return: Seq2Seq object that is ready for training and inference
+    '''
+
+    from keras.utils import set_random_seed
+    from phonorm.Seq2Seq import Seq2Seq
+
+    set_random_seed(seed)
+
+    model = Seq2Seq(hidden_dim, mapping_input, mapping_output, input_mode = input_mode)
+    model.Encoder(mapping_input.n_chars)
+    model.Decoder(mapping_output.n_chars)
+    model.compile_model(print_summary = False)
+    model.inference()
+
+    return model
+
+def bench_encode(pairs, mappings, settings):
+
+    '''one_hot_encode() and index_encode() of words and phonemes'''
+
+    mapping_input, mapping_output = mappings
+    out = {}
+
+    for size in settings["encode_sizes"]:
+
+        sample = np.resize(pairs, (size, 2))
+        words, pronunciations = list(sample[:, 0]), list(sample[:, 1])
+
+        seconds = time_function(one_hot_encode, words, mapping_input, repeat = settings["repeat"])
+        out["one_hot_input_{}_seconds".format(size)] = seconds
+        out["one_hot_input_{}_words_per_second".format(size)] = size / seconds
+
+        seconds = time_function(one_hot_encode, pronunciations, mapping_output, split = True, repeat = settings["repeat"])
+        out["one_hot_output_{}_seconds".format(size)] = seconds
+
+        seconds = time_function(index_encode, words, mapping_input, repeat = settings["repeat"])
+        out["index_input_{}_seconds".format(size)] = seconds
+
+    return out
+
+def bench_decode(pairs, mappings, settings):
+
+    '''Greedy decoding of single words (decode_sequence()) and batches (keras and numpy engines)'''
+
+    from phonorm.inference import load_npz
+
+    model = synthetic_model(*mappings)
+    words = [str(word) for word in np.resize(pairs, (settings["decode_words"], 2))[:, 0]]
+    out = {}
+
+    ## The first call builds the predict functions
+    model.predict(words[0])
+    model.predict_batch(words[:2])
+
+    start = time.perf_counter()
+    for word in words[:settings["single_words"]]:
+        model.predict(word)
+    out["decode_sequence_ms_per_word"] = (time.perf_counter() - start) * 1000. / settings["single_words"]
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        model.export_npz(os.path.join(directory, "model.npz"))
+        engines = {"keras": model, "numpy": load_npz(os.path.join(directory, "model.npz"))}
+
+    for engine, engine_model in engines.items():
+
+        ## The encoder skips the padding, so bucketing must not change the outputs
+        if engine_model.predict_batch(words, bucketing = True) != engine_model.predict_batch(words):
+            raise ValueError("Bucketing changes the predictions of the {} engine".format(engine))
+
+        for batch_size in settings["batch_sizes"]:
+
+            seconds = time_function(engine_model.predict_batch, words, batch_size = batch_size, repeat = settings["repeat"])
+            out["{}_batch_{}_seconds".format(engine, batch_size)] = seconds
+            out["{}_batch_{}_words_per_second".format(engine, batch_size)] = len(words) / seconds
+
+            seconds = time_function(engine_model.predict_batch, words, batch_size = batch_size, bucketing = True,
+                                    repeat = settings["repeat"])
+            out["{}_bucketed_batch_{}_seconds".format(engine, batch_size)] = seconds
+
+    return out
+
+def bench_load(pairs, mappings, settings):
+
+    '''Cold start: import, load and first prediction in a fresh interpreter'''
+
+    model = synthetic_model(*mappings)
+    out = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        pathnames = {
+            "keras_h5": os.path.join(directory, "model.h5"),
+            "keras_bundle": os.path.join(directory, "model.phonorm"),
+            "numpy_bundle": os.path.join(directory, "model.phonorm"),
+            "numpy_npz": os.path.join(directory, "model.npz")
+        }
+
+        model.fit_opts = {"hidden_dim": model.hidden_dim, "input_mode": model.input_mode}
+        model.history = {}
+        model.save(pathnames["keras_h5"])
+        model.save_bundle(pathnames["keras_bundle"])
+        model.export_npz(pathnames["numpy_npz"])
+
+        environment = dict(os.environ, TF_CPP_MIN_LOG_LEVEL = "3")
+        predictions = {}
+        for engine, (imports, load) in COLD_START_ENGINES.items():
+
+            timings = []
+            for _ in range(settings["load_repeat"]):
+
+                code = COLD_START.format(imports = imports, load = load.format(pathname = pathnames[engine]))
+                output = subprocess.run([sys.executable, "-c", code], stdout = subprocess.PIPE, env = environment,
+                                        check = True).stdout.decode("utf-8")
+                timings.append(json.loads(output.strip().splitlines()[-1]))
+
+            predictions[engine] = timings[0].pop("prediction")
+            for key in timings[0]:
+                out["{}_{}".format(engine, key)] = min(timing[key] for timing in timings)
+
+    ## Every engine must load the same model
+    if len(set(predictions.values())) > 1:
+        raise ValueError("The engines predict different pronunciations after loading: {}".format(predictions))
+
+    return out
+
+def bench_train(pairs, mappings, settings):
+
+    '''A fixed number of training steps on fixed batches'''
+
+    from phonorm.generators import PairSequence
+
+    out = {}
+    for input_mode in ["one_hot", "index"]:
+
+        model = synthetic_model(*mappings, input_mode = input_mode)
+        sequence = PairSequence(pairs, *mappings, batch_size = BATCH_SIZE, shuffle = False, input_mode = input_mode)
+
+        ## The first step builds the training function
+        start = time.perf_counter()
+        model.model.train_on_batch(*sequence[0])
+        out["{}_first_step_seconds".format(input_mode)] = time.perf_counter() - start
+
+        batches = [sequence[step % len(sequence)] for step in range(settings["train_steps"])]
+
+        start = time.perf_counter()
+        for inputs, targets in batches:
+            model.model.train_on_batch(inputs, targets)
+        seconds = time.perf_counter() - start
+
+        out["{}_seconds_per_step".format(input_mode)] = seconds / settings["train_steps"]
+        out["{}_pairs_per_second".format(input_mode)] = settings["train_steps"] * BATCH_SIZE / seconds
+
+    return out
+
+def bench_bleu(pairs, mappings, settings):
+
+    '''BLEU of the dev split against perturbed references, and evaluate_model() with the numpy engine'''
+
+    from phonorm.inference import load_npz
+
+    dev = load_split("cmudict_multichar", "dev")
+    references = [reference_pronunciation(str(pronunciation)) for pronunciation in np.resize(dev, (settings["bleu_pairs"], 2))[:, 1]]
+
+    ## Predictions with one or two edits, the same in every run
+    rng = random.Random(1)
+    symbols = sorted(set("".join(references)))
+    predictions = [perturb(reference, symbols, rng.randint(1, 2), rng) for reference in references]
+
+    out = {}
+    seconds = time_function(bleu_batch, references, predictions, repeat = settings["repeat"])
+    out["bleu_batch_seconds"] = seconds
+    out["bleu_batch_pairs_per_second"] = len(references) / seconds
+
+    model = synthetic_model(*mappings)
+    with tempfile.TemporaryDirectory() as directory:
+        model.export_npz(os.path.join(directory, "model.npz"))
+        engine = load_npz(os.path.join(directory, "model.npz"))
+
+    seconds = time_function(evaluate_model, engine, dev, repeat = settings["repeat"])
+    out["evaluate_dev_seconds"] = seconds
+    out["evaluate_dev_pairs"] = len(dev)
+
+    return out
+
+SCENARIOS = {
+    "encode": bench_encode,
+    "decode": bench_decode,
+    "load": bench_load,
+    "train": bench_train,
+    "bleu": bench_bleu
+}
+
+def environment():
+
+    '''Versions and machine, stored with the results'''
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                                check = True).stdout.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    try:
+        import tensorflow
+        tensorflow_version = tensorflow.__version__
+    except ImportError:
+        tensorflow_version = None
+
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "tensorflow": tensorflow_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count()
+    }
+
+def run(scenarios = None, quick = False, output = None):
+
+    '''
+    Run a number of scenarios
+
+    :param scenarios: names of the scenarios (see SCENARIOS). Defaults to None (all scenarios)
+    :param quick: if True, use the small settings. Defaults to False
+    :param output: path of the json file with the results. Defaults to None (not saved)
+    :return: dictionary with the environment, the settings and the results per scenario
+    '''
+
+    settings = SETTINGS["quick" if quick else "full"]
+    scenarios = list(SCENARIOS) if scenarios is None else scenarios
+
+    pairs = load_pairs("cmudict_multichar")
+    mappings = create_mapping("input", "output", pairs, split = True)
+
+    results = {"environment": environment(), "settings": settings, "results": {}}
+    for name in scenarios:
+
+        start = time.perf_counter()
+        results["results"][name] = SCENARIOS[name](pairs, mappings, settings)
+
+        print("== {} ({:.1f}s)".format(name, time.perf_counter() - start))
+        for key, value in results["results"][name].items():
+            print("{:<42} {}".format(key, round(value, 6) if isinstance(value, float) else value))
+
+    if output is not None:
+
+        os.makedirs(os.path.dirname(output) or ".", exist_ok = True)
+        with open(output, "w") as outFile:
+            json.dump(results, outFile, indent = 2)
+
+    return results
+
+def compare(old, new, threshold = 0.1):
+
+    '''
+    Compare the timings of two runs
+
+    Metrics that end in '_seconds', '_ms_per_word' or '_per_step' are timings (lower is better) and metrics
+    that end in '_per_second' are throughputs (higher is better). Other metrics are not compared.
+
+    :param old: results of run() or path of the json file
+    :param new: results of run() or path of the json file
+    :param threshold: relative slowdown that counts as a regression. Defaults to 0.1
+    :return: list of (scenario, metric, old value, new value) tuples of the regressions
+    '''
+
+    runs = []
+    for results in [old, new]:
+        if isinstance(results, str):
+            with open(results) as inFile:
+                results = json.load(inFile)
+        runs.append(results)
+
+    old, new = runs
+    regressions = []
+
+    print("{:<8} {:<42} {:>12} {:>12} {:>8}".format("scenario", "metric", "old", "new", "change"))
+    for scenario, metrics in new["results"].items():
+
+        for metric, value in metrics.items():
+
+            previous = old["results"].get(scenario, {}).get(metric)
+            if previous is None or not previous > 0:
+                continue
+
+            if metric.endswith(("_seconds", "_ms_per_word", "_per_step")):
+                slowdown = value / previous - 1.
+            elif metric.endswith("_per_second"):
+                slowdown = previous / value - 1. if value > 0 else float("inf")
+            else:
+                continue
+
+            flag = " !" if slowdown > threshold else ""
+            print("{:<8} {:<42} {:>12.6g} {:>12.6g} {:>+7.1%}{}".format(scenario, metric, previous, value, slowdown, flag))
+
+            if slowdown > threshold:
+                regressions.append((scenario, metric, previous, value))
+
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmark the encode, decode, load, train and evaluation hot paths")
+    parser.add_argument("--scenarios", nargs = "*", default = None, choices = list(SCENARIOS), help = "scenarios to run (default: all)")
+    parser.add_argument("--quick", action = "store_true", help = "small settings, e.g. for CI")
+    parser.add_argument("--output", default = None, help = "path of the json file with the results")
+    parser.add_argument("--compare", nargs = 2, default = None, metavar = ("OLD", "NEW"), help = "compare two result files")
+    parser.add_argument("--threshold", type = float, default = 0.1, help = "relative slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        sys.exit(1 if compare(*args.compare, threshold = args.threshold) else 0)
+
+    run(scenarios = args.scenarios, quick = args.quick, output = args.output)
@@ -0,0 +1,126 @@
+## Benchmark for the phonetic similarity index (phonorm.similarity)
+##  Run from the root of the repository: python -m benchmarks.similarity_index
+##  By default the cmudict pronunciations are indexed. Pass --bundle to index the pronunciations
+##  predicted by a model instead.
+
+import argparse
+import random
+import time
+import numpy as np
+
+from phonorm.lexicon import read_cmudict, model_pronunciation
+from phonorm.evaluate import codepoints
+from phonorm.similarity import PronunciationIndex
+
+def perturb(pronunciation, symbols, edits, rng):
+
+    '''Apply a number of random character insertions, deletions and substitutions'''
+
+    chars = list(pronunciation)
+    for _ in range(edits):
+
+        operation = rng.random()
+        if operation < 1 / 3 and len(chars) > 1:
+            chars.pop(rng.randrange(len(chars)))
+        elif operation < 2 / 3:
+            chars.insert(rng.randrange(len(chars) + 1), rng.choice(symbols))
+        else:
+            chars[rng.randrange(len(chars))] = rng.choice(symbols)
+
+    return "".join(chars)
+
+def brute_force(index, pronunciation, k):
+
+    '''Edit distance to every word in the index, as (word, pronunciation, distance) tuples of the k closest words'''
+
+    found = np.arange(len(index))
+    distances = index._distances(*[value if i == 0 else int(value[0]) for i, value in enumerate(codepoints([pronunciation]))], found)
+    best = np.lexsort((found, distances))[:k]
+
+    return [(str(index.words[i]), str(index.pronunciations[i]), int(distances[i])) for i in best]
+
+def run(pathname = "data/raw/cmudict/cmudict_SPHINX_40.txt", bundle = None, n_queries = 1000, n_exact = 20, k = 10,
+        max_candidates = None, seed = 1):
+
+    '''
+    Measure build time, memory and query latency on the full cmudict vocabulary
+
+    :param pathname: path to the cmudict file
+    :param bundle: path to a model bundle. If given, the predicted pronunciations are indexed. Defaults to None
+    :param n_queries: number of queries. Defaults to 1000
+    :param n_exact: number of queries that are compared with a brute force search to measure recall. Defaults to 20
+    :param k: number of words returned per query. Defaults to 10
+    :param max_candidates: maximum number of words that are reranked per query. Defaults to None (exact)
+    :param seed: random seed. Defaults to 1
+    :return: dictionary with the measurements
+    '''
+
+    pairs = read_cmudict(pathname)
+    words = [word for word, _ in pairs]
+
+    start = time.perf_counter()
+    if bundle is None:
+        index = PronunciationIndex(words, [model_pronunciation(pronunciation, join_phonemes = True) for _, pronunciation in pairs])
+    else:
+        from phonorm.bundle import load_model
+        index = PronunciationIndex.from_model(load_model(bundle), words)
+    build = time.perf_counter() - start
+
+    ## Queries are pronunciations of known words with one or two random edits
+    rng = random.Random(seed)
+    symbols = sorted(set("".join(str(pronunciation) for pronunciation in index.pronunciations)))
+    sample = rng.sample(range(len(index)), n_queries)
+    queries = [perturb(str(index.pronunciations[i]), symbols, rng.randint(1, 2), rng) for i in sample]
+
+    ## One query at a time
+    latencies = []
+    for query in queries:
+
+        start = time.perf_counter()
+        index.query(query, k = k, max_candidates = max_candidates)
+        latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000.
+
+    ## All queries at once
+    start = time.perf_counter()
+    results = index.query_batch(queries, k = k, max_candidates = max_candidates)
+    batch = time.perf_counter() - start
+
+    ## Recall compared with the edit distance to every word in the vocabulary
+    exact = [brute_force(index, query, k) for query in queries[:n_exact]]
+    recall = np.mean([len(set(word for word, _, _ in approximate) & set(word for word, _, _ in full)) / max(len(full), 1)
+                      for approximate, full in zip(results[:n_exact], exact)])
+    distance_match = np.mean([[distance for _, _, distance in approximate] == [distance for _, _, distance in full]
+                              for approximate, full in zip(results[:n_exact], exact)])
+
+    ## How often the word that was perturbed is returned
+    hit_rate = np.mean([str(index.words[i]) in [word for word, _, _ in result] for i, result in zip(sample, results)])
+
+    out = {
+        "n_words": len(index),
+        "build_seconds": build,
+        "index_megabytes": index.nbytes() / 1e6,
+        "query_p50_ms": float(np.percentile(latencies, 50)),
+        "query_p99_ms": float(np.percentile(latencies, 99)),
+        "batch_ms_per_query": batch * 1000. / n_queries,
+        "recall_at_k": float(recall),
+        "exact_distances": float(distance_match),
+        "source_hit_rate": float(hit_rate)
+    }
+
+    for key, value in out.items():
+        print("{:<20} {}".format(key, round(value, 4) if isinstance(value, float) else value))
+
+    return out
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmark the phonetic similarity index")
+    parser.add_argument("--cmudict", default = "data/raw/cmudict/cmudict_SPHINX_40.txt", help = "path to the cmudict file")
+    parser.add_argument("--bundle", default = None, help = "index the pronunciations predicted by this model bundle")
+    parser.add_argument("--queries", type = int, default = 1000, help = "number of queries")
+    parser.add_argument("--max-candidates", type = int, default = None, help = "maximum number of words reranked per query")
+    args = parser.parse_args()
+
+    run(pathname = args.cmudict, bundle = args.bundle, n_queries = args.queries, max_candidates = args.max_candidates)
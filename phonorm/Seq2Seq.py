@@ -2,12 +2,29 @@
 
 from keras import Input, Model
 from keras.models import save_model, load_model
-from keras.layers import Dense, LSTM, Bidirectional, Dot, Concatenate
+from keras.layers import Dense, LSTM, Bidirectional, Dot, Concatenate, Masking
 from keras.optimizers import Adam
+import numpy as np
 import pickle
+import os
 
-from phonorm.utilities import one_hot_encode, decode_from_ohe
-from phonorm.evaluate import plot_model_history, decode_sequence, evaluate_bleu
+from phonorm.utilities import one_hot_encode, index_encode, decode_from_ohe, sequence_lengths, length_buckets
+from phonorm.layers import OneHot, masked_sparse_categorical_crossentropy, custom_objects
+from phonorm.inference import export_npz
+from phonorm.bundle import save_bundle, Bundle
+from phonorm.generators import PairSequence
+from phonorm.dataset import PairDataset, open_pairs
+from phonorm.prepare import FrozenCharmap, freeze, save_mappings, load_mappings
+from phonorm.cache import model_fingerprint
+from phonorm.normalize import normalize_texts
+from phonorm.evaluate import plot_model_history, decode_sequence, decode_sequence_batch, beam_search_decode, evaluate_bleu, \
+    evaluate_model
+
+def _base_pathname(pathname):
+
+    '''Remove the '.h5' extension (if any) from the path of a saved model'''
+
+    return pathname[:-len(".h5")] if pathname.endswith(".h5") else pathname
 
 ## Seq2seq setup
 class Seq2Seq:
@@ -19,20 +36,42 @@ class Seq2Seq:
     Also: see Chollet, Francois. Deep learning with python. Manning Publications Co., 2017.
     '''
     
-    def __init__(self, hidden_dim, mapping_input, mapping_output):
+    def __init__(self, hidden_dim, mapping_input, mapping_output, input_mode = "one_hot", mask_padding = True):
         
         '''
         :param hidden_dim: number of hidden units
-        :param mapping_input: charmap object containing mapping and inverse mapping for the input words
-        :param mapping_output: charmap object containing mapping and inverse mapping for the output words
+        :param mapping_input: charmap object containing mapping and inverse mapping for the input words. Stored as
+            a prepare.FrozenCharmap
+        :param mapping_output: charmap object containing mapping and inverse mapping for the output words. Stored as
+            a prepare.FrozenCharmap
+        :param input_mode: either 'one_hot' (inputs are one-hot encoded, see utilities.one_hot_encode) or 'index'
+            (inputs are integer sequences, see utilities.index_encode, and are one-hot encoded inside the graph)
+        :param mask_padding: if True, the encoder skips padded timesteps, so that its states do not depend on how
+            far a word is padded (which is needed for bucketing, see fit_generator() and predict_batch()).
+            Defaults to True
         '''
         
-        self.mapping_input = mapping_input
-        self.mapping_output = mapping_output
+        if input_mode not in ["one_hot", "index"]:
+
+            raise ValueError("'input_mode' must be one of 'one_hot' or 'index'")
+
+        ## Freeze the mappings once, so that every encode call reuses their lookup tables. The mappings are None
+        #  when the model is about to be loaded (see load() and load_bundle())
+        self.mapping_input = freeze(mapping_input) if mapping_input is not None else None
+        self.mapping_output = freeze(mapping_output) if mapping_output is not None else None
+        self.input_mode = input_mode
+        self.mask_padding = mask_padding
         
         self.hidden_dim = hidden_dim
         self.model = None
         self.encoder_model = None
+
+        ## The history of a loaded bundle is only read when it is used
+        self._history = None
+        self._bundle = None
+
+        ## Counters of the prefix sharing decode (see predict_batch())
+        self.decode_stats = {}
         
         ## Define concatenator
         self.concat = Concatenate()
@@ -52,14 +91,18 @@ class Seq2Seq:
         self.encoder_vocab_length = vocab_length
         
         # Specify input
-        self.encoder_inputs = Input(shape=(None, vocab_length))
+        self.encoder_inputs, encoder_ohe = self._inputs(vocab_length, "encoder_one_hot")
+
+        ## Padding is an all-zero vector in both input modes
+        if self.mask_padding:
+            encoder_ohe = Masking(mask_value = 0.)(encoder_ohe)
 
         ## Specify the encoder
         encoder = Bidirectional(LSTM(self.hidden_dim, activation = "tanh", return_state = True, 
                                      dropout = dropout_prop, recurrent_dropout = recurrent_dropout_prop))
 
         ## Get outputs
-        encoder_outputs, forward_hidden, forward_memcell, backward_hidden, backward_memcell = encoder(self.encoder_inputs)
+        encoder_outputs, forward_hidden, forward_memcell, backward_hidden, backward_memcell = encoder(encoder_ohe)
 
         ## Concatename the forward & backward hidden cells
         self.state_hidden = self.concat([forward_hidden, backward_hidden])
@@ -80,14 +123,14 @@ class Seq2Seq:
         self.decoder_vocab_length = vocab_length
         
         ## Use encoder states as the initial states as the initial states
-        self.decoder_inputs = Input(shape = (None, vocab_length))
+        self.decoder_inputs, self.decoder_ohe = self._inputs(vocab_length, "decoder_one_hot")
 
         ## Encoder LSTM is bidirectional so we need to multiply this
         self.decoder_lstm = LSTM(self.hidden_dim * 2, return_sequences=True, return_state=True,
                             dropout = dropout_prop, recurrent_dropout = recurrent_dropout_prop)
 
         ## Save the outputs
-        decoder_outputs = self.decoder_lstm(self.decoder_inputs, initial_state = [self.state_hidden, self.state_memcell])
+        decoder_outputs = self.decoder_lstm(self.decoder_ohe, initial_state = [self.state_hidden, self.state_memcell])
 
         ## Discard elements 2 and 3 using underscore
         self.decoder_outputs, _, _ = decoder_outputs
@@ -98,19 +141,65 @@ class Seq2Seq:
         ## Save outputs
         self.decoder_outputs = self.decoder_dense(self.decoder_outputs)
         
+    def _inputs(self, vocab_length, name):
+
+        '''
+        Create the input layer for the encoder or decoder
+
+        :param vocab_length: number of characters in the charmap
+        :param name: name of the one-hot layer that is used if the input mode is 'index'
+        :return: tuple (input, one-hot encoded input)
+        '''
+
+        if self.input_mode == "index":
+
+            inputs = Input(shape = (None,), dtype = "int32")
+
+            return inputs, OneHot(vocab_length, name = name)(inputs)
+
+        inputs = Input(shape = (None, vocab_length))
+
+        return inputs, inputs
+
+    def _encode(self, words, mapping, one_timestep_ahead = False, split = False, max_length = None):
+
+        '''
+        Encode words according to the input mode of the model
+
+        :param words: list of words of length N
+        :param mapping: charmap used to encode the words
+        :param one_timestep_ahead: if True, then the encoding is one timestep ahead
+        :param split: if True, then dealing with phonemes
+        :param max_length: pad to this length instead of mapping.max_length
+        :return: one-hot encoded array (see utilities.one_hot_encode) or index array (see utilities.index_encode)
+        '''
+
+        if self.input_mode == "index":
+
+            return index_encode(words, mapping, one_timestep_ahead = one_timestep_ahead, split = split,
+                                max_length = max_length)
+
+        return one_hot_encode(words, mapping, one_timestep_ahead = one_timestep_ahead, split = split,
+                              max_length = max_length)
+
     def compile_model(self,
                       optimizer = Adam(lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=None, decay=0.0, amsgrad=False),
-                      loss = "categorical_crossentropy",
+                      loss = None,
                       print_summary = True):
 
         '''
         Compile the Keras encoder/decoder model
 
         :param optimizer: Optimizer to use for gradient descent. Defaults to Adam. See https://keras.io/optimizers/
-        :param loss: Loss to optimize. Defaults to crossentropy loss
+        :param loss: Loss to optimize. Defaults to crossentropy loss ('categorical_crossentropy' for one-hot
+            inputs, masked sparse categorical crossentropy for index inputs)
         :param print_summary: Whether to print a summary of the model. Defaults to True
         '''
         
+        if loss is None:
+
+            loss = masked_sparse_categorical_crossentropy if self.input_mode == "index" else "categorical_crossentropy"
+        
         ## Define the model
         self.model = Model([self.encoder_inputs, self.decoder_inputs], self.decoder_outputs)
         
@@ -122,25 +211,41 @@ class Seq2Seq:
         if print_summary:
             self.model.summary()
             
-    def fit(self, data_in, data_out, batch_size = 64, epochs = 10, validation_split = 0.05,
+    def fit(self, data_in, data_out = None, batch_size = 64, epochs = 10, validation_split = 0.05,
             plot_loss = True):
         
         self.fit_opts = {
             "batch_size" : batch_size,
             "epochs" : epochs,
             "validation_split" : validation_split,
-            "hidden_dim" : self.hidden_dim
+            "hidden_dim" : self.hidden_dim,
+            "input_mode" : self.input_mode,
+            "mask_padding" : self.mask_padding
         }
         
         '''
         @param data_in list containing ecoder inputs & decoder inputs
-        @param data_out one-hot encoded outputs for decoder
+        @param data_out one-hot encoded outputs for decoder (or index encoded outputs if the input mode is 'index')
+
+        data_in can also be a packed dataset (dataset.PairDataset or its path) of (word, pronunciation) pairs,
+        which is encoded in one go. data_out is then None.
         '''
         
         ## If none, raise error
         if self.model == None:
             
             raise ValueError("You must compile the model before calling 'fit'")
+
+        ## Encode a packed dataset
+        if isinstance(data_in, (str, PairDataset)):
+
+            data_in, data_out = open_pairs(data_in).encode(self.mapping_input, self.mapping_output,
+                                                           input_mode = self.input_mode)
+        
+        ## Integer targets need a trailing axis of length 1
+        if self.input_mode == "index" and data_out.ndim == 2:
+
+            data_out = data_out[:, :, np.newaxis]
         
         # Fit model and plot
         history = self.model.fit(data_in, data_out,
@@ -155,6 +260,103 @@ class Seq2Seq:
         if plot_loss:
             plot_model_history(self.history)
         
+    def fit_generator(self, pairs, validation_pairs = None, batch_size = 64, epochs = 10, validation_split = 0.05,
+                      shuffle = True, workers = 1, use_multiprocessing = False, max_queue_size = 10, seed = None,
+                      bucketing = False, plot_loss = True):
+
+        '''
+        Fit the model on raw (word, pronunciation) pairs that are encoded one mini-batch at a time
+
+        Peak memory is bounded by the batch size instead of the size of the corpus (see generators.PairSequence).
+
+        :param pairs: list or array of (word, pronunciation) training pairs, dataset.PairDataset or the path to a
+            packed dataset or .npy file
+        :param validation_pairs: list or array of (word, pronunciation) pairs, dataset.PairDataset or path used for validation.
+            If None, the last validation_split fraction of pairs is held out (like keras' validation_split)
+        :param batch_size: number of pairs per batch. Defaults to 64
+        :param epochs: number of epochs. Defaults to 10
+        :param validation_split: fraction of pairs held out for validation if validation_pairs is None. Defaults to 0.05
+        :param shuffle: if True, the training pairs are shuffled at the start of every epoch. Defaults to True
+        :param workers: number of workers that prefetch batches. Defaults to 1
+        :param use_multiprocessing: if True, use processes instead of threads for the workers. Defaults to False
+        :param max_queue_size: maximum number of prefetched batches. Defaults to 10
+        :param seed: seed for the shuffling. Defaults to None
+        :param bucketing: if True, batch pairs of similar length together and pad each batch only to its
+            longest entry (see generators.PairSequence). Requires mask_padding. Defaults to False
+        :param plot_loss: Whether to plot the loss after training. Defaults to True
+        '''
+
+        ## If none, raise error
+        if self.model == None:
+            
+            raise ValueError("You must compile the model before calling 'fit_generator'")
+
+        ## Without masking, the encoder states would depend on the padding of the bucket
+        if bucketing and not self.mask_padding:
+
+            raise ValueError("'bucketing' requires a model with 'mask_padding' = True")
+
+        pairs, validation_pairs = open_pairs(pairs), open_pairs(validation_pairs)
+
+        ## Hold out validation data (slices of a PairDataset share its memory-mapped buffers)
+        if validation_pairs is None:
+
+            n_train = len(pairs) - int(len(pairs) * validation_split)
+            pairs, validation_pairs = pairs[:n_train], pairs[n_train:]
+
+        self.fit_opts = {
+            "batch_size" : batch_size,
+            "epochs" : epochs,
+            "validation_split" : validation_split,
+            "hidden_dim" : self.hidden_dim,
+            "input_mode" : self.input_mode,
+            "mask_padding" : self.mask_padding,
+            "bucketing" : bucketing
+        }
+
+        train_sequence = PairSequence(pairs, self.mapping_input, self.mapping_output, batch_size = batch_size,
+                                      shuffle = shuffle, input_mode = self.input_mode, seed = seed,
+                                      bucketing = bucketing)
+
+        validation_sequence = None
+        if len(validation_pairs) > 0:
+            validation_sequence = PairSequence(validation_pairs, self.mapping_input, self.mapping_output,
+                                               batch_size = batch_size, shuffle = False, input_mode = self.input_mode,
+                                               bucketing = bucketing)
+
+        # Fit model and plot. The batches are shuffled by PairSequence.on_epoch_end() (with its own seed),
+        #  so keras must not reorder them.
+        history = self.model.fit(train_sequence,
+                                 epochs = epochs,
+                                 validation_data = validation_sequence,
+                                 workers = workers,
+                                 use_multiprocessing = use_multiprocessing,
+                                 max_queue_size = max_queue_size,
+                                 shuffle = False)
+
+        ## Save history
+        self.history = history.history
+
+        ## Plot historical loss
+        if plot_loss:
+            plot_model_history(self.history)
+
+    @property
+    def history(self):
+
+        '''Training history (loss per epoch)'''
+
+        if self._history is None and self._bundle is not None:
+            self._history = self._bundle.history()
+
+        return self._history
+
+    @history.setter
+    def history(self, history):
+
+        self._history = history
+        self._bundle = None
+
     def plot_model_history(self):
         
         '''Plot history of loss'''
@@ -182,7 +384,7 @@ class Seq2Seq:
 
         # Outputs to the decoder
         decoder_outputs, state_h, state_c = self.decoder_lstm(
-            self.decoder_inputs, initial_state=decoder_states_inputs)
+            self.decoder_ohe, initial_state=decoder_states_inputs)
         
         # Decoder states
         decoder_states = [state_h, state_c]
@@ -208,14 +410,128 @@ class Seq2Seq:
             ## Inference setup if not exists
             self.inference()
         
-        # One-hot encode the word
-        word_ohe = one_hot_encode([word], self.mapping_input)
+        # Encode the word
+        word_ohe = self._encode([word], self.mapping_input)
         
         # Shape should be (1, 33, 34)
         #print(word_ohe.shape)
         
         # Predict output
-        return(decode_sequence(word_ohe, self.encoder_model, self.decoder_model, self.mapping_input, self.mapping_output))
+        return(decode_sequence(word_ohe, self.encoder_model, self.decoder_model, self.mapping_input, self.mapping_output,
+                               input_mode = self.input_mode))
+    
+    def predict_batch(self, words, batch_size = 64, bucketing = False, share_prefixes = False, return_indices = False):
+
+        '''
+        Predict the pronunciation of a list of input words
+
+        Words are encoded and decoded batch_size at a time. The output is the same as calling
+        predict() on each word.
+
+        With bucketing, words of similar length are decoded together and each batch is only padded to its
+        longest word. The encoder skips the padding (see mask_padding), so this does not change the outputs.
+
+        :param words: list of words to predict
+        :param batch_size: number of words that are decoded together. Defaults to 64
+        :param bucketing: if True, group words by length and pad to the bucket maximum. Requires mask_padding.
+            Defaults to False
+        :param share_prefixes: if True, rows with the same emitted prefix and decoder state are decoded once
+            (see utilities.PrefixSharing). The counters are accumulated in self.decode_stats. Defaults to False
+        :param return_indices: if True, return lists of output token indices instead of strings (e.g. to
+            score phonemes, see evaluate.evaluate_model()). Defaults to False
+        :return: list of pronunciations in the same order as the input words
+        '''
+
+        if bucketing and not self.mask_padding:
+
+            raise ValueError("'bucketing' requires a model with 'mask_padding' = True")
+
+        if self.encoder_model is None:
+            ## Inference setup if not exists
+            self.inference()
+
+        ## Batches of word positions
+        if bucketing:
+            batches = length_buckets(sequence_lengths(words), batch_size)
+        else:
+            batches = [np.arange(start, min(start + batch_size, len(words))) for start in range(0, len(words), batch_size)]
+
+        predictions = [None] * len(words)
+        for batch in batches:
+
+            batch_words = [words[i] for i in batch]
+
+            # Encode the batch
+            max_length = max([1] + [len(word) for word in batch_words]) if bucketing else None
+            batch_ohe = self._encode(batch_words, self.mapping_input, max_length = max_length)
+
+            # Predict outputs and restore the original order
+            decoded = decode_sequence_batch(batch_ohe, self.encoder_model, self.decoder_model,
+                                            self.mapping_input, self.mapping_output,
+                                            input_mode = self.input_mode, share_prefixes = share_prefixes,
+                                            stats = self.decode_stats, return_indices = return_indices)
+            for i, pronunciation in zip(batch, decoded):
+                predictions[i] = pronunciation
+
+        return(predictions)
+
+    def encode(self, words, batch_size = 64):
+
+        '''
+        Run the bidirectional encoder only (see inference.NumpySeq2Seq.encode())
+
+        :param words: list of words of length N
+        :param batch_size: number of words that are encoded together. Defaults to 64
+        :return: tuple (state_hidden, state_memcell), each of shape (N, 2 * hidden_dim)
+        '''
+
+        if self.encoder_model is None:
+            ## Inference setup if not exists
+            self.inference()
+
+        states_hidden, states_memcell = [], []
+        for start in range(0, len(words), batch_size):
+
+            batch_ohe = self._encode(list(words[start:start + batch_size]), self.mapping_input)
+            state_hidden, state_memcell = self.encoder_model.predict(batch_ohe, verbose = 0)
+            states_hidden.append(state_hidden)
+            states_memcell.append(state_memcell)
+
+        if len(words) == 0:
+            return(np.zeros((0, 2 * self.hidden_dim), dtype = "float32"), np.zeros((0, 2 * self.hidden_dim), dtype = "float32"))
+
+        return(np.concatenate(states_hidden), np.concatenate(states_memcell))
+
+    def predict_beam(self, words, beam_width = 3, n_best = 1, length_normalization = 0.0, batch_size = 64):
+
+        '''
+        Predict the n-best pronunciations of a list of input words using beam search
+
+        :param words: list of words to predict
+        :param beam_width: number of hypotheses kept per word. Defaults to 3
+        :param n_best: number of pronunciations returned per word. Defaults to 1
+        :param length_normalization: exponent of the length penalty used to rank hypotheses. Defaults to 0
+        :param batch_size: number of words that are decoded together. Defaults to 64
+        :return: list containing a list of (pronunciation, log-probability) tuples for each word, best first
+        '''
+
+        if self.encoder_model is None:
+            ## Inference setup if not exists
+            self.inference()
+
+        predictions = []
+        for start in range(0, len(words), batch_size):
+
+            # Encode the batch
+            batch_ohe = self._encode(words[start:start + batch_size], self.mapping_input)
+
+            # Predict outputs
+            predictions += beam_search_decode(batch_ohe, self.encoder_model, self.decoder_model, self.mapping_output,
+                                              beam_width = beam_width, n_best = n_best,
+                                              length_normalization = length_normalization,
+                                              input_mode = self.input_mode)
+
+        return(predictions)
     
     def save(self, pathname = "models/model.h5"):
 
@@ -230,16 +546,18 @@ class Seq2Seq:
         self.model.save(pathname)
         
         ## Save settings as json
-        mappings_out_name = pathname.strip(".h5") + "_mappings.p"
-        fitopts_out_name = pathname.strip(".h5") + "_fit_opts.p"
-        mhist_out_name = pathname.strip(".h5") + "_history.p"
+        mappings_out_name = _base_pathname(pathname) + "_mappings.p"
+        fitopts_out_name = _base_pathname(pathname) + "_fit_opts.p"
+        mhist_out_name = _base_pathname(pathname) + "_history.p"
         
         ## Concat mappings
         mappings = [self.mapping_input, self.mapping_output]
         
-        ## Save mappings as pickle files
+        ## Save mappings as pickle files (read by older versions) and as json
         with open(mappings_out_name, "wb") as outFile:
-            pickle.dump(mappings, outFile, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump([mapping.thaw() if isinstance(mapping, FrozenCharmap) else mapping for mapping in mappings], outFile,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        save_mappings(mappings, _base_pathname(pathname) + "_mappings.json")
             
         ## Save fit options
         with open(fitopts_out_name, "wb") as outFile:
@@ -249,6 +567,113 @@ class Seq2Seq:
         with open(mhist_out_name, "wb") as outFile:
             pickle.dump(self.history, outFile, protocol = pickle.HIGHEST_PROTOCOL)
             
+    def evaluate(self, pairs, batch_size = 64, processes = 1):
+
+        '''
+        Predict and score a set of (word, pronunciation) pairs (see evaluate.evaluate_model())
+
+        :param pairs: list or array of (word, pronunciation) pairs (see evaluate.load_split())
+        :param batch_size: number of words that are decoded together. Defaults to 64
+        :param processes: number of processes used to score the predictions. Defaults to 1
+        :return: dictionary with the average scores and the per-item arrays
+        '''
+
+        return evaluate_model(self, pairs, batch_size = batch_size, processes = processes)
+
+    def normalize_texts(self, texts, batch_size = 64, return_tokens = False):
+
+        '''
+        Replace every word in a batch of texts by its pronunciation (see normalize.normalize_texts())
+
+        :param texts: list of texts
+        :param batch_size: number of words that are decoded together. Defaults to 64
+        :param return_tokens: if True, return (original token, pronunciation) tuples instead of texts. Defaults to False
+        :return: list of normalized texts
+        '''
+
+        return normalize_texts(self, texts, batch_size = batch_size, return_tokens = return_tokens)
+
+    def fingerprint(self):
+
+        '''
+        Fingerprint of the trained weights, mappings and input mode (see cache.model_fingerprint())
+
+        :return: hexadecimal sha1 digest
+        '''
+
+        return model_fingerprint(self.model.get_weights(), self.mapping_input, self.mapping_output,
+                                 extra = self.input_mode + (",mask_padding" if self.mask_padding else ""))
+
+    def export_npz(self, pathname = "models/model.npz"):
+
+        '''
+        Export the weights and mappings for the NumPy inference engine (see phonorm.inference)
+
+        :param pathname: path to store the weights. Defaults to 'models/model.npz'
+        '''
+
+        export_npz(self, pathname)
+
+    def save_bundle(self, pathname = "models/model.phonorm"):
+
+        '''
+        Save the trained model, mappings, fit options and history to a single file (see phonorm.bundle)
+
+        :param pathname: path to store the bundle. Defaults to 'models/model.phonorm'
+        '''
+
+        save_bundle(self, pathname)
+
+    def load_bundle(self, pathname = "models/model.phonorm"):
+
+        '''
+        Load a model saved with save_bundle()
+
+        The training and inference graphs are rebuilt from the settings in the bundle and the memory-mapped
+        weights are copied into the layers. The training history is read when it is first used.
+        Call compile_model() before training the model further.
+
+        :param pathname: path where the bundle is stored
+        '''
+
+        bundle = Bundle(pathname)
+        layers = bundle.graph["layers"]
+
+        self.mapping_input = bundle.mapping_input
+        self.mapping_output = bundle.mapping_output
+        self.input_mode = bundle.input_mode
+        self.mask_padding = bundle.mask_padding
+        self.hidden_dim = bundle.hidden_dim
+        self.fit_opts = bundle.fit_opts
+
+        ## Rebuild the graph
+        self.Encoder(bundle.graph["encoder_vocab_length"], dropout_prop = layers["encoder_forward"]["dropout"],
+                     recurrent_dropout_prop = layers["encoder_forward"]["recurrent_dropout"])
+        self.Decoder(bundle.graph["decoder_vocab_length"], dropout_prop = layers["decoder"]["dropout"],
+                     recurrent_dropout_prop = layers["decoder"]["recurrent_dropout"])
+        self.model = Model([self.encoder_inputs, self.decoder_inputs], self.decoder_outputs)
+
+        ## Copy the weights
+        model_layers = {layer.__class__.__name__: layer for layer in self.model.layers}
+        for name in bundle.graph["layer_weights"]:
+            model_layers[name].set_weights(bundle.layer_weights(name))
+
+        ## The activations are not arguments of Encoder() and Decoder(), so check that they match
+        for prefix, layer in [("encoder_forward", model_layers["Bidirectional"].forward_layer),
+                              ("decoder", model_layers["LSTM"])]:
+
+            config = layer.get_config()
+            for key in ["activation", "recurrent_activation"]:
+
+                if config[key] != layers[prefix][key]:
+                    raise ValueError("The bundle uses {} '{}' but this version of keras builds '{}'".format(
+                        key, layers[prefix][key], config[key]))
+
+        self._bundle = bundle
+        self._history = None
+
+        self.inference()
+            
     def load(self, pathname = "models/model.h5"):
 
         '''
@@ -257,24 +682,29 @@ class Seq2Seq:
         :param pathname: path where model is stored
         '''
         
-        self.model = load_model(pathname)
+        self.model = load_model(pathname, custom_objects = custom_objects)
         
         ## Save settings as json
-        mappings_in_name = pathname.strip(".h5") + "_mappings.p"
-        fitopts_in_name = pathname.strip(".h5") + "_fit_opts.p"
-        mhist_in_name = pathname.strip(".h5") + "_history.p"
-        
-        ## Retrieve mappings
-        with open(mappings_in_name, "rb") as inFile:
-            mappings = pickle.load(inFile)
+        mappings_in_name = _base_pathname(pathname) + "_mappings.p"
+        fitopts_in_name = _base_pathname(pathname) + "_fit_opts.p"
+        mhist_in_name = _base_pathname(pathname) + "_history.p"
+        
+        ## Retrieve mappings. The json file is not there for models saved by older versions
+        if os.path.exists(_base_pathname(pathname) + "_mappings.json"):
+            mappings = load_mappings(_base_pathname(pathname) + "_mappings.json")
+        else:
+            mappings = load_mappings(mappings_in_name)
             
-        self.mapping_input = mappings[0]
-        self.mapping_output = mappings[1]
+        self.mapping_input = freeze(mappings[0])
+        self.mapping_output = freeze(mappings[1])
         
         ## Retrieve fit options
         with open(fitopts_in_name, "rb") as inFile:
             self.fit_opts = pickle.load(inFile)
             
+        ## Models saved before the index input mode existed are one-hot models
+        self.input_mode = self.fit_opts.get("input_mode", "one_hot")
+
         ## Retrieve history
         with open(mhist_in_name, "rb") as inFile:
             self.history = pickle.load(inFile)
@@ -282,9 +712,15 @@ class Seq2Seq:
         ## Set up inference
         ## TODO: adapted from ???
         
+        ## Find the layers by type. The layer indices differ between the one-hot and index variants.
+        layers = {layer.__class__.__name__: layer for layer in self.model.layers}
+
+        ## Models saved before masking existed have no Masking layer
+        self.mask_padding = "Masking" in layers
+
         ## Load inputs & states
         encoder_inputs = self.model.input[0]   
-        encoder_outputs, forward_hidden, forward_memcell, backward_hidden, backward_memcell = self.model.layers[1].output  
+        encoder_outputs, forward_hidden, forward_memcell, backward_hidden, backward_memcell = layers["Bidirectional"].output  
 
         ## Concatenate
         concat = Concatenate()
@@ -298,25 +734,25 @@ class Seq2Seq:
         
         ## Decoder inputs
         decoder_inputs = self.model.input[1]
+        if self.input_mode == "index":
+            decoder_ohe = self.model.get_layer("decoder_one_hot").output
+        else:
+            decoder_ohe = decoder_inputs
 
         ## Create inputs
-        decoder_state_input_h = Input(shape=(self.fit_opts['hidden_dim'] * 2,),name='input_3')
-        decoder_state_input_c = Input(shape=(self.fit_opts['hidden_dim'] * 2,),name='input_4')
+        decoder_state_input_h = Input(shape=(self.fit_opts['hidden_dim'] * 2,),name='decoder_state_input_h')
+        decoder_state_input_c = Input(shape=(self.fit_opts['hidden_dim'] * 2,),name='decoder_state_input_c')
 
         ## Save states for decoder and define model
         decoder_states_inputs = [decoder_state_input_h, decoder_state_input_c]
-        decoder_lstm = self.model.layers[4]
+        decoder_lstm = layers["LSTM"]
         decoder_outputs, state_h_dec, state_c_dec = decoder_lstm(
-            decoder_inputs, initial_state=decoder_states_inputs)
+            decoder_ohe, initial_state=decoder_states_inputs)
         
         ## Propagate through densor
         decoder_states = [state_h_dec, state_c_dec]
-        decoder_dense = self.model.layers[5]
+        decoder_dense = layers["Dense"]
         decoder_outputs = decoder_dense(decoder_outputs)
         self.decoder_model = Model(
             [decoder_inputs] + decoder_states_inputs,
             [decoder_outputs] + decoder_states)
-
-
-
-
@@ -0,0 +1,243 @@
+## Bulk offline normalization with a pool of worker processes
+##  Lines are read in chunks, every worker normalizes whole chunks (see normalize.normalize_texts()) and the
+##  results are written in input order. Only max_in_flight chunks are in memory at any time.
+##
+##  e.g.
+##   python -m phonorm.bulk --bundle models/cmudict/multichar_model.phonorm --workers 8 archive.txt > normalized.txt
+##   cat archive.txt | python -m phonorm.bulk --bundle models/cmudict/multichar_model.phonorm --workers 8 -o normalized.txt
+
+from collections import deque
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+from phonorm.bundle import load_model
+from phonorm.normalize import tokenize, normalize_texts
+
+## Environment variables that limit the number of threads of the numerical libraries
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                    "VECLIB_MAXIMUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]
+
+## Model of the worker process (see _init_worker())
+_model = None
+_batch_size = 256
+
+def thread_environment(threads):
+
+    '''
+    Environment variables that limit every worker to a number of threads
+
+    The variables must be set before numpy or tensorflow are imported, so they are set in the parent
+    and inherited by the (spawned) workers.
+
+    :param threads: number of threads per worker
+    :return: dictionary with the environment variables
+    '''
+
+    return {variable: str(threads) for variable in THREAD_VARIABLES}
+
+def _init_worker(pathname, engine, threads, batch_size, lexicon, cache_size):
+
+    '''Load the model once per worker process'''
+
+    global _model, _batch_size
+
+    if engine == "keras":
+
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    model = load_model(pathname, engine = engine)
+
+    if cache_size > 0:
+
+        from phonorm.cache import CachedModel, PronunciationCache
+        model = CachedModel(model, PronunciationCache(maxsize = cache_size))
+
+    if lexicon is not None:
+
+        from phonorm.lexicon import Lexicon, LexiconModel
+        words = Lexicon()
+        words.load(lexicon)
+        model = LexiconModel(model, words)
+
+    _model = model
+    _batch_size = batch_size
+
+def _normalize_chunk(lines):
+
+    '''Normalize a chunk of lines in a worker. Returns the normalized lines and the number of words.'''
+
+    return normalize_texts(_model, lines, batch_size = _batch_size), sum(len(tokenize(line)) for line in lines)
+
+def _chunks(lines, chunk_size):
+
+    lines = iter(lines)
+    while True:
+
+        chunk = list(itertools.islice(lines, chunk_size))
+        if len(chunk) == 0:
+            return
+
+        yield chunk
+
+def normalize_lines(lines, pathname, engine = "numpy", workers = None, threads = 1, chunk_size = 1000,
+                    max_in_flight = None, batch_size = 256, lexicon = None, cache_size = 0, stats = None,
+                    start_method = "spawn"):
+
+    '''
+    Normalize a stream of lines with a pool of worker processes
+
+    Every worker loads the model once. Lines are sent to the workers in chunks of chunk_size and are yielded
+    in input order; at most max_in_flight chunks are queued or being processed at any time, so memory use
+    does not depend on the length of the input.
+
+    :param lines: iterable of lines (without line endings)
+    :param pathname: path of the model bundle (see Seq2Seq.save_bundle())
+    :param engine: 'numpy' or 'keras' (see bundle.load_model()). Defaults to 'numpy'
+    :param workers: number of worker processes. 0 normalizes in the current process. Defaults to the number of CPUs
+    :param threads: number of threads per worker. Defaults to 1
+    :param chunk_size: number of lines per task. Defaults to 1000
+    :param max_in_flight: maximum number of chunks in flight. Defaults to 2 * workers
+    :param batch_size: number of words that are decoded together. Defaults to 256
+    :param lexicon: path of a lexicon (see lexicon.Lexicon.save()) that is consulted before the model. Defaults to None
+    :param cache_size: size of the per-worker pronunciation cache (see cache.CachedModel). 0 disables the cache. Defaults to 0
+    :param stats: dictionary in which the number of lines, words and chunks are counted. Defaults to None
+    :param start_method: multiprocessing start method. Defaults to 'spawn', so that no tensorflow state is forked
+    :return: generator of normalized lines
+    '''
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if max_in_flight is None:
+        max_in_flight = 2 * max(workers, 1)
+
+    if stats is None:
+        stats = {}
+
+    for key in ["lines", "words", "chunks"]:
+        stats.setdefault(key, 0)
+
+    initargs = (pathname, engine, threads, batch_size, lexicon, cache_size)
+
+    def count(result):
+
+        normalized, words = result
+        stats["lines"] += len(normalized)
+        stats["words"] += words
+        stats["chunks"] += 1
+
+        return normalized
+
+    ## Normalize in the current process
+    if workers == 0:
+
+        _init_worker(*initargs)
+        for chunk in _chunks(lines, chunk_size):
+            yield from count(_normalize_chunk(chunk))
+
+        return
+
+    ## Spawned workers inherit the environment of the parent
+    environment = thread_environment(threads)
+    previous = {variable: os.environ.get(variable) for variable in environment}
+    os.environ.update(environment)
+
+    try:
+        pool = multiprocessing.get_context(start_method).Pool(workers, initializer = _init_worker, initargs = initargs)
+    finally:
+        for variable, value in previous.items():
+            if value is None:
+                os.environ.pop(variable)
+            else:
+                os.environ[variable] = value
+
+    try:
+
+        pending = deque()
+        for chunk in _chunks(lines, chunk_size):
+
+            ## Write the oldest chunk before more work is queued
+            if len(pending) >= max_in_flight:
+                yield from count(pending.popleft().get())
+
+            pending.append(pool.apply_async(_normalize_chunk, (chunk,)))
+
+        while pending:
+            yield from count(pending.popleft().get())
+
+        pool.close()
+
+    finally:
+
+        pool.terminate()
+        pool.join()
+
+def normalize_files(inputs, output, pathname, **kwargs):
+
+    '''
+    Normalize text files line by line
+
+    :param inputs: list of paths of input files. '-' reads from stdin
+    :param output: path of the output file. '-' writes to stdout
+    :param pathname: path of the model bundle (see Seq2Seq.save_bundle())
+    :param kwargs: passed on to normalize_lines()
+    :return: dictionary with the number of lines, words and chunks, the time in seconds and the throughput
+    '''
+
+    def read():
+
+        for input_pathname in inputs:
+
+            handle = sys.stdin if input_pathname == "-" else open(input_pathname, encoding = "utf-8")
+            try:
+                for line in handle:
+                    yield line.rstrip("\n")
+            finally:
+                if handle is not sys.stdin:
+                    handle.close()
+
+    stats = kwargs.pop("stats", {})
+    start = time.perf_counter()
+
+    handle = sys.stdout if output == "-" else open(output, "w", encoding = "utf-8")
+    try:
+        for line in normalize_lines(read(), pathname, stats = stats, **kwargs):
+            handle.write(line + "\n")
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["lines_per_second"] = stats["lines"] / stats["seconds"] if stats["seconds"] > 0 else 0.
+    stats["words_per_second"] = stats["words"] / stats["seconds"] if stats["seconds"] > 0 else 0.
+
+    return stats
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Normalize text files with a phonorm model")
+    parser.add_argument("inputs", nargs = "*", default = ["-"], help = "input files ('-' or none reads stdin)")
+    parser.add_argument("-o", "--output", default = "-", help = "output file ('-' writes stdout)")
+    parser.add_argument("--bundle", required = True, help = "path to the model bundle (see Seq2Seq.save_bundle())")
+    parser.add_argument("--engine", default = "numpy", choices = ["numpy", "keras"], help = "inference engine")
+    parser.add_argument("--workers", type = int, default = None, help = "number of worker processes (0: no pool)")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of threads per worker")
+    parser.add_argument("--chunk-size", type = int, default = 1000, help = "number of lines per task")
+    parser.add_argument("--max-in-flight", type = int, default = None, help = "maximum number of chunks in flight")
+    parser.add_argument("--batch-size", type = int, default = 256, help = "number of words decoded together")
+    parser.add_argument("--lexicon", default = None, help = "lexicon that is consulted before the model")
+    parser.add_argument("--cache-size", type = int, default = 0, help = "size of the per-worker pronunciation cache")
+    args = parser.parse_args()
+
+    stats = normalize_files(args.inputs, args.output, args.bundle, engine = args.engine, workers = args.workers,
+                            threads = args.threads, chunk_size = args.chunk_size, max_in_flight = args.max_in_flight,
+                            batch_size = args.batch_size, lexicon = args.lexicon, cache_size = args.cache_size)
+
+    print("Normalized {lines} lines ({words} words) in {seconds:.1f}s: {lines_per_second:.1f} lines/s, "
+          "{words_per_second:.1f} words/s".format(**stats), file = sys.stderr)
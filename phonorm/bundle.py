@@ -0,0 +1,315 @@
+## Versioned single-file model bundles
+##  A bundle holds everything that is needed to serve or continue training a model: the weights, the charmaps,
+##  the fit options, the layer settings of the graph and (read only on request) the training history.
+##  Like phonorm.inference, this module must not import keras or tensorflow.
+
+import json
+import os
+import struct
+import numpy as np
+
+from phonorm.prepare import FrozenCharmap
+from phonorm.inference import model_weights, NumpySeq2Seq
+
+## Every container starts with MAGIC, the format version and the length of the json header
+MAGIC = b"PHONORM\x00"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sIQ")
+
+## Arrays are aligned so that they can be memory-mapped without copying
+ALIGNMENT = 64
+
+## Order of the weights of the Bidirectional, LSTM and Dense layers (see Seq2Seq.load_bundle())
+LAYER_WEIGHTS = {
+    "Bidirectional": ["encoder_forward_kernel", "encoder_forward_recurrent_kernel", "encoder_forward_bias",
+                      "encoder_backward_kernel", "encoder_backward_recurrent_kernel", "encoder_backward_bias"],
+    "LSTM": ["decoder_kernel", "decoder_recurrent_kernel", "decoder_bias"],
+    "Dense": ["dense_kernel", "dense_bias"]
+}
+
+def _aligned(offset):
+
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_container(pathname, meta, arrays = None, blobs = None, magic = MAGIC):
+
+    '''
+    Write a json header, numpy arrays and raw byte strings to a single file
+
+    The file is written next to pathname and then moved into place, so that readers never see a partial file.
+
+    :param pathname: path of the file
+    :param meta: dictionary that can be serialized to json
+    :param arrays: dictionary name --> numpy array. Defaults to None (no arrays)
+    :param blobs: dictionary name --> bytes. Blobs are only read when they are asked for. Defaults to None (no blobs)
+    :param magic: 8 bytes that identify the type of file. Defaults to MAGIC
+    '''
+
+    arrays = {name: np.ascontiguousarray(array) for name, array in (arrays or {}).items()}
+    blobs = blobs or {}
+
+    ## Offsets are relative to the start of the data section
+    sections = {"arrays": {}, "blobs": {}}
+    offset = 0
+    for name, array in arrays.items():
+
+        if array.dtype.hasobject:
+            raise ValueError("Array '{}' has dtype object and cannot be stored".format(name))
+
+        offset = _aligned(offset)
+        sections["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+
+    for name, blob in blobs.items():
+
+        offset = _aligned(offset)
+        sections["blobs"][name] = {"offset": offset, "length": len(blob)}
+        offset += len(blob)
+
+    header = json.dumps({"meta": meta, "arrays": sections["arrays"], "blobs": sections["blobs"]}).encode("utf-8")
+    data_start = _aligned(PREAMBLE.size + len(header))
+
+    temp_pathname = pathname + ".tmp"
+    with open(temp_pathname, "wb") as outFile:
+
+        outFile.write(PREAMBLE.pack(magic, FORMAT_VERSION, len(header)))
+        outFile.write(header)
+
+        for name, array in arrays.items():
+            outFile.seek(data_start + sections["arrays"][name]["offset"])
+            outFile.write(array.tobytes())
+
+        for name, blob in blobs.items():
+            outFile.seek(data_start + sections["blobs"][name]["offset"])
+            outFile.write(blob)
+
+        ## Make sure that the file is as long as the last (possibly empty) section says
+        outFile.truncate(data_start + offset)
+
+    os.replace(temp_pathname, pathname)
+
+class Container:
+
+    '''
+    Read a file written with write_container()
+
+    Only the header is read when the container is opened. Arrays are memory-mapped and blobs are
+    read from disk when they are asked for.
+    '''
+
+    def __init__(self, pathname, magic = MAGIC):
+
+        '''
+        :param pathname: path of the file
+        :param magic: 8 bytes that identify the type of file. Defaults to MAGIC
+        '''
+
+        self.pathname = pathname
+
+        with open(pathname, "rb") as inFile:
+
+            preamble = inFile.read(PREAMBLE.size)
+            if len(preamble) < PREAMBLE.size or preamble[:len(magic)] != magic:
+                raise ValueError("'{}' is not a phonorm file of the expected type".format(pathname))
+
+            _, self.version, header_length = PREAMBLE.unpack(preamble)
+            if self.version > FORMAT_VERSION:
+                raise ValueError("'{}' has format version {}, this version of phonorm reads up to version {}".format(
+                    pathname, self.version, FORMAT_VERSION))
+
+            header = json.loads(inFile.read(header_length).decode("utf-8"))
+
+        self.meta = header["meta"]
+        self._arrays = header["arrays"]
+        self._blobs = header["blobs"]
+        self._data_start = _aligned(PREAMBLE.size + header_length)
+
+    def __contains__(self, name):
+
+        return name in self._arrays or name in self._blobs
+
+    def array_names(self):
+
+        '''
+        :return: list with the names of the arrays in the container
+        '''
+
+        return list(self._arrays)
+
+    def array(self, name):
+
+        '''
+        Memory-map a single array
+
+        :param name: name of the array
+        :return: read-only numpy memmap
+        '''
+
+        spec = self._arrays[name]
+        shape = tuple(spec["shape"])
+
+        ## Empty arrays cannot be memory-mapped
+        if 0 in shape:
+            return np.empty(shape, dtype = spec["dtype"])
+
+        return np.memmap(self.pathname, dtype = spec["dtype"], mode = "r", shape = shape,
+                         offset = self._data_start + spec["offset"])
+
+    def blob(self, name):
+
+        '''
+        Read a single blob
+
+        :param name: name of the blob
+        :return: bytes
+        '''
+
+        spec = self._blobs[name]
+
+        with open(self.pathname, "rb") as inFile:
+            inFile.seek(self._data_start + spec["offset"])
+            return inFile.read(spec["length"])
+
+def save_bundle(model, pathname = "models/model.phonorm"):
+
+    '''
+    Store a trained (or loaded) Seq2Seq model as a single file
+
+    :param model: Seq2Seq object
+    :param pathname: path to store the bundle. Defaults to 'models/model.phonorm'
+    '''
+
+    arrays, config = model_weights(model)
+
+    fit_opts = getattr(model, "fit_opts", None) or {"hidden_dim": model.hidden_dim, "input_mode": model.input_mode}
+
+    meta = {
+        "format": "phonorm-bundle",
+        "hidden_dim": model.hidden_dim,
+        "input_mode": model.input_mode,
+        "fit_opts": fit_opts,
+        "mapping_input": model.mapping_input.to_dict(),
+        "mapping_output": model.mapping_output.to_dict(),
+        ## Everything that is needed to rebuild the training and inference graphs without loading a keras model
+        "graph": {
+            "encoder_vocab_length": model.mapping_input.n_chars,
+            "decoder_vocab_length": model.mapping_output.n_chars,
+            "layers": config,
+            "layer_weights": LAYER_WEIGHTS,
+            "mask_padding": model.mask_padding
+        }
+    }
+
+    blobs = {}
+    if model.history is not None:
+        blobs["history"] = json.dumps(model.history, default = float).encode("utf-8")
+
+    write_container(pathname, meta, arrays = arrays, blobs = blobs)
+
+class Bundle:
+
+    '''
+    Model stored with save_bundle()
+
+    Opening a bundle only reads the json header. The weights are memory-mapped and the training
+    history is only read by history().
+    '''
+
+    def __init__(self, pathname = "models/model.phonorm"):
+
+        '''
+        :param pathname: path where the bundle is stored
+        '''
+
+        self.container = Container(pathname)
+        self.meta = self.container.meta
+
+        if self.meta.get("format") != "phonorm-bundle":
+            raise ValueError("'{}' is not a phonorm model bundle".format(pathname))
+
+        self.hidden_dim = self.meta["hidden_dim"]
+        self.input_mode = self.meta["input_mode"]
+        self.fit_opts = self.meta["fit_opts"]
+        self.graph = self.meta["graph"]
+
+        ## Bundles saved before masking existed have an unmasked encoder
+        self.mask_padding = self.graph.get("mask_padding", False)
+
+        self.mapping_input = FrozenCharmap.from_dict(self.meta["mapping_input"])
+        self.mapping_output = FrozenCharmap.from_dict(self.meta["mapping_output"])
+
+    def weights(self):
+
+        '''
+        Memory-map the weights
+
+        :return: dictionary with the arrays of model_weights() and the activations of the LSTM layers
+            (the same entries as a .npz file written by inference.export_npz())
+        '''
+
+        weights = {name: self.container.array(name) for name in self.container.array_names()}
+
+        for prefix, config in self.graph["layers"].items():
+
+            weights[prefix + "_activation"] = np.array(config["activation"])
+            weights[prefix + "_recurrent_activation"] = np.array(config["recurrent_activation"])
+
+        return weights
+
+    def layer_weights(self, layer):
+
+        '''
+        Weights of a single keras layer, in the order of layer.get_weights()
+
+        :param layer: class name of the layer ('Bidirectional', 'LSTM' or 'Dense')
+        :return: list of numpy arrays
+        '''
+
+        return [self.container.array(name) for name in self.graph["layer_weights"][layer]]
+
+    def history(self):
+
+        '''
+        Read the training history
+
+        :return: dictionary with the loss per epoch or None if the model was not trained
+        '''
+
+        if "history" not in self.container:
+            return None
+
+        return json.loads(self.container.blob("history").decode("utf-8"))
+
+    def numpy_model(self):
+
+        '''
+        Create the NumPy inference engine (see inference.NumpySeq2Seq) without keras
+
+        :return: NumpySeq2Seq object
+        '''
+
+        return NumpySeq2Seq(self.weights(), self.mapping_input, self.mapping_output, mask_padding = self.mask_padding)
+
+def load_model(pathname, engine = "numpy"):
+
+    '''
+    Load a model bundle saved with save_bundle()
+
+    :param pathname: path of the bundle
+    :param engine: 'numpy' (inference.NumpySeq2Seq, no keras needed) or 'keras' (Seq2Seq). Defaults to 'numpy'
+    :return: model with a predict_batch method
+    '''
+
+    if engine == "numpy":
+
+        return Bundle(pathname).numpy_model()
+
+    if engine == "keras":
+
+        ## Only import keras when it is needed
+        from phonorm.Seq2Seq import Seq2Seq
+        model = Seq2Seq(None, None, None)
+        model.load_bundle(pathname)
+        return model
+
+    raise ValueError("'engine' must be one of 'numpy' or 'keras'")
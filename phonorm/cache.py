@@ -0,0 +1,276 @@
+## Pronunciation cache that sits in front of a model's predict functions
+
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+
+
+def model_fingerprint(weights, mapping_input, mapping_output, extra = ""):
+
+    '''
+    Create a fingerprint that identifies a trained model
+
+    :param weights: list of numpy arrays containing the model weights
+    :param mapping_input: charmap object for the input words
+    :param mapping_output: charmap object for the output words
+    :param extra: any other string that changes the predictions (e.g. the input mode)
+    :return: hexadecimal sha1 digest
+    '''
+
+    digest = hashlib.sha1()
+
+    for array in weights:
+        digest.update(str(array.shape).encode("utf-8"))
+        digest.update(array.tobytes())
+
+    for mapping in [mapping_input, mapping_output]:
+        digest.update(repr([mapping.index2char[i] for i in range(mapping.n_chars)]).encode("utf-8"))
+        digest.update(repr((mapping.max_length, mapping.split)).encode("utf-8"))
+
+    digest.update(extra.encode("utf-8"))
+
+    return digest.hexdigest()
+
+class PronunciationCache:
+
+    '''
+    Thread-safe LRU cache from (model fingerprint, word) --> pronunciation
+
+    Up to maxsize entries are kept in memory; the least recently used entry is evicted first.
+    If a path is given, every entry is also written to a sqlite database so that a warm cache
+    survives restarts. Entries that were evicted from memory are read back from disk on a miss.
+    '''
+
+    def __init__(self, maxsize = 100000, path = None):
+
+        '''
+        :param maxsize: maximum number of entries kept in memory. Defaults to 100000
+        :param path: path of the sqlite database used to persist the cache. Defaults to None (memory only)
+        '''
+
+        self.maxsize = maxsize
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._connection = None
+
+        if path is not None:
+
+            self._connection = sqlite3.connect(path, check_same_thread = False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS pronunciations "
+                                     "(fingerprint TEXT, word TEXT, pronunciation TEXT, PRIMARY KEY (fingerprint, word))")
+            self._connection.commit()
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def _remember(self, key, pronunciation):
+
+        '''Add an entry to memory and evict the least recently used entries'''
+
+        self._entries[key] = pronunciation
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last = False)
+
+    def get_many(self, fingerprint, words):
+
+        '''
+        Look up a list of words
+
+        :param fingerprint: fingerprint of the model (see model_fingerprint())
+        :param words: list of words
+        :return: dictionary word --> pronunciation for the words that are in the cache
+        '''
+
+        found = {}
+
+        with self._lock:
+
+            missing = []
+            for word in words:
+
+                key = (fingerprint, word)
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[word] = self._entries[key]
+                else:
+                    missing.append(word)
+
+            ## Fall back on the database
+            if self._connection is not None and len(missing) > 0:
+
+                for word in set(missing):
+
+                    row = self._connection.execute("SELECT pronunciation FROM pronunciations WHERE fingerprint = ? AND word = ?",
+                                                   (fingerprint, word)).fetchone()
+                    if row is not None:
+                        found[word] = row[0]
+                        self._remember((fingerprint, word), row[0])
+
+            self.hits += sum(1 for word in words if word in found)
+            self.misses += sum(1 for word in words if word not in found)
+
+        return found
+
+    def get(self, fingerprint, word):
+
+        '''
+        Look up a single word
+
+        :param fingerprint: fingerprint of the model (see model_fingerprint())
+        :param word: word to look up
+        :return: pronunciation or None if the word is not in the cache
+        '''
+
+        return self.get_many(fingerprint, [word]).get(word)
+
+    def put_many(self, fingerprint, pronunciations):
+
+        '''
+        Add pronunciations to the cache
+
+        :param fingerprint: fingerprint of the model (see model_fingerprint())
+        :param pronunciations: dictionary word --> pronunciation
+        '''
+
+        with self._lock:
+
+            for word, pronunciation in pronunciations.items():
+                self._remember((fingerprint, word), pronunciation)
+
+            if self._connection is not None:
+
+                self._connection.executemany("INSERT OR REPLACE INTO pronunciations VALUES (?, ?, ?)",
+                                             [(fingerprint, word, pronunciation) for word, pronunciation in pronunciations.items()])
+                self._connection.commit()
+
+    def put(self, fingerprint, word, pronunciation):
+
+        '''
+        Add a single pronunciation to the cache
+
+        :param fingerprint: fingerprint of the model (see model_fingerprint())
+        :param word: word
+        :param pronunciation: predicted pronunciation
+        '''
+
+        self.put_many(fingerprint, {word: pronunciation})
+
+    def stats(self):
+
+        '''
+        Hit/miss counters
+
+        :return: dictionary with hits, misses, hit_rate, size and maxsize
+        '''
+
+        with self._lock:
+
+            lookups = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+                "size": len(self._entries),
+                "maxsize": self.maxsize
+            }
+
+    def clear(self):
+
+        '''Remove all entries (also from disk) and reset the counters'''
+
+        with self._lock:
+
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM pronunciations")
+                self._connection.commit()
+
+    def close(self):
+
+        '''Close the database connection'''
+
+        with self._lock:
+
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+class CachedModel:
+
+    '''
+    Wrap a model (Seq2Seq or inference.NumpySeq2Seq) so that predictions are served from a PronunciationCache
+
+    Only words that are not in the cache are passed to the model, as one batch. All other
+    attributes are looked up on the wrapped model.
+    '''
+
+    def __init__(self, model, cache = None):
+
+        '''
+        :param model: object with fingerprint() and predict_batch() methods
+        :param cache: PronunciationCache. Defaults to a new in-memory cache
+        '''
+
+        self.model = model
+        self.cache = PronunciationCache() if cache is None else cache
+        self._fingerprint = model.fingerprint()
+
+    def __getattr__(self, name):
+
+        return getattr(self.model, name)
+
+    def fingerprint(self):
+
+        '''
+        Fingerprint of the wrapped model (see cache.model_fingerprint())
+
+        :return: hexadecimal sha1 digest
+        '''
+
+        return self._fingerprint
+
+    def predict_batch(self, words, batch_size = 64):
+
+        '''
+        Predict the pronunciation of a list of input words
+
+        :param words: list of words to predict
+        :param batch_size: number of words that are decoded together by the model. Defaults to 64
+        :return: list of pronunciations in the same order as the input words
+        '''
+
+        found = self.cache.get_many(self._fingerprint, words)
+
+        ## Predict every missing word once
+        missing = list(OrderedDict.fromkeys(word for word in words if word not in found))
+        if len(missing) > 0:
+
+            predicted = dict(zip(missing, self.model.predict_batch(missing, batch_size = batch_size)))
+            self.cache.put_many(self._fingerprint, predicted)
+            found.update(predicted)
+
+        return [found[word] for word in words]
+
+    def predict(self, word):
+
+        '''
+        Predict the pronunciation of an input word
+
+        :param word: word to predict
+        :return: pronunciation of input word
+        '''
+
+        return self.predict_batch([word])[0]
@@ -0,0 +1,389 @@
+## Packed, memory-mappable datasets of (word, pronunciation) pairs
+##  The words and pronunciations are stored as UTF-8 byte buffers with int64 offsets, optionally together with
+##  their integer representation against a stored pair of charmaps (see bundle.write_container()). Opening a
+##  dataset only reads the json header; slicing and batching read the bytes of the selected pairs.
+##
+##  e.g.
+##   python -m phonorm.dataset data/preprocessed/cmudict_multichar_*.npy --bundle models/model.phonorm
+
+import argparse
+import os
+import numpy as np
+
+from phonorm.bundle import write_container, Container
+from phonorm.prepare import FrozenCharmap
+from phonorm.utilities import encode_positions, sequence_lengths
+
+FIELDS = ["word", "pronunciation"]
+
+def _pack(strings):
+
+    '''UTF-8 byte buffer and offsets of a list of strings'''
+
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype = "int64")
+    np.cumsum([len(string) for string in encoded], out = offsets[1:])
+
+    return np.frombuffer(b"".join(encoded), dtype = "uint8"), offsets
+
+def _tokenize(strings, mapping):
+
+    '''Integer representation and offsets of a list of strings (see utilities.encode_positions())'''
+
+    lengths = sequence_lengths(strings, split = mapping.split)
+    _, _, indices = encode_positions(strings, mapping, split = mapping.split, max_length = int(lengths.max(initial = 0)) + 1)
+
+    offsets = np.zeros(len(strings) + 1, dtype = "int64")
+    np.cumsum(lengths, out = offsets[1:])
+
+    return indices.astype("int16" if mapping.n_chars < 2 ** 15 else "int32"), offsets
+
+def _gather(buffer, offsets, rows):
+
+    '''
+    Concatenate the entries of a number of rows
+
+    :return: tuple (flat array with the elements of the rows, int64 array with the length of every row)
+    '''
+
+    starts, lengths = offsets[rows], offsets[rows + 1] - offsets[rows]
+
+    ## Position of every element in the buffer
+    positions = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+    return buffer[positions], lengths
+
+def _fill(rows, positions, indices, n_rows, mapping, max_length, input_mode):
+
+    '''Padded index or one-hot array (see utilities.index_encode() and utilities.one_hot_encode())'''
+
+    if input_mode == "index":
+
+        out = np.full((n_rows, max_length), mapping.char2index["<PAD>"], dtype = "int32")
+        out[rows, positions] = indices
+
+    else:
+
+        out = np.zeros((n_rows, max_length, mapping.n_chars), dtype = "float32")
+        out[rows, positions, indices] = 1.
+
+    return out
+
+def write_dataset(pathname, pairs, mapping_input = None, mapping_output = None):
+
+    '''
+    Store (word, pronunciation) pairs as a packed dataset
+
+    :param pathname: path of the dataset (e.g. 'data/preprocessed/cmudict_multichar_train.pairs')
+    :param pairs: list or array of (word, pronunciation) pairs
+    :param mapping_input: if given together with mapping_output, the integer representation of the words is
+        stored as well, so that batches can be encoded without decoding any string. Defaults to None
+    :param mapping_output: charmap object for the pronunciations. Defaults to None
+    '''
+
+    strings = {"word": [str(pair[0]) for pair in pairs], "pronunciation": [str(pair[1]) for pair in pairs]}
+
+    meta = {"format": "phonorm-dataset", "n": len(strings["word"])}
+    arrays = {}
+    for field in FIELDS:
+        arrays[field + "_bytes"], arrays[field + "_offsets"] = _pack(strings[field])
+
+    if mapping_input is not None and mapping_output is not None:
+
+        meta["mapping_input"] = mapping_input.to_dict()
+        meta["mapping_output"] = mapping_output.to_dict()
+
+        for field, mapping in zip(FIELDS, [mapping_input, mapping_output]):
+            arrays[field + "_indices"], arrays[field + "_index_offsets"] = _tokenize(strings[field], mapping)
+
+    write_container(pathname, meta, arrays = arrays)
+
+class PairDataset:
+
+    '''
+    Dataset stored with write_dataset()
+
+    Behaves like a read-only sequence of (word, pronunciation) tuples. Slices with step 1 are views that share
+    the memory-mapped buffers of the dataset. words(), pronunciations() and encode() take the rows of a batch at once.
+    '''
+
+    def __init__(self, pathname):
+
+        '''
+        :param pathname: path where the dataset is stored
+        '''
+
+        self.container = Container(pathname)
+        self.meta = self.container.meta
+
+        if self.meta.get("format") != "phonorm-dataset":
+            raise ValueError("'{}' is not a phonorm dataset".format(pathname))
+
+        self.pathname = pathname
+        self._arrays = {name: self.container.array(name) for name in self.container.array_names()}
+
+        self.mapping_input, self.mapping_output = None, None
+        if "mapping_input" in self.meta:
+            self.mapping_input = FrozenCharmap.from_dict(self.meta["mapping_input"])
+            self.mapping_output = FrozenCharmap.from_dict(self.meta["mapping_output"])
+
+    def _view(self, start, stop):
+
+        view = self.__class__.__new__(self.__class__)
+        view.__dict__.update(self.__dict__)
+
+        ## Only the offsets are sliced, the buffers are shared
+        view._arrays = {name: array[start:stop + 1] if name.endswith("offsets") else array
+                        for name, array in self._arrays.items()}
+
+        return view
+
+    def __len__(self):
+
+        return len(self._arrays["word_offsets"]) - 1
+
+    def __getitem__(self, idx):
+
+        if isinstance(idx, slice):
+
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return self._view(start, max(start, stop))
+
+            return list(zip(self.words(np.arange(start, stop, step)), self.pronunciations(np.arange(start, stop, step))))
+
+        if idx < 0:
+            idx += len(self)
+
+        if not 0 <= idx < len(self):
+            raise IndexError("Dataset index out of range")
+
+        return self.words([idx])[0], self.pronunciations([idx])[0]
+
+    def __iter__(self):
+
+        return zip(self.words(), self.pronunciations())
+
+    def _strings(self, field, rows):
+
+        buffer, offsets = self._arrays[field + "_bytes"], self._arrays[field + "_offsets"]
+
+        if rows is None:
+            start, stop = int(offsets[0]), int(offsets[-1])
+            data, lengths = bytes(buffer[start:stop]), np.diff(offsets)
+        else:
+            data, lengths = _gather(buffer, offsets, np.asarray(rows, dtype = "int64"))
+            data = data.tobytes()
+
+        bounds = np.zeros(len(lengths) + 1, dtype = "int64")
+        np.cumsum(lengths, out = bounds[1:])
+
+        return [data[start:stop].decode("utf-8") for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+    def words(self, rows = None):
+
+        '''
+        :param rows: row numbers. Defaults to None (all rows)
+        :return: list with the words of the rows
+        '''
+
+        return self._strings("word", rows)
+
+    def pronunciations(self, rows = None):
+
+        '''
+        :param rows: row numbers. Defaults to None (all rows)
+        :return: list with the pronunciations of the rows
+        '''
+
+        return self._strings("pronunciation", rows)
+
+    def lengths(self, field = "word"):
+
+        '''
+        Number of timesteps of every entry, without decoding any string
+
+        :param field: 'word' or 'pronunciation'. Defaults to 'word'
+        :return: numpy int64 array of length N. Pronunciations are counted in tokens if the dataset is tokenized
+            and the output mapping is split, else in characters
+        '''
+
+        if field + "_index_offsets" in self._arrays:
+            return np.diff(self._arrays[field + "_index_offsets"])
+
+        if field == "pronunciation":
+            return sequence_lengths(self.pronunciations())
+
+        ## Count the bytes that start a UTF-8 character
+        offsets = self._arrays[field + "_offsets"]
+        buffer = self._arrays[field + "_bytes"][offsets[0]:offsets[-1]]
+
+        starts = np.zeros(len(buffer) + 1, dtype = "int64")
+        np.cumsum((buffer & 0xC0) != 0x80, out = starts[1:])
+
+        return np.diff(starts[offsets - offsets[0]])
+
+    def tokenized(self, mapping_input, mapping_output):
+
+        '''
+        :return: True if the stored integer representation was made with the same charmaps
+        '''
+
+        if self.mapping_input is None:
+            return False
+
+        return all(stored.to_dict()["chars"] == mapping.to_dict()["chars"] and stored.split == mapping.split
+                   for stored, mapping in [(self.mapping_input, mapping_input), (self.mapping_output, mapping_output)])
+
+    def _positions(self, field, rows, one_timestep_ahead, max_length):
+
+        '''(rows, positions, indices) of the stored integer representation (see utilities.encode_positions())'''
+
+        indices, lengths = _gather(self._arrays[field + "_indices"], self._arrays[field + "_index_offsets"], rows)
+        indices = indices.astype("int64")
+
+        batch_rows = np.repeat(np.arange(len(rows)), lengths)
+        positions = np.arange(len(indices)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        if one_timestep_ahead:
+
+            keep = positions > 0
+            batch_rows, positions, indices = batch_rows[keep], positions[keep] - 1, indices[keep]
+
+        if len(positions) > 0 and positions.max() >= max_length:
+
+            raise IndexError("Input contains sequences that are longer than the max length ({})".format(max_length))
+
+        return batch_rows, positions, indices
+
+    def encode(self, mapping_input, mapping_output, rows = None, input_mode = "one_hot", bucketing = False):
+
+        '''
+        Encode a number of pairs for training (see generators.PairSequence)
+
+        The stored integer representation is used if it was made with the same charmaps (see tokenized()),
+        otherwise the strings are decoded and encoded with the charmaps.
+
+        :param mapping_input: charmap object for the input words
+        :param mapping_output: charmap object for the output words
+        :param rows: row numbers. Defaults to None (all rows)
+        :param input_mode: 'one_hot' or 'index' (see Seq2Seq). Defaults to 'one_hot'
+        :param bucketing: if True, pad to the longest entry of the rows instead of the max length of the mappings.
+            Defaults to False
+        :return: tuple ([encoder inputs, decoder inputs], decoder targets)
+        '''
+
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype = "int64")
+        split = mapping_output.split
+
+        if self.tokenized(mapping_input, mapping_output):
+
+            input_lengths = np.diff(self._arrays["word_index_offsets"])[rows]
+            output_lengths = np.diff(self._arrays["pronunciation_index_offsets"])[rows]
+
+            def positions(field, one_timestep_ahead, max_length):
+                return self._positions(field, rows, one_timestep_ahead, max_length)
+
+        else:
+
+            words, pronunciations = self.words(rows), self.pronunciations(rows)
+            input_lengths = sequence_lengths(words)
+            output_lengths = sequence_lengths(pronunciations, split = split)
+
+            def positions(field, one_timestep_ahead, max_length):
+                if field == "word":
+                    return encode_positions(words, mapping_input, max_length = max_length)
+                return encode_positions(pronunciations, mapping_output, one_timestep_ahead = one_timestep_ahead,
+                                        split = split, max_length = max_length)
+
+        ## Pad to the longest entry of the batch or to the max length of the mappings
+        input_length, output_length = mapping_input.max_length, mapping_output.max_length
+        if bucketing:
+            input_length = int(input_lengths.max(initial = 1))
+            output_length = int(output_lengths.max(initial = 1))
+
+        encoder_in = _fill(*positions("word", False, input_length), len(rows), mapping_input, input_length, input_mode)
+        decoder_in = _fill(*positions("pronunciation", False, output_length), len(rows), mapping_output,
+                           output_length, input_mode)
+        decoder_target = _fill(*positions("pronunciation", True, output_length), len(rows), mapping_output,
+                               output_length, input_mode)
+
+        ## Integer targets need a trailing axis of length 1
+        if input_mode == "index":
+            decoder_target = decoder_target[:, :, np.newaxis]
+
+        return ([encoder_in, decoder_in], decoder_target)
+
+def open_pairs(pairs):
+
+    '''
+    Open pairs that are given as a path
+
+    :param pairs: path to a packed dataset or a .npy file, or pairs that are returned as they are
+    :return: PairDataset, numpy array or the input
+    '''
+
+    if not isinstance(pairs, str):
+        return pairs
+
+    if pairs.endswith(".npy"):
+        return np.load(pairs, allow_pickle = True)
+
+    return PairDataset(pairs)
+
+def convert_npy(npy_pathname, pathname = None, mapping_input = None, mapping_output = None):
+
+    '''
+    Convert a .npy file of (word, pronunciation) pairs to a packed dataset
+
+    :param npy_pathname: path to the .npy file (e.g. 'data/preprocessed/wikt2pron_dev.npy')
+    :param pathname: path of the dataset. Defaults to npy_pathname with the extension '.pairs'
+    :param mapping_input: charmap object for the words (see write_dataset()). Defaults to None
+    :param mapping_output: charmap object for the pronunciations. Defaults to None
+    :return: path of the dataset
+    '''
+
+    if pathname is None:
+        pathname = os.path.splitext(npy_pathname)[0] + ".pairs"
+
+    write_dataset(pathname, np.load(npy_pathname, allow_pickle = True), mapping_input = mapping_input,
+                  mapping_output = mapping_output)
+
+    return pathname
+
+def convert_splits(dataset, directory = "data/preprocessed", mapping_input = None, mapping_output = None):
+
+    '''
+    Convert the preprocessed splits of a dataset that exist in directory (see evaluate.load_split())
+
+    :param dataset: 'cmudict_singlechar', 'cmudict_multichar' or 'wikt2pron'
+    :param directory: directory with the preprocessed data. Defaults to 'data/preprocessed'
+    :param mapping_input: charmap object for the words (see write_dataset()). Defaults to None
+    :param mapping_output: charmap object for the pronunciations. Defaults to None
+    :return: list with the paths of the datasets
+    '''
+
+    out = []
+    for suffix in ["train", "dev", "test", "homophone_dev", "homophone_tst"]:
+
+        npy_pathname = os.path.join(directory, "{}_{}.npy".format(dataset, suffix))
+        if os.path.exists(npy_pathname):
+            out.append(convert_npy(npy_pathname, mapping_input = mapping_input, mapping_output = mapping_output))
+
+    return out
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Convert .npy pair files to packed datasets")
+    parser.add_argument("files", nargs = "+", help = ".npy files with (word, pronunciation) pairs")
+    parser.add_argument("--bundle", default = None, help = "store the integer representation against the charmaps of this model bundle")
+    args = parser.parse_args()
+
+    mappings = {}
+    if args.bundle is not None:
+        from phonorm.bundle import Bundle
+        bundle = Bundle(args.bundle)
+        mappings = {"mapping_input": bundle.mapping_input, "mapping_output": bundle.mapping_output}
+
+    for npy_pathname in args.files:
+        print(convert_npy(npy_pathname, **mappings))
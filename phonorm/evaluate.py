@@ -4,32 +4,61 @@
 ## TODO: write documentation for each function
 
 # Modules
-from nltk.translate.bleu_score import sentence_bleu
+from collections import Counter
 import matplotlib.pyplot as plt
 import numpy as np
+import multiprocessing
+import math
+import inspect
+import sys
+import os
 
-def decode_sequence(input_seq, encoder_model, decoder_model, mapping_input, mapping_output):
+from phonorm.utilities import PrefixSharing
+from phonorm.prepare import freeze
+from phonorm.dataset import PairDataset, open_pairs
+
+def target_sequence(tokens, n_chars, input_mode = "one_hot"):
+
+    '''
+    Create the decoder input for a single timestep
+
+    :param tokens: integer array of shape (N,) containing the previous output token of each row
+    :param n_chars: number of characters in the output charmap
+    :param input_mode: 'one_hot' or 'index' (see Seq2Seq)
+    :return: array of shape (N, 1, n_chars) for one-hot models or (N, 1) for index models
+    '''
+
+    if input_mode == "index":
+
+        return np.asarray(tokens, dtype = "int32").reshape(-1, 1)
+
+    target_seq = np.zeros((len(tokens), 1, n_chars))
+    target_seq[np.arange(len(tokens)), 0, tokens] = 1.
+
+    return target_seq
+
+def decode_sequence(input_seq, encoder_model, decoder_model, mapping_input, mapping_output, input_mode = "one_hot"):
 
     '''
     Take input as one-hot encoded vector and predict the output.
 
-    :param input_seq: one-hot encoded input word
+    :param input_seq: one-hot encoded input word (or index encoded if input_mode is 'index')
     :param encoder_model: trained model encoder (see 'inference' in seq2seq.py)
     :param decoder_model: trained model decoder
     :param mapping_input: hash tables from character --> integer and vice versa
     :param mapping_output: hash tables from character --> integer and vice versa
+    :param input_mode: 'one_hot' or 'index' (see Seq2Seq). Defaults to 'one_hot'
     :return: predicted pronunciation
 
     :adapted from: https://blog.keras.io/a-ten-minute-introduction-to-sequence-to-sequence-learning-in-keras.html
     '''
     
     # Encode the input as state vectors.
-    states_value = encoder_model.predict(input_seq)
+    states_value = encoder_model.predict(input_seq, verbose = 0)
 
-    # Generate empty target sequence of length 1.
-    target_seq = np.zeros((1, 1, mapping_output.n_chars))
+    # Generate target sequence of length 1.
     # Populate the first character of target sequence with the start character.
-    target_seq[0, 0, mapping_output.char2index['\t']] = 1.
+    target_seq = target_sequence([mapping_output.char2index['\t']], mapping_output.n_chars, input_mode)
 
     # Sampling loop for a batch of sequences
     # (to simplify, here we assume a batch of size 1).
@@ -37,7 +66,7 @@ def decode_sequence(input_seq, encoder_model, decoder_model, mapping_input, mapp
     decoded_sentence = ''
     while not stop_condition:
         output_tokens, h, c = decoder_model.predict(
-            [target_seq] + states_value)
+            [target_seq] + states_value, verbose = 0)
 
         # Sample a token
         sampled_token_index = np.argmax(output_tokens[0, -1, :])
@@ -51,14 +80,298 @@ def decode_sequence(input_seq, encoder_model, decoder_model, mapping_input, mapp
             stop_condition = True
 
         # Update the target sequence (of length 1).
-        target_seq = np.zeros((1, 1, mapping_output.n_chars))
-        target_seq[0, 0, sampled_token_index] = 1.
+        target_seq = target_sequence([sampled_token_index], mapping_output.n_chars, input_mode)
 
         # Update states
         states_value = [h, c]
 
     return decoded_sentence.strip("\n")
 
+def decode_sequence_batch(input_seq, encoder_model, decoder_model, mapping_input, mapping_output,
+                          input_mode = "one_hot", share_prefixes = False, stats = None, return_indices = False):
+
+    '''
+    Take a batch of one-hot encoded words and predict their outputs in lock-step.
+
+    Every row is decoded greedily exactly like decode_sequence(), but the decoder is stepped
+    over the whole batch at once. Rows that emitted the stop character (or exceeded the maximum
+    output length) are dropped from the batch so that later steps only run on unfinished rows.
+
+    :param input_seq: one-hot encoded input words of shape (N, max_length, n_chars)
+        (or index encoded words of shape (N, max_length) if input_mode is 'index')
+    :param encoder_model: trained model encoder (see 'inference' in seq2seq.py)
+    :param decoder_model: trained model decoder
+    :param mapping_input: hash tables from character --> integer and vice versa
+    :param mapping_output: hash tables from character --> integer and vice versa
+    :param input_mode: 'one_hot' or 'index' (see Seq2Seq). Defaults to 'one_hot'
+    :param share_prefixes: if True, rows that emitted the same prefix and reached the same decoder state are
+        only decoded once (see utilities.PrefixSharing). Defaults to False
+    :param stats: dictionary in which the prefix sharing counters are accumulated. Defaults to None
+    :param return_indices: if True, return the output token indices (without the stop token) instead of strings.
+        Defaults to False
+    :return: list of N predicted pronunciations
+    '''
+
+    n_rows = input_seq.shape[0]
+    n_chars = mapping_output.n_chars
+
+    # Encode the whole batch as state vectors.
+    states_value = encoder_model.predict(input_seq, batch_size = max(n_rows, 1), verbose = 0)
+
+    # Number of characters each token adds to the decoded string (phonemes can be > 1)
+    token_length = np.array([len(mapping_output.index2char[i]) for i in range(n_chars)])
+    stop_index = mapping_output.char2index['\n']
+
+    # Rows that are still being decoded, the last token of each row and the decoded lengths
+    active = np.arange(n_rows)
+    sampled = np.full(n_rows, mapping_output.char2index['\t'])
+    lengths = np.zeros(n_rows, dtype = "int64")
+    decoded = [[] for _ in range(n_rows)]
+    sharing = PrefixSharing(n_rows, stats = stats) if share_prefixes else None
+
+    while active.size > 0:
+
+        # Only decode one of the rows that will give the same output
+        if sharing is not None:
+
+            keep = sharing.merge(active, states_value[0], states_value[1])
+            active = active[keep]
+            sampled = sampled[keep]
+            states_value = [states_value[0][keep], states_value[1][keep]]
+
+        # Target sequence of length 1 for every unfinished row
+        target_seq = target_sequence(sampled, n_chars, input_mode)
+
+        output_tokens, h, c = decoder_model.predict(
+            [target_seq] + states_value, batch_size = active.size, verbose = 0)
+
+        # Sample a token for each row
+        sampled = np.argmax(output_tokens[:, -1, :], axis = -1)
+        for row, token in zip(active, sampled):
+            decoded[row].append(token)
+        lengths[active] += token_length[sampled]
+        if sharing is not None:
+            sharing.extend(active, sampled)
+
+        # Stop mask: either hit max length or find stop character.
+        keep = (sampled != stop_index) & (lengths[active] <= mapping_output.max_length)
+
+        # Drop finished rows
+        active = active[keep]
+        sampled = sampled[keep]
+        states_value = [h[keep], c[keep]]
+
+    if sharing is not None:
+        sharing.finish(decoded)
+
+    if return_indices:
+        return [[int(token) for token in tokens if token != stop_index] for tokens in decoded]
+
+    return [prediction.strip("\n") for prediction in freeze(mapping_output).decode(decoded)]
+
+def beam_search_decode(input_seq, encoder_model, decoder_model, mapping_output, beam_width = 3, n_best = 1,
+                       length_normalization = 0.0, input_mode = "one_hot"):
+
+    '''
+    Take a batch of one-hot encoded words and predict the n-best outputs using beam search.
+
+    All beams of all words are stepped through the decoder together as one (N * beam_width) batch.
+    Candidates are ranked by their log-probability divided by (number of tokens ** length_normalization).
+    A hypothesis is finished when it emits the stop character or exceeds mapping_output.max_length.
+    With beam_width = 1 this is the same as greedy decoding.
+
+    :param input_seq: one-hot encoded input words of shape (N, max_length, n_chars)
+        (or index encoded words of shape (N, max_length) if input_mode is 'index')
+    :param encoder_model: trained model encoder (see 'inference' in seq2seq.py)
+    :param decoder_model: trained model decoder
+    :param mapping_output: hash tables from character --> integer and vice versa
+    :param beam_width: number of hypotheses kept per word. Defaults to 3
+    :param n_best: number of hypotheses returned per word. Must be <= beam_width. Defaults to 1
+    :param length_normalization: exponent of the length penalty. 0 ranks by raw log-probability. Defaults to 0
+    :param input_mode: 'one_hot' or 'index' (see Seq2Seq). Defaults to 'one_hot'
+    :return: list of N lists with (pronunciation, log-probability) tuples, best first
+    '''
+
+    if n_best > beam_width:
+
+        raise ValueError("'n_best' cannot be larger than 'beam_width'")
+
+    n_rows = input_seq.shape[0]
+    n_chars = mapping_output.n_chars
+    stop_index = mapping_output.char2index['\n']
+    token_length = np.array([len(mapping_output.index2char[i]) for i in range(n_chars)])
+
+    # Encode the input and give every beam of a word the same initial state
+    state_h, state_c = encoder_model.predict(input_seq, batch_size = max(n_rows, 1), verbose = 0)
+    state_h = np.repeat(state_h[:, np.newaxis, :], beam_width, axis = 1)
+    state_c = np.repeat(state_c[:, np.newaxis, :], beam_width, axis = 1)
+
+    # Beam bookkeeping, all of shape (N, beam_width). Only the first beam is alive at the start.
+    log_probs = np.full((n_rows, beam_width), -np.inf)
+    log_probs[:, 0] = 0.
+    sampled = np.full((n_rows, beam_width), mapping_output.char2index['\t'])
+    n_tokens = np.zeros((n_rows, beam_width), dtype = "int64")
+    lengths = np.zeros((n_rows, beam_width), dtype = "int64")
+    finished = np.zeros((n_rows, beam_width), dtype = bool)
+    history = np.zeros((n_rows, beam_width, 0), dtype = "int64")
+
+    while True:
+
+        alive = ~finished & np.isfinite(log_probs)
+        if not alive.any():
+            break
+
+        # Step the decoder over all unfinished beams at once
+        rows, beams = np.nonzero(alive)
+        target_seq = target_sequence(sampled[rows, beams], n_chars, input_mode)
+
+        output_tokens, h, c = decoder_model.predict(
+            [target_seq, state_h[rows, beams], state_c[rows, beams]], batch_size = rows.size, verbose = 0)
+
+        state_h[rows, beams] = h
+        state_c[rows, beams] = c
+
+        # Candidate log-probabilities of shape (N, beam_width, n_chars).
+        # Finished beams are carried over unchanged as a single candidate on the stop character.
+        candidates = np.full((n_rows, beam_width, n_chars), -np.inf)
+        with np.errstate(divide = "ignore"):
+            candidates[rows, beams] = log_probs[rows, beams, np.newaxis] + np.log(output_tokens[:, -1, :])
+        done_rows, done_beams = np.nonzero(finished)
+        candidates[done_rows, done_beams, stop_index] = log_probs[done_rows, done_beams]
+
+        candidate_tokens = n_tokens[:, :, np.newaxis] + (~finished)[:, :, np.newaxis]
+        scores = candidates / np.maximum(candidate_tokens, 1) ** length_normalization
+
+        # Keep the beam_width best candidates per word
+        flat_scores = scores.reshape(n_rows, -1)
+        best = np.argsort(-flat_scores, axis = 1, kind = "stable")[:, :beam_width]
+        parent = best // n_chars
+        token = best % n_chars
+
+        # Reorder the beams according to their parents
+        was_finished = np.take_along_axis(finished, parent, axis = 1)
+        log_probs = np.take_along_axis(candidates.reshape(n_rows, -1), best, axis = 1)
+        n_tokens = np.take_along_axis(n_tokens, parent, axis = 1) + ~was_finished
+        lengths = np.take_along_axis(lengths, parent, axis = 1) + np.where(was_finished, 0, token_length[token])
+        state_h = np.take_along_axis(state_h, parent[:, :, np.newaxis], axis = 1)
+        state_c = np.take_along_axis(state_c, parent[:, :, np.newaxis], axis = 1)
+        history = np.take_along_axis(history, parent[:, :, np.newaxis], axis = 1)
+        history = np.concatenate([history, np.where(was_finished, -1, token)[:, :, np.newaxis]], axis = 2)
+        sampled = token
+
+        # Exit condition per beam: either hit max length or find stop character.
+        finished = was_finished | (token == stop_index) | (lengths > mapping_output.max_length)
+
+    # Final ranking
+    scores = log_probs / np.maximum(n_tokens, 1) ** length_normalization
+    order = np.argsort(-scores, axis = 1, kind = "stable")[:, :n_best]
+
+    decoded = []
+    for row in range(n_rows):
+
+        hypotheses = []
+        for beam in order[row]:
+
+            if not np.isfinite(log_probs[row, beam]):
+                continue
+
+            pronunciation = "".join(mapping_output.index2char[token] for token in history[row, beam] if token >= 0)
+            hypotheses.append((pronunciation.strip("\n"), float(log_probs[row, beam])))
+
+        decoded.append(hypotheses)
+
+    return decoded
+
+## Weights of the 1, 2, 3 and 4-gram BLEU scores reported by evaluate_bleu()
+BLEU_WEIGHTS = [(1, 0, 0, 0), (0.5, 0.5, 0, 0), (0.33, 0.33, 0.33, 0), (0.25, 0.25, 0.25, 0.25)]
+
+def reference_pronunciation(pronunciation):
+
+    '''
+    Convert a pronunciation from the preprocessed data to the format the model predicts
+
+    :param pronunciation: pronunciation with start ('\\t') and stop ('\\n') characters and (for phonemes) spaces
+    :return: pronunciation without start/stop characters and spaces
+    '''
+
+    return pronunciation.replace(" ", "").replace("\n", "").replace("\t", "")
+
+def bleu_scores(reference, prediction, weights = BLEU_WEIGHTS):
+
+    '''
+    Calculate the character BLEU score of a prediction for a number of n-gram weightings at once
+
+    The n-gram counts are computed once and shared by all weightings. The scores are the same as
+    nltk's sentence_bleu([list(reference)], list(prediction), weights) without smoothing.
+
+    :param reference: actual output
+    :param prediction: predicted output
+    :param weights: list of n-gram weight tuples. Defaults to BLEU_WEIGHTS
+    :return: list with a BLEU score for every weight tuple
+    '''
+
+    max_n = max(len(weight) for weight in weights)
+
+    ## Clipped n-gram matches and number of n-grams in the prediction
+    numerators = []
+    denominators = []
+    for n in range(1, max_n + 1):
+
+        counts = Counter(prediction[i:i + n] for i in range(len(prediction) - n + 1))
+        reference_counts = Counter(reference[i:i + n] for i in range(len(reference) - n + 1))
+
+        numerators.append(sum(min(count, reference_counts[ngram]) for ngram, count in counts.items()))
+        denominators.append(max(1, sum(counts.values())))
+
+    ## No matching characters at all
+    if numerators[0] == 0:
+        return [0.] * len(weights)
+
+    ## Brevity penalty
+    if len(prediction) > len(reference):
+        penalty = 1
+    else:
+        penalty = math.exp(1 - len(reference) / len(prediction))
+
+    ## Without smoothing, a precision of 0 is replaced by the smallest float
+    log_precisions = [math.log(numerator / denominator) if numerator != 0 else math.log(sys.float_info.min)
+                      for numerator, denominator in zip(numerators, denominators)]
+
+    return [penalty * math.exp(math.fsum(weight * log_precision for weight, log_precision in zip(weight, log_precisions)))
+            for weight in weights]
+
+def _bleu_chunk(args):
+
+    references, predictions, weights = args
+
+    return np.array([bleu_scores(reference, prediction, weights) for reference, prediction in zip(references, predictions)],
+                    dtype = "float64").reshape(len(references), len(weights))
+
+def bleu_batch(references, predictions, weights = BLEU_WEIGHTS, processes = 1, chunk_size = 5000):
+
+    '''
+    Calculate the BLEU scores of many predictions, optionally in a pool of processes
+
+    :param references: list of actual outputs
+    :param predictions: list of predicted outputs
+    :param weights: list of n-gram weight tuples. Defaults to BLEU_WEIGHTS
+    :param processes: number of processes. None uses one process per CPU. Defaults to 1 (no pool)
+    :param chunk_size: number of pairs per task. Defaults to 5000
+    :return: numpy array of shape (N, number of weight tuples)
+    '''
+
+    chunks = [(references[start:start + chunk_size], predictions[start:start + chunk_size], weights)
+              for start in range(0, len(references), chunk_size)]
+
+    if len(chunks) == 0:
+        return np.zeros((0, len(weights)))
+
+    if processes == 1 or len(chunks) == 1:
+        return np.concatenate([_bleu_chunk(chunk) for chunk in chunks])
+
+    with multiprocessing.Pool(processes) as pool:
+        return np.concatenate(pool.map(_bleu_chunk, chunks))
+
 def evaluate_bleu(reference, prediction):
 
     '''
@@ -69,21 +382,325 @@ def evaluate_bleu(reference, prediction):
     :return: numpy array containing 4 rows
     '''
     
-    ## Numpy array
-    out = np.zeros(
-        (4, 1),
-        dtype="float32"
-    )
-    
-    ## For each
-    out[0] = sentence_bleu([list(reference)], list(prediction), weights=(1, 0,0,0))
-    out[1] = sentence_bleu([list(reference)], list(prediction), weights=(0.5, 0.5,0,0))
-    out[2] = sentence_bleu([list(reference)], list(prediction), weights=(0.33, 0.33,0.33,0))
-    out[3] = sentence_bleu([list(reference)], list(prediction), weights=(0.25, 0.25,0.25,0.25))
-    
-    # Return
+    return np.array(bleu_scores(reference, prediction), dtype = "float32").reshape(4, 1)
+
+def load_split(dataset, split, directory = "data/preprocessed"):
+
+    '''
+    Load one of the preprocessed evaluation splits
+
+    :param dataset: 'cmudict_singlechar', 'cmudict_multichar' or 'wikt2pron'
+    :param split: 'dev', 'test', 'homophone_dev' or 'homophone_test'
+    :param directory: directory with the preprocessed data. Defaults to 'data/preprocessed'
+    :return: dataset.PairDataset if the split was converted to a packed dataset (see dataset.convert_splits()),
+        else numpy array of (word, pronunciation) pairs
+    '''
+
+    ## The preprocessing scripts call the homophone test split 'homophone_tst'
+    files = {"dev": "dev", "test": "test", "homophone_dev": "homophone_dev", "homophone_test": "homophone_tst"}
+
+    if split not in files:
+        raise ValueError("'split' must be one of {}".format(", ".join("'{}'".format(key) for key in files)))
+
+    pathname = "{}/{}_{}".format(directory, dataset, files[split])
+    if os.path.exists(pathname + ".pairs"):
+        return PairDataset(pathname + ".pairs")
+
+    return np.load(pathname + ".npy", allow_pickle = True)
+
+def pad_sequences(sequences):
+
+    '''
+    Pad a list of integer sequences
+
+    :param sequences: list of lists of integers (e.g. output token indices)
+    :return: tuple (int32 array of shape (N, longest sequence) padded with -1, int array with the lengths)
+    '''
+
+    lengths = np.array([len(sequence) for sequence in sequences], dtype = "int64")
+    out = np.full((len(sequences), max(lengths.max(initial = 0), 1)), -1, dtype = "int32")
+
+    for row, sequence in enumerate(sequences):
+        out[row, :len(sequence)] = sequence
+
+    return out, lengths
+
+def codepoints(strings):
+
+    '''
+    Convert a list of strings to a padded array of unicode code points
+
+    :param strings: list of strings
+    :return: tuple (uint32 array of shape (N, longest string) padded with 0, int array with the lengths)
+    '''
+
+    ## A fixed-width unicode array stores every character as 4 bytes, so it can be viewed as code points
+    array = np.array(list(strings), dtype = "U")
+    if array.dtype.itemsize == 0:
+        array = array.astype("U1")
+
+    width = array.dtype.itemsize // 4
+
+    return array.view("uint32").reshape(len(array), width), np.char.str_len(array).astype("int64")
+
+def levenshtein_batch(source, source_lengths, target, target_lengths, max_distance = None):
+
+    '''
+    Levenshtein distance between many pairs of padded sequences at once
+
+    The dynamic programming table is filled one source position at a time for all pairs together.
+    Deletions and substitutions are elementwise; the insertions of a row are resolved with a cumulative
+    minimum, since D[i, j] = min over k <= j of (D'[i, k] + j - k) = j + cummin(D'[i, k] - k).
+
+    :param source: integer array of shape (N, max source length)
+    :param source_lengths: integer array with the N source lengths
+    :param target: integer array of shape (N, max target length)
+    :param target_lengths: integer array with the N target lengths
+    :param max_distance: if given, distances larger than max_distance are returned as max_distance + 1, and a pair
+        is dropped as soon as every entry of its current row is larger than max_distance (the minimum of a row
+        never decreases). Defaults to None
+    :return: int array with the N edit distances
+    '''
+
+    source_lengths = np.asarray(source_lengths)
+    target_lengths = np.asarray(target_lengths)
+
+    ## Longest sources first, so that the pairs that are still being computed are always the first rows
+    order = np.argsort(-source_lengths, kind = "stable")
+    source, source_lengths = source[order], source_lengths[order]
+    target, target_lengths = target[order], target_lengths[order]
+
+    columns = np.arange(target.shape[1] + 1, dtype = "int32")
+    previous = np.tile(columns, (len(source), 1))
+
+    distances = np.where(source_lengths == 0, target_lengths, 0)
+
+    ## Position in `distances` of every row that is still being computed
+    positions = np.arange(len(source))
+
+    for i in range(1, int(source_lengths.max(initial = 0)) + 1):
+
+        active = int(np.count_nonzero(source_lengths >= i))
+        previous = previous[:active]
+
+        ## Deletions and substitutions
+        current = np.empty_like(previous)
+        current[:, 0] = i
+        current[:, 1:] = np.minimum(previous[:, 1:] + 1,
+                                    previous[:, :-1] + (source[:active, i - 1, np.newaxis] != target[:active]))
+
+        ## Insertions
+        current = np.minimum.accumulate(current - columns, axis = 1) + columns
+
+        done = np.flatnonzero(source_lengths[:active] == i)
+        distances[positions[done]] = current[done, target_lengths[done]]
+
+        if max_distance is not None:
+
+            keep = current.min(axis = 1) <= max_distance
+            if not keep.all():
+
+                distances[positions[:active][~keep]] = max_distance + 1
+                source, source_lengths, target, target_lengths, positions = [
+                    array[:active][keep] for array in [source, source_lengths, target, target_lengths, positions]]
+                current = current[keep]
+
+        previous = current
+
+    if max_distance is not None:
+        distances = np.minimum(distances, max_distance + 1)
+
+    out = np.empty_like(distances)
+    out[order] = distances
+
     return out
 
+def edit_distances(references, predictions):
+
+    '''
+    Levenshtein distances between references and predictions
+
+    :param references: list of strings, or list of lists of token indices
+    :param predictions: list of strings, or list of lists of token indices
+    :return: tuple (int array with the edit distances, int array with the reference lengths)
+    '''
+
+    encode = codepoints if len(references) > 0 and isinstance(references[0], str) else pad_sequences
+
+    source, source_lengths = encode(references)
+    target, target_lengths = encode(predictions)
+
+    return levenshtein_batch(source, source_lengths, target, target_lengths), source_lengths
+
+def pronunciation_indices(pronunciations, mapping):
+
+    '''
+    Split decoded pronunciations back into output token indices
+
+    Multi-character tokens are joined without a separator (e.g. 'ng' can be 'ng' or 'n' 'g'), so the split
+    with the fewest unknown characters and then the fewest tokens is used. Characters that are not part of
+    any token map to '<UNK>'.
+
+    :param pronunciations: list of pronunciations (e.g. returned by predict_batch())
+    :param mapping: output charmap of the model
+    :return: list of lists of token indices
+    '''
+
+    unknown = mapping.char2index["<UNK>"]
+    tokens = {char: index for char, index in mapping.char2index.items() if char not in ["<PAD>", "<UNK>", "\t", "\n"]}
+    longest = max([len(token) for token in tokens] + [1])
+
+    out = []
+    for pronunciation in pronunciations:
+
+        ## costs[i] is (unknown characters, tokens) of the best split of pronunciation[:i]
+        costs = [(0, 0)] + [None] * len(pronunciation)
+        previous = [None] * (len(pronunciation) + 1)
+
+        for start in range(len(pronunciation)):
+
+            for end in range(start + 1, min(start + longest, len(pronunciation)) + 1):
+
+                index = tokens.get(pronunciation[start:end])
+                if index is None and end > start + 1:
+                    continue
+
+                cost = (costs[start][0] + int(index is None), costs[start][1] + 1)
+                if costs[end] is None or cost < costs[end]:
+                    costs[end] = cost
+                    previous[end] = (start, unknown if index is None else index)
+
+        indices = []
+        end = len(pronunciation)
+        while end > 0:
+            end, index = previous[end]
+            indices.append(index)
+
+        out.append(indices[::-1])
+
+    return out
+
+def error_rate(distances, lengths):
+
+    '''
+    Corpus-level error rate: total number of edits divided by the total reference length
+
+    :param distances: int array with the edit distances (see edit_distances())
+    :param lengths: int array with the reference lengths
+    :return: error rate
+    '''
+
+    return float(np.sum(distances) / max(np.sum(lengths), 1))
+
+def homophone_agreement(references, predictions):
+
+    '''
+    Fraction of homophone groups (words with the same reference pronunciation) that get the same prediction
+
+    :param references: list of reference pronunciations
+    :param predictions: list of predicted pronunciations
+    :return: agreement or None if no reference pronunciation occurs more than once
+    '''
+
+    groups = {}
+    for reference, prediction in zip(references, predictions):
+        groups.setdefault(reference, set()).add(prediction)
+
+    sizes = Counter(references)
+    agree = [len(groups[reference]) == 1 for reference, size in sizes.items() if size > 1]
+
+    return float(np.mean(agree)) if len(agree) > 0 else None
+
+def evaluate_model(model, pairs, batch_size = 256, processes = 1, weights = BLEU_WEIGHTS, phonemes = None):
+
+    '''
+    Predict the pronunciations of a set of pairs in batches and score them
+
+    :param model: object with a predict_batch method (Seq2Seq, inference.NumpySeq2Seq or a wrapper)
+    :param pairs: list or array of (word, pronunciation) pairs, dataset.PairDataset or path (see load_split())
+    :param batch_size: number of words that are decoded together. Defaults to 256
+    :param processes: number of processes used to score the predictions (see bleu_batch()). Defaults to 1
+    :param weights: list of n-gram weight tuples. Defaults to BLEU_WEIGHTS
+    :param phonemes: if True, also compute the phoneme error rate. Models whose predict_batch takes return_indices
+        (Seq2Seq and inference.NumpySeq2Seq) are decoded to token indices, for other models (e.g. cache.CachedModel
+        or lexicon.LexiconModel) the predictions are split with pronunciation_indices(). Defaults to
+        model.mapping_output.split
+    :return: dictionary with the averages ('n', 'bleu_1', ..., 'bleu_4', 'word_accuracy', 'cer', 'per' and
+        'homophone_agreement') and the per-item arrays ('words', 'references', 'predictions', 'bleu' of shape
+        (N, number of weight tuples), 'correct', 'char_distances' and 'phoneme_distances')
+    '''
+
+    mapping_output = model.mapping_output
+    if phonemes is None:
+        phonemes = mapping_output.split
+
+    pairs = open_pairs(pairs)
+    if isinstance(pairs, PairDataset):
+        words, pronunciations = pairs.words(), pairs.pronunciations()
+    else:
+        words, pronunciations = [str(pair[0]) for pair in pairs], [str(pair[1]) for pair in pairs]
+
+    references = [reference_pronunciation(pronunciation) for pronunciation in pronunciations]
+
+    if phonemes and "return_indices" in inspect.signature(model.predict_batch).parameters:
+
+        indices = model.predict_batch(words, batch_size = batch_size, return_indices = True)
+        predictions = freeze(mapping_output).decode(indices)
+
+    else:
+
+        predictions = model.predict_batch(words, batch_size = batch_size)
+        if phonemes:
+            indices = pronunciation_indices(predictions, mapping_output)
+
+    bleu = bleu_batch(references, predictions, weights = weights, processes = processes)
+    correct = np.array([reference == prediction for reference, prediction in zip(references, predictions)], dtype = bool)
+    char_distances, char_lengths = edit_distances(references, predictions)
+
+    results = {"n": len(words)}
+    for i in range(len(weights)):
+        results["bleu_{}".format(i + 1)] = float(bleu[:, i].mean()) if len(words) > 0 else 0.
+
+    results["word_accuracy"] = float(correct.mean()) if len(words) > 0 else 0.
+    results["cer"] = error_rate(char_distances, char_lengths)
+
+    if phonemes:
+
+        unknown = mapping_output.char2index["<UNK>"]
+        reference_indices = [[mapping_output.char2index.get(phoneme, unknown) for phoneme in pronunciation.split()]
+                             for pronunciation in pronunciations]
+        phoneme_distances, phoneme_lengths = edit_distances(reference_indices, indices)
+        results["per"] = error_rate(phoneme_distances, phoneme_lengths)
+
+    results["homophone_agreement"] = homophone_agreement(references, predictions)
+
+    results["words"] = np.array(words)
+    results["references"] = np.array(references)
+    results["predictions"] = np.array(predictions)
+    results["bleu"] = bleu
+    results["correct"] = correct
+    results["char_distances"] = char_distances
+    if phonemes:
+        results["phoneme_distances"] = phoneme_distances
+
+    return results
+
+def evaluate_splits(model, dataset, splits = ("dev", "test", "homophone_dev", "homophone_test"),
+                    directory = "data/preprocessed", **kwargs):
+
+    '''
+    Evaluate a model on a number of preprocessed splits (see load_split() and evaluate_model())
+
+    :param model: object with a predict_batch method
+    :param dataset: 'cmudict_singlechar', 'cmudict_multichar' or 'wikt2pron'
+    :param splits: names of the splits. Defaults to the dev, test and homophone dev/test splits
+    :param directory: directory with the preprocessed data. Defaults to 'data/preprocessed'
+    :param kwargs: passed on to evaluate_model()
+    :return: dictionary split --> results of evaluate_model()
+    '''
+
+    return {split: evaluate_model(model, load_split(dataset, split, directory = directory), **kwargs) for split in splits}
+
 ## Plot bleu score function
 def plot_bleu(data):
 
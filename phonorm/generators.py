@@ -0,0 +1,127 @@
+## Data generators that encode mini-batches on the fly
+
+from keras.utils import Sequence
+import numpy as np
+import math
+
+from phonorm.utilities import one_hot_encode, index_encode, sequence_lengths, length_buckets
+from phonorm.dataset import PairDataset
+from phonorm.prepare import freeze
+
+class PairSequence(Sequence):
+
+    '''
+    Keras Sequence that yields encoded mini-batches from raw (word, pronunciation) pairs
+
+    Only the current batch is one-hot (or index) encoded, so peak memory is bounded by the
+    batch size instead of the size of the corpus. Because a Sequence is indexed by batch,
+    it can safely be prefetched by multiple workers (see Seq2Seq.fit_generator()).
+
+    With bucketing, pairs of similar input length are batched together and each batch is only
+    padded to its longest word and pronunciation instead of mapping.max_length. The encoder of the
+    model must skip the padding (see Seq2Seq mask_padding).
+
+    The pairs can also be a dataset.PairDataset, in which case the batches are encoded by PairDataset.encode()
+    from the stored integer representation where possible.
+    '''
+
+    def __init__(self, pairs, mapping_input, mapping_output, batch_size = 64, shuffle = True,
+                 input_mode = "one_hot", seed = None, bucketing = False, bucket_pool = 100):
+
+        '''
+        :param pairs: list or array of (word, pronunciation) pairs or dataset.PairDataset
+        :param mapping_input: charmap object for the input words
+        :param mapping_output: charmap object for the output words. mapping_output.split is used for the outputs
+        :param batch_size: number of pairs per batch. Defaults to 64
+        :param shuffle: if True, the pairs are shuffled at the start of every epoch. Defaults to True
+        :param input_mode: 'one_hot' or 'index' (see Seq2Seq). Defaults to 'one_hot'
+        :param seed: seed for the shuffling. Defaults to None
+        :param bucketing: if True, group pairs of similar length into the same batch. Defaults to False
+        :param bucket_pool: pairs are sorted by length within pools of bucket_pool batches, so that the
+            batches still differ between epochs. Defaults to 100
+        '''
+
+        self.pairs = pairs
+        ## Freeze the mappings once instead of building their lookup tables for every batch
+        self.mapping_input = freeze(mapping_input)
+        self.mapping_output = freeze(mapping_output)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.input_mode = input_mode
+        self.bucketing = bucketing
+        self.bucket_pool = bucket_pool
+
+        if bucketing and isinstance(pairs, PairDataset):
+            self.lengths = pairs.lengths("word")
+        elif bucketing:
+            self.lengths = sequence_lengths([pair[0] for pair in pairs])
+
+        self.random_state = np.random.RandomState(seed)
+        self.order = np.arange(len(pairs))
+        self.on_epoch_end()
+
+    def __len__(self):
+
+        return int(math.ceil(len(self.pairs) / self.batch_size))
+
+    def __getitem__(self, idx):
+
+        '''
+        Encode a single batch
+
+        :param idx: batch number
+        :return: tuple ([encoder inputs, decoder inputs], decoder targets)
+        '''
+
+        if isinstance(self.pairs, PairDataset):
+            return self.pairs.encode(self.mapping_input, self.mapping_output, rows = self.batches[idx],
+                                     input_mode = self.input_mode, bucketing = self.bucketing)
+
+        batch = [self.pairs[i] for i in self.batches[idx]]
+        words = [pair[0] for pair in batch]
+        pronunciations = [pair[1] for pair in batch]
+
+        split = self.mapping_output.split
+
+        ## Pad to the longest entry of the batch or to the max length of the mappings
+        input_length, output_length = None, None
+        if self.bucketing:
+            input_length = int(sequence_lengths(words).max())
+            output_length = int(sequence_lengths(pronunciations, split = split).max())
+
+        encode = index_encode if self.input_mode == "index" else one_hot_encode
+
+        encoder_in = encode(words, self.mapping_input, max_length = input_length)
+        decoder_in = encode(pronunciations, self.mapping_output, split = split, max_length = output_length)
+        decoder_target = encode(pronunciations, self.mapping_output, one_timestep_ahead = True, split = split,
+                                max_length = output_length)
+
+        ## Integer targets need a trailing axis of length 1
+        if self.input_mode == "index":
+            decoder_target = decoder_target[:, :, np.newaxis]
+
+        return ([encoder_in, decoder_in], decoder_target)
+
+    def on_epoch_end(self):
+
+        '''Shuffle the pairs and create the batches for the next epoch'''
+
+        if self.shuffle:
+            self.random_state.shuffle(self.order)
+
+        if not self.bucketing:
+
+            self.batches = [self.order[start:start + self.batch_size] for start in range(0, len(self.order), self.batch_size)]
+            return
+
+        ## Sort by length within each pool
+        pool = self.batch_size * self.bucket_pool
+        self.batches = []
+        for start in range(0, len(self.order), pool):
+
+            chunk = self.order[start:start + pool]
+            self.batches += [chunk[batch] for batch in length_buckets(self.lengths[chunk], self.batch_size)]
+
+        ## Otherwise the batches would go from short to long words within every pool
+        if self.shuffle:
+            self.random_state.shuffle(self.batches)
@@ -0,0 +1,392 @@
+## Pure NumPy implementation of the forward pass of the Seq2Seq model
+##  This module must not import keras or tensorflow so that it can be used to serve trained models.
+
+import numpy as np
+
+from phonorm.prepare import FrozenCharmap
+from phonorm.cache import model_fingerprint
+from phonorm.utilities import sequence_lengths, length_buckets, PrefixSharing
+
+## Activation functions used by the Keras LSTM layers
+ACTIVATIONS = {
+    "tanh": np.tanh,
+    "sigmoid": lambda x: 1. / (1. + np.exp(-x)),
+    "hard_sigmoid": lambda x: np.clip(0.2 * x + 0.5, 0., 1.),
+    "relu": lambda x: np.maximum(x, 0.),
+    "linear": lambda x: x
+}
+
+def model_weights(model):
+
+    '''
+    Pull the weights and the layer settings that are needed for inference out of a trained Seq2Seq model
+
+    :param model: trained (or loaded) Seq2Seq object
+    :return: tuple (arrays, config). arrays is a dictionary with the weights of the encoder, decoder and softmax
+        layers, config a dictionary with the (recurrent) activation and dropout of the LSTM layers. Whether the
+        encoder skips padding is model.mask_padding
+    '''
+
+    ## Find the layers by type. The layer indices differ between model variants.
+    layers = {layer.__class__.__name__: layer for layer in model.model.layers}
+    encoder = layers["Bidirectional"]
+    decoder = layers["LSTM"]
+    dense = layers["Dense"]
+
+    arrays = {}
+    config = {}
+    for prefix, lstm in [("encoder_forward", encoder.forward_layer),
+                         ("encoder_backward", encoder.backward_layer),
+                         ("decoder", decoder)]:
+
+        kernel, recurrent_kernel, bias = lstm.get_weights()
+        layer_config = lstm.get_config()
+
+        arrays[prefix + "_kernel"] = kernel
+        arrays[prefix + "_recurrent_kernel"] = recurrent_kernel
+        arrays[prefix + "_bias"] = bias
+
+        config[prefix] = {key: layer_config[key] for key in ["units", "activation", "recurrent_activation",
+                                                             "dropout", "recurrent_dropout"]}
+
+    arrays["dense_kernel"], arrays["dense_bias"] = dense.get_weights()
+
+    return arrays, config
+
+def export_npz(model, pathname = "models/model.npz"):
+
+    '''
+    Pull the weights and character mappings out of a trained Seq2Seq model and store them in a .npz file
+
+    :param model: trained (or loaded) Seq2Seq object
+    :param pathname: path to store the weights. Defaults to 'models/model.npz'
+    '''
+
+    arrays, config = model_weights(model)
+
+    for prefix in ["encoder_forward", "encoder_backward", "decoder"]:
+
+        arrays[prefix + "_activation"] = np.array(config[prefix]["activation"])
+        arrays[prefix + "_recurrent_activation"] = np.array(config[prefix]["recurrent_activation"])
+
+    ## Store the mappings as plain arrays so that they can be loaded without unpickling
+    for prefix, mapping in [("input", model.mapping_input), ("output", model.mapping_output)]:
+
+        arrays[prefix + "_name"] = np.array(mapping.name)
+        arrays[prefix + "_chars"] = np.array([mapping.index2char[i] for i in range(mapping.n_chars)])
+        arrays[prefix + "_max_length"] = np.array(mapping.max_length)
+        arrays[prefix + "_split"] = np.array(mapping.split)
+
+    arrays["mask_padding"] = np.array(model.mask_padding)
+
+    np.savez(pathname, **arrays)
+
+def load_npz(pathname = "models/model.npz"):
+
+    '''
+    Load a model exported with export_npz()
+
+    :param pathname: path where the weights are stored
+    :return: NumpySeq2Seq object
+    '''
+
+    with np.load(pathname, allow_pickle = False) as data:
+        arrays = {key: data[key] for key in data.files}
+
+    ## Rebuild the character mappings
+    mappings = []
+    for prefix in ["input", "output"]:
+
+        name, split = str(arrays.pop(prefix + "_name")), bool(arrays.pop(prefix + "_split"))
+        chars = [str(char) for char in arrays.pop(prefix + "_chars")]
+        mappings.append(FrozenCharmap(name, chars, split = split, max_length = int(arrays.pop(prefix + "_max_length"))))
+
+    ## Files exported before masking existed have no mask_padding entry
+    mask_padding = bool(arrays.pop("mask_padding", False))
+
+    return NumpySeq2Seq(arrays, mappings[0], mappings[1], mask_padding = mask_padding)
+
+class LSTMWeights:
+
+    '''
+    Weights of a single Keras LSTM layer
+
+    The gates are stored in the Keras order: input, forget, cell, output.
+    '''
+
+    def __init__(self, kernel, recurrent_kernel, bias, activation = "tanh", recurrent_activation = "hard_sigmoid"):
+
+        '''
+        :param kernel: input weights of shape (n_inputs, 4 * units)
+        :param recurrent_kernel: recurrent weights of shape (units, 4 * units)
+        :param bias: bias of shape (4 * units,)
+        :param activation: name of the cell/output activation
+        :param recurrent_activation: name of the gate activation
+        '''
+
+        ## Append an all-zero row so that padding (index == n_inputs) maps onto a zero input
+        self.kernel = np.vstack([kernel, np.zeros((1, kernel.shape[1]), dtype = kernel.dtype)])
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = bias
+        self.units = recurrent_kernel.shape[0]
+        self.activation = ACTIVATIONS[activation]
+        self.recurrent_activation = ACTIVATIONS[recurrent_activation]
+
+    def step(self, projected, h, c):
+
+        '''
+        Run a single timestep
+
+        :param projected: input projection (kernel row + bias) of shape (N, 4 * units)
+        :param h: hidden state of shape (N, units)
+        :param c: memory cell of shape (N, units)
+        :return: tuple (h, c) with the new states
+        '''
+
+        z = projected + h @ self.recurrent_kernel
+        u = self.units
+
+        i = self.recurrent_activation(z[:, :u])
+        f = self.recurrent_activation(z[:, u:2 * u])
+        g = self.activation(z[:, 2 * u:3 * u])
+        o = self.recurrent_activation(z[:, 3 * u:])
+
+        c = f * c + i * g
+        h = o * self.activation(c)
+
+        return h, c
+
+    def run(self, indices, reverse = False, mask = False):
+
+        '''
+        Run the LSTM over a batch of index sequences starting from zero states
+
+        :param indices: integer array of shape (N, T). Padding is encoded as n_inputs
+        :param reverse: if True, process the sequence from the last to the first timestep
+        :param mask: if True, padded timesteps keep the states (like a keras LSTM after a Masking layer)
+        :return: tuple (h, c) with the final states
+        '''
+
+        ## Multiplying a one-hot vector with the kernel is the same as selecting a row
+        projected = self.kernel[indices] + self.bias
+
+        h = np.zeros((indices.shape[0], self.units), dtype = self.recurrent_kernel.dtype)
+        c = np.zeros_like(h)
+
+        padded = indices == self.kernel.shape[0] - 1
+
+        timesteps = range(indices.shape[1] - 1, -1, -1) if reverse else range(indices.shape[1])
+        for t in timesteps:
+
+            h_new, c_new = self.step(projected[:, t], h, c)
+
+            if mask:
+                keep = padded[:, t, np.newaxis]
+                h, c = np.where(keep, h, h_new), np.where(keep, c, c_new)
+            else:
+                h, c = h_new, c_new
+
+        return h, c
+
+class NumpySeq2Seq:
+
+    '''
+    Inference-only version of the Seq2Seq model that runs in NumPy
+
+    The encoder, decoder and softmax layer use the weights exported from a trained Seq2Seq model
+    (see export_npz()) and give the same outputs as the Keras inference models.
+    '''
+
+    def __init__(self, weights, mapping_input, mapping_output, mask_padding = False):
+
+        '''
+        :param weights: dictionary with the arrays written by export_npz()
+        :param mapping_input: charmap object containing mapping and inverse mapping for the input words
+        :param mapping_output: charmap object containing mapping and inverse mapping for the output words
+        :param mask_padding: if True, the encoder skips padded timesteps (see Seq2Seq). Defaults to False
+        '''
+
+        self.mapping_input = mapping_input
+        self.mapping_output = mapping_output
+        self.weights = weights
+        self.mask_padding = mask_padding
+
+        self.encoder_forward = self._lstm(weights, "encoder_forward")
+        self.encoder_backward = self._lstm(weights, "encoder_backward")
+        self.decoder = self._lstm(weights, "decoder")
+
+        self.dense_kernel = weights["dense_kernel"]
+        self.dense_bias = weights["dense_bias"]
+
+        self.hidden_dim = self.encoder_forward.units
+
+        ## Counters of the prefix sharing decode (see predict_batch())
+        self.decode_stats = {}
+
+    @staticmethod
+    def _lstm(weights, prefix):
+
+        return LSTMWeights(weights[prefix + "_kernel"], weights[prefix + "_recurrent_kernel"], weights[prefix + "_bias"],
+                           activation = str(weights[prefix + "_activation"]),
+                           recurrent_activation = str(weights[prefix + "_recurrent_activation"]))
+
+    def fingerprint(self):
+
+        '''
+        Fingerprint of the weights and mappings (see cache.model_fingerprint())
+
+        :return: hexadecimal sha1 digest
+        '''
+
+        return model_fingerprint([self.weights[key] for key in sorted(self.weights)], self.mapping_input, self.mapping_output,
+                                 extra = "mask_padding" if self.mask_padding else "")
+
+    def encode_indices(self, words, max_length = None):
+
+        '''
+        Map words to padded index arrays. Padding is encoded as n_chars.
+
+        :param words: list of words of length N
+        :param max_length: pad to this length instead of mapping_input.max_length
+        :return: integer array of shape (N, max_length)
+        '''
+
+        if max_length is None:
+            max_length = self.mapping_input.max_length
+
+        char2index = self.mapping_input.char2index
+        out = np.full((len(words), max_length), self.mapping_input.n_chars, dtype = "int64")
+
+        for row, word in enumerate(words):
+            out[row, :len(word)] = [char2index[char] for char in word]
+
+        return out
+
+    def encode(self, words, max_length = None):
+
+        '''
+        Run the bidirectional encoder
+
+        :param words: list of words of length N
+        :param max_length: pad to this length instead of mapping_input.max_length
+        :return: tuple (state_hidden, state_memcell), each of shape (N, 2 * hidden_dim)
+        '''
+
+        indices = self.encode_indices(words, max_length = max_length)
+
+        forward_hidden, forward_memcell = self.encoder_forward.run(indices, mask = self.mask_padding)
+        backward_hidden, backward_memcell = self.encoder_backward.run(indices, reverse = True, mask = self.mask_padding)
+
+        return (np.concatenate([forward_hidden, backward_hidden], axis = 1),
+                np.concatenate([forward_memcell, backward_memcell], axis = 1))
+
+    def decoder_step(self, tokens, h, c):
+
+        '''
+        Feed one token per row to the decoder
+
+        :param tokens: integer array of shape (N,) with the previous output tokens
+        :param h: decoder hidden state of shape (N, 2 * hidden_dim)
+        :param c: decoder memory cell of shape (N, 2 * hidden_dim)
+        :return: tuple (probabilities, h, c) where probabilities has shape (N, n_chars)
+        '''
+
+        h, c = self.decoder.step(self.decoder.kernel[tokens] + self.decoder.bias, h, c)
+
+        ## Softmax
+        logits = h @ self.dense_kernel + self.dense_bias
+        logits -= logits.max(axis = 1, keepdims = True)
+        probabilities = np.exp(logits)
+        probabilities /= probabilities.sum(axis = 1, keepdims = True)
+
+        return probabilities, h, c
+
+    def predict_batch(self, words, batch_size = 256, bucketing = False, share_prefixes = False, return_indices = False):
+
+        '''
+        Predict the pronunciation of a list of input words
+
+        :param words: list of words to predict
+        :param batch_size: number of words that are decoded together. Defaults to 256
+        :param bucketing: if True, group words by length and pad to the bucket maximum (see Seq2Seq.predict_batch()).
+            Requires mask_padding. Defaults to False
+        :param share_prefixes: if True, rows with the same emitted prefix and decoder state are decoded once
+            (see utilities.PrefixSharing). The counters are accumulated in self.decode_stats. Defaults to False
+        :param return_indices: if True, return lists of output token indices (without the stop token) instead
+            of strings. Defaults to False
+        :return: list of pronunciations in the same order as the input words
+        '''
+
+        if bucketing and not self.mask_padding:
+
+            raise ValueError("'bucketing' requires a model with 'mask_padding' = True")
+
+        mapping_output = self.mapping_output
+        n_chars = mapping_output.n_chars
+        token_length = np.array([len(mapping_output.index2char[i]) for i in range(n_chars)])
+        stop_index = mapping_output.char2index['\n']
+
+        ## Batches of word positions
+        if bucketing:
+            batches = length_buckets(sequence_lengths(words), batch_size)
+        else:
+            batches = [np.arange(start, min(start + batch_size, len(words))) for start in range(0, len(words), batch_size)]
+
+        predictions = [None] * len(words)
+        for positions in batches:
+
+            batch = [words[i] for i in positions]
+            h, c = self.encode(batch, max_length = max([1] + [len(word) for word in batch]) if bucketing else None)
+
+            ## Same sampling loop as phonorm.evaluate.decode_sequence_batch()
+            active = np.arange(len(batch))
+            sampled = np.full(len(batch), mapping_output.char2index['\t'])
+            lengths = np.zeros(len(batch), dtype = "int64")
+            decoded = [[] for _ in range(len(batch))]
+            sharing = PrefixSharing(len(batch), stats = self.decode_stats) if share_prefixes else None
+
+            while active.size > 0:
+
+                if sharing is not None:
+
+                    keep = sharing.merge(active, h, c)
+                    active, sampled, h, c = active[keep], sampled[keep], h[keep], c[keep]
+
+                probabilities, h, c = self.decoder_step(sampled, h, c)
+
+                sampled = np.argmax(probabilities, axis = 1)
+                for row, token in zip(active, sampled):
+                    decoded[row].append(token)
+                lengths[active] += token_length[sampled]
+                if sharing is not None:
+                    sharing.extend(active, sampled)
+
+                keep = (sampled != stop_index) & (lengths[active] <= mapping_output.max_length)
+
+                active = active[keep]
+                sampled = sampled[keep]
+                h, c = h[keep], c[keep]
+
+            if sharing is not None:
+                sharing.finish(decoded)
+
+            ## Restore the original order
+            for i, tokens in zip(positions, decoded):
+
+                if return_indices:
+                    predictions[i] = [int(token) for token in tokens if token != stop_index]
+                else:
+                    predictions[i] = "".join(mapping_output.index2char[token] for token in tokens).strip("\n")
+
+        return predictions
+
+    def predict(self, word):
+
+        '''
+        Predict the pronunciation of an input word
+
+        :param word: word to predict
+        :return: pronunciation of input word
+        '''
+
+        return self.predict_batch([word])[0]
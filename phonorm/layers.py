@@ -0,0 +1,65 @@
+## Custom Keras layers and losses used by the index (integer) input variant of the Seq2Seq model
+
+from keras import backend as K
+from keras.layers import Layer
+
+class OneHot(Layer):
+
+    '''
+    One-hot encode integer index sequences inside the graph
+
+    Padding (index 0, '<PAD>') is encoded as an all-zero vector, which is the same representation
+    that phonorm.utilities.one_hot_encode() produces. A model that uses this layer therefore has
+    the same weights as the one-hot variant, but only needs (N, max_length) integer arrays as input.
+    '''
+
+    def __init__(self, n_chars, **kwargs):
+
+        '''
+        :param n_chars: number of characters in the charmap
+        '''
+
+        super(OneHot, self).__init__(**kwargs)
+        self.n_chars = n_chars
+
+    def call(self, inputs):
+
+        inputs = K.cast(inputs, "int32")
+        mask = K.cast(K.not_equal(inputs, 0), K.floatx())
+
+        return K.one_hot(inputs, self.n_chars) * K.expand_dims(mask, -1)
+
+    def compute_output_shape(self, input_shape):
+
+        return tuple(input_shape) + (self.n_chars,)
+
+    def get_config(self):
+
+        config = {"n_chars": self.n_chars}
+        base_config = super(OneHot, self).get_config()
+
+        return dict(list(base_config.items()) + list(config.items()))
+
+def masked_sparse_categorical_crossentropy(y_true, y_pred):
+
+    '''
+    Sparse categorical crossentropy that ignores padded timesteps
+
+    The one-hot targets of the dense model are all-zero at padded timesteps, so they do not add
+    to the categorical crossentropy. This loss gives the same result for integer targets of shape
+    (N, max_length, 1) where padding is encoded as 0.
+
+    :param y_true: integer targets of shape (N, max_length, 1)
+    :param y_pred: softmax outputs of shape (N, max_length, n_chars)
+    :return: loss per timestep of shape (N, max_length)
+    '''
+
+    mask = K.cast(K.greater(K.max(y_true, axis = -1), 0), K.floatx())
+
+    return K.sparse_categorical_crossentropy(y_true, y_pred) * mask
+
+## Needed by keras.models.load_model()
+custom_objects = {
+    "OneHot": OneHot,
+    "masked_sparse_categorical_crossentropy": masked_sparse_categorical_crossentropy
+}
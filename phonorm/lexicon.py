@@ -0,0 +1,317 @@
+## Dictionary-first lookup of pronunciations
+##  Words that appear in cmudict or in the preprocessed wiktionary pairs do not need to go through the model.
+
+from collections import OrderedDict
+import argparse
+import re
+import threading
+import numpy as np
+
+
+def read_cmudict(pathname = "data/raw/cmudict/cmudict_SPHINX_40.txt", skip_head = 64, skip_tail = 5):
+
+    '''
+    Read the cmudict file the same way preprocessing/preprocess_cmudict_data.py does
+
+    Punctuation entries at the start and end of the file are skipped, as are alternative pronunciations
+    (entries such as 'a(2)' that contain numbers). Words and phonemes are lowercased.
+
+    :param pathname: path to the cmudict file
+    :param skip_head: number of punctuation entries at the start of the file. Defaults to 64
+    :param skip_tail: number of punctuation entries at the end of the file. Defaults to 5
+    :return: list of (word, pronunciation) pairs. Phonemes are separated by spaces
+    '''
+
+    with open(pathname) as lines:
+        data = [line.replace("\n", "").split("\t") for line in lines]
+
+    data = data[skip_head:len(data) - skip_tail]
+
+    ## Remove entries with numbers in them
+    nums = re.compile('[0-9]')
+
+    return [(line[0].lower(), line[1].lower()) for line in data if nums.search(line[0]) is None]
+
+def model_pronunciation(pronunciation, join_phonemes = False):
+
+    '''
+    Convert a pronunciation from the data to the format the model predicts
+
+    :param pronunciation: pronunciation, possibly surrounded by the start ('\\t') and stop ('\\n') characters
+    :param join_phonemes: if True, remove the spaces between phonemes (cmudict models predict e.g. 'hhahlow')
+    :return: pronunciation as returned by Seq2Seq.predict()
+    '''
+
+    if join_phonemes:
+
+        return "".join(pronunciation.split())
+
+    return pronunciation.strip("\t").strip("\n")
+
+class Lexicon:
+
+    '''
+    Compact, sorted word --> pronunciation index
+
+    Sources are added in order of priority: if a word is in multiple sources, the pronunciation of
+    the source that was added first is used. The index is stored as sorted numpy arrays, so lookups
+    of a whole batch of words are a single np.searchsorted() call.
+    '''
+
+    def __init__(self):
+
+        self.sources = []
+        self._entries = OrderedDict()
+
+        self.words = np.array([], dtype = str)
+        self.pronunciations = np.array([], dtype = str)
+        self.source_ids = np.array([], dtype = "int16")
+
+    def __len__(self):
+
+        return len(self.words)
+
+    def add_pairs(self, pairs, source, join_phonemes = False):
+
+        '''
+        Add (word, pronunciation) pairs
+
+        :param pairs: list or array of (word, pronunciation) pairs
+        :param source: name of the source (e.g. 'cmudict')
+        :param join_phonemes: see model_pronunciation()
+        '''
+
+        if source not in self.sources:
+            self.sources.append(source)
+
+        source_id = self.sources.index(source)
+
+        ## A loaded lexicon only creates the dictionary when it is extended
+        if self._entries is None:
+            self._entries = OrderedDict((str(word), (str(pronunciation), int(source_id)))
+                                        for word, pronunciation, source_id in zip(self.words, self.pronunciations, self.source_ids))
+
+        for word, pronunciation in pairs:
+
+            word = str(word).lower()
+            if word not in self._entries:
+                self._entries[word] = (model_pronunciation(str(pronunciation), join_phonemes = join_phonemes), source_id)
+
+        self._build()
+
+    def add_cmudict(self, pathname = "data/raw/cmudict/cmudict_SPHINX_40.txt", source = "cmudict"):
+
+        '''
+        Add the cmudict pronunciations (see read_cmudict())
+
+        :param pathname: path to the cmudict file
+        :param source: name of the source. Defaults to 'cmudict'
+        '''
+
+        self.add_pairs(read_cmudict(pathname), source, join_phonemes = True)
+
+    def add_npy(self, pathname, source = None, join_phonemes = False):
+
+        '''
+        Add preprocessed pairs stored as .npy file (e.g. data/preprocessed/wikt2pron_dev.npy)
+
+        :param pathname: path to the .npy file
+        :param source: name of the source. Defaults to the file name
+        :param join_phonemes: see model_pronunciation()
+        '''
+
+        if source is None:
+            source = pathname.split("/")[-1].replace(".npy", "")
+
+        self.add_pairs(np.load(pathname), source, join_phonemes = join_phonemes)
+
+    def _build(self):
+
+        '''Create the sorted arrays'''
+
+        words = np.array(list(self._entries), dtype = str)
+        order = np.argsort(words)
+
+        self.words = words[order]
+        self.pronunciations = np.array([entry[0] for entry in self._entries.values()], dtype = str)[order]
+        self.source_ids = np.array([entry[1] for entry in self._entries.values()], dtype = "int16")[order]
+
+    def lookup(self, words):
+
+        '''
+        Look up a batch of words
+
+        :param words: list of words
+        :return: tuple (pronunciations, source_ids). pronunciations is a list that contains None for words
+            that are not in the lexicon, source_ids a numpy array with -1 for those words
+        '''
+
+        if len(self.words) == 0:
+
+            return [None] * len(words), np.full(len(words), -1, dtype = "int16")
+
+        queries = np.array([str(word) for word in words], dtype = str)
+
+        position = np.minimum(np.searchsorted(self.words, queries), len(self.words) - 1)
+        found = self.words[position] == queries
+
+        pronunciations = [str(self.pronunciations[i]) if hit else None for i, hit in zip(position, found)]
+        source_ids = np.where(found, self.source_ids[position], -1)
+
+        return pronunciations, source_ids
+
+    def get(self, word):
+
+        '''
+        Look up a single word
+
+        :param word: word to look up
+        :return: pronunciation or None if the word is not in the lexicon
+        '''
+
+        return self.lookup([word])[0][0]
+
+    def save(self, pathname = "models/lexicon.npz"):
+
+        '''
+        Save the lexicon as uncompressed .npz file
+
+        :param pathname: path to store the lexicon. Defaults to 'models/lexicon.npz'
+        '''
+
+        np.savez(pathname, words = self.words, pronunciations = self.pronunciations,
+                 source_ids = self.source_ids, sources = np.array(self.sources))
+
+    def load(self, pathname = "models/lexicon.npz"):
+
+        '''
+        Load a lexicon saved with save()
+
+        :param pathname: path where the lexicon is stored
+        '''
+
+        with np.load(pathname, allow_pickle = False) as data:
+
+            self.words = data["words"]
+            self.pronunciations = data["pronunciations"]
+            self.source_ids = data["source_ids"]
+            self.sources = [str(source) for source in data["sources"]]
+
+        ## Sources that are added after loading have lower priority than the loaded entries
+        self._entries = None
+
+class LexiconModel:
+
+    '''
+    Wrap a model (Seq2Seq, inference.NumpySeq2Seq or cache.CachedModel) so that the lexicon is consulted first
+
+    Only out-of-vocabulary words are passed to the model. All other attributes are looked up on the
+    wrapped model. Hits are counted per source (see stats()).
+    '''
+
+    def __init__(self, model, lexicon):
+
+        '''
+        :param model: object with a predict_batch() method
+        :param lexicon: Lexicon object
+        '''
+
+        self.model = model
+        self.lexicon = lexicon
+
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def __getattr__(self, name):
+
+        return getattr(self.model, name)
+
+    def reset_stats(self):
+
+        '''Reset the hit counters'''
+
+        with self._lock:
+            self.source_hits = np.zeros(len(self.lexicon.sources), dtype = "int64")
+            self.model_calls = 0
+
+    def stats(self):
+
+        '''
+        Hit counters per source
+
+        :return: dictionary with the number of lookups, the number of words predicted by the model and,
+            for every source, the number of hits and the hit rate
+        '''
+
+        with self._lock:
+
+            total = int(self.source_hits.sum()) + self.model_calls
+            out = {"lookups": total, "model": self.model_calls,
+                   "model_rate": self.model_calls / total if total > 0 else 0.}
+
+            for source, hits in zip(self.lexicon.sources, self.source_hits):
+                out[source] = int(hits)
+                out[source + "_rate"] = int(hits) / total if total > 0 else 0.
+
+        return out
+
+    def predict_batch(self, words, batch_size = 64):
+
+        '''
+        Predict the pronunciation of a list of input words
+
+        :param words: list of words to predict
+        :param batch_size: number of words that are decoded together by the model. Defaults to 64
+        :return: list of pronunciations in the same order as the input words
+        '''
+
+        pronunciations, source_ids = self.lexicon.lookup(words)
+
+        ## Out-of-vocabulary words
+        missing = [i for i, pronunciation in enumerate(pronunciations) if pronunciation is None]
+        if len(missing) > 0:
+
+            predicted = self.model.predict_batch([words[i] for i in missing], batch_size = batch_size)
+            for i, pronunciation in zip(missing, predicted):
+                pronunciations[i] = pronunciation
+
+        hits = np.bincount(source_ids[source_ids >= 0], minlength = len(self.lexicon.sources))
+
+        with self._lock:
+            ## Sources may have been added to the lexicon after the counters were created
+            self.source_hits = np.pad(self.source_hits, (0, len(hits) - len(self.source_hits)))
+            self.source_hits += hits
+            self.model_calls += len(missing)
+
+        return pronunciations
+
+    def predict(self, word):
+
+        '''
+        Predict the pronunciation of an input word
+
+        :param word: word to predict
+        :return: pronunciation of input word
+        '''
+
+        return self.predict_batch([word])[0]
+
+if __name__ == "__main__":
+
+    ## Build a lexicon from the command line, e.g.
+    ##  python -m phonorm.lexicon --cmudict data/raw/cmudict/cmudict_SPHINX_40.txt --output models/cmudict/lexicon.npz
+    parser = argparse.ArgumentParser(description = "Build a phonorm lexicon")
+    parser.add_argument("--cmudict", help = "path to the cmudict file")
+    parser.add_argument("--pairs", nargs = "*", default = [], help = "preprocessed .npy pair files")
+    parser.add_argument("--join-phonemes", action = "store_true", help = "remove spaces between phonemes of the pair files")
+    parser.add_argument("--output", default = "models/lexicon.npz", help = "path to store the lexicon")
+    args = parser.parse_args()
+
+    lexicon = Lexicon()
+    if args.cmudict:
+        lexicon.add_cmudict(args.cmudict)
+    for pathname in args.pairs:
+        lexicon.add_npy(pathname, join_phonemes = args.join_phonemes)
+
+    lexicon.save(args.output)
+    print("Saved {} words from {} source(s) to {}".format(len(lexicon), len(lexicon.sources), args.output))
@@ -0,0 +1,74 @@
+## Normalize whole sentences / documents with a single batched decode
+
+from collections import OrderedDict
+import re
+
+## Words are runs of letters, optionally joined by apostrophes (e.g. "don't", "a's")
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
+
+def tokenize(text):
+
+    '''
+    Split a text into word tokens
+
+    :param text: input text
+    :return: list of (start, end) character offsets of the words in the text
+    '''
+
+    return [match.span() for match in TOKEN_PATTERN.finditer(text)]
+
+def normalize_texts(model, texts, batch_size = 64, return_tokens = False):
+
+    '''
+    Replace every word in a batch of texts by its pronunciation
+
+    The texts are tokenized, the (lowercased) words are deduplicated across the whole batch and
+    the unique words are predicted with a single call to model.predict_batch(). Punctuation,
+    whitespace, numbers and words with characters that are not in the input charmap are kept as-is.
+
+    :param model: Seq2Seq, inference.NumpySeq2Seq or one of the wrappers (cache.CachedModel, lexicon.LexiconModel)
+    :param texts: list of texts
+    :param batch_size: number of words that are decoded together. Defaults to 64
+    :param return_tokens: if True, return the tokens instead of the normalized texts. Defaults to False
+    :return: list of normalized texts, or (if return_tokens) a list with a list of
+        (original token, pronunciation) tuples for every text
+    '''
+
+    mapping_input = model.mapping_input
+
+    ## Tokenize and find the words that the model can pronounce
+    spans = [tokenize(text) for text in texts]
+    unique = OrderedDict()
+    for text, text_spans in zip(texts, spans):
+
+        for start, end in text_spans:
+
+            word = text[start:end].lower()
+            if len(word) <= mapping_input.max_length and all(char in mapping_input.char2index for char in word):
+                unique[word] = None
+
+    ## One batched decode over the unique words
+    words = list(unique)
+    pronunciations = dict(zip(words, model.predict_batch(words, batch_size = batch_size))) if len(words) > 0 else {}
+
+    ## Reassemble
+    out = []
+    for text, text_spans in zip(texts, spans):
+
+        if return_tokens:
+
+            out.append([(text[start:end], pronunciations.get(text[start:end].lower())) for start, end in text_spans])
+            continue
+
+        pieces = []
+        position = 0
+        for start, end in text_spans:
+
+            pieces.append(text[position:start])
+            pieces.append(pronunciations.get(text[start:end].lower(), text[start:end]))
+            position = end
+
+        pieces.append(text[position:])
+        out.append("".join(pieces))
+
+    return out
@@ -1,5 +1,11 @@
 ## Prep data functions
 
+from types import MappingProxyType
+from itertools import chain
+import json
+import pickle
+import numpy as np
+
 class charmap:
 
     '''
@@ -76,3 +82,282 @@ class charmap:
             if char not in ["\t", "\n"]:
 
                 self.char2count[char] += 1
+
+    def to_dict(self):
+
+        '''
+        Convert the hash maps to a dictionary of plain python types (e.g. to store them as json)
+
+        :return: dictionary with the name, split, max_length, characters (in index order) and character counts
+        '''
+
+        return {
+            "name": self.name,
+            "split": self.split,
+            "max_length": self.max_length,
+            "chars": [self.index2char[i] for i in range(self.n_chars)],
+            "char2count": self.char2count
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+
+        '''
+        Create a charmap from a dictionary created with to_dict()
+
+        :param data: dictionary with the name, split, max_length, characters and character counts
+        :return: charmap object
+        '''
+
+        mapping = cls(data["name"], split = data["split"])
+        mapping.char2index = {char: index for index, char in enumerate(data["chars"])}
+        mapping.index2char = {index: char for index, char in enumerate(data["chars"])}
+        mapping.char2count = dict(data["char2count"])
+        mapping.n_chars = len(data["chars"])
+        mapping.max_length = data["max_length"]
+
+        return mapping
+
+class FrozenCharmap:
+
+    '''
+    Immutable charmap with array-backed lookups
+
+    Has the attributes of charmap (char2index and index2char are read-only dictionaries), plus a dense
+    codepoint --> index table for the single-character entries (see utilities.char_lookup_table()) and an
+    index --> string array, so that index sequences are translated back to strings in one call (see decode()).
+    Serializes to json instead of pickle.
+    '''
+
+    __slots__ = ("name", "split", "max_length", "n_chars", "chars", "char2index", "index2char", "char2count",
+                 "table", "strings")
+
+    def __init__(self, name, chars, split = False, max_length = 0, char2count = None):
+
+        '''
+        :param name: name of the charmap
+        :param chars: list of characters (or phonemes) in index order, starting with '<PAD>', '<UNK>', '\\t' and '\\n'
+        :param split: if True, the entries are phonemes separated by spaces. Defaults to False
+        :param max_length: length of the longest word. Defaults to 0
+        :param char2count: dictionary with character frequencies. Defaults to None
+        '''
+
+        chars = tuple(chars)
+
+        values = {
+            "name": name,
+            "split": bool(split),
+            "max_length": int(max_length),
+            "n_chars": len(chars),
+            "chars": chars,
+            "char2index": MappingProxyType({char: index for index, char in enumerate(chars)}),
+            "index2char": MappingProxyType(dict(enumerate(chars))),
+            "char2count": MappingProxyType(dict(char2count or {}))
+        }
+
+        ## Codepoint --> index. Phonemes and the special entries are looked up in char2index
+        single = [(ord(char), index) for index, char in enumerate(chars) if len(char) == 1]
+        table = np.full(max([codepoint for codepoint, _ in single] + [-1]) + 1, -1, dtype = "int32")
+        for codepoint, index in single:
+            table[codepoint] = index
+
+        ## Index --> string, with an empty string for padding at index n_chars
+        strings = np.array(list(chars) + [""], dtype = object)
+
+        table.flags.writeable = False
+        strings.flags.writeable = False
+        values.update({"table": table, "strings": strings})
+
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+
+        raise AttributeError("FrozenCharmap is immutable. Use thaw() to get a charmap that can be changed")
+
+    def __delattr__(self, key):
+
+        raise AttributeError("FrozenCharmap is immutable. Use thaw() to get a charmap that can be changed")
+
+    def __reduce__(self):
+
+        ## Slots with a read-only __setattr__ are not restored by the default pickle protocol
+        return (self.__class__.from_dict, (self.to_dict(),))
+
+    def __repr__(self):
+
+        return "FrozenCharmap(name = {!r}, n_chars = {}, split = {}, max_length = {})".format(
+            self.name, self.n_chars, self.split, self.max_length)
+
+    def __eq__(self, other):
+
+        return isinstance(other, FrozenCharmap) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+
+        return hash((self.name, self.split, self.max_length, self.chars))
+
+    def decode(self, indices, lengths = None):
+
+        '''
+        Translate index sequences back to strings in one call
+
+        Sequence i gives "".join(index2char[index] for index in indices[i][:lengths[i]] if index >= 0).
+
+        :param indices: integer array of shape (N, T) or list of N integer sequences. Negative values are padding
+        :param lengths: number of valid positions of every sequence. Defaults to None (all positions)
+        :return: list of N strings
+        '''
+
+        if isinstance(indices, np.ndarray) and indices.ndim == 2:
+
+            valid = indices >= 0
+            if lengths is not None:
+                valid &= np.arange(indices.shape[1]) < np.asarray(lengths)[:, np.newaxis]
+
+            ## A single lookup for all tokens, padding maps to the empty string
+            return ["".join(row) for row in self.strings[np.where(valid, indices, self.n_chars)].tolist()]
+
+        sizes = np.fromiter(map(len, indices), dtype = "int64", count = len(indices))
+        tokens = np.fromiter(chain.from_iterable(indices), dtype = "int64", count = int(sizes.sum()))
+
+        valid = tokens >= 0
+        if lengths is not None:
+            valid &= np.arange(len(tokens)) - np.repeat(np.cumsum(sizes) - sizes, sizes) < np.repeat(lengths, sizes)
+
+        strings = self.strings[np.where(valid, tokens, self.n_chars)].tolist()
+        bounds = np.cumsum(sizes).tolist()
+
+        return ["".join(strings[stop - size:stop]) for stop, size in zip(bounds, sizes.tolist())]
+
+    def to_dict(self):
+
+        '''
+        :return: dictionary with the name, split, max_length, characters (in index order) and character counts
+            (the same format as charmap.to_dict())
+        '''
+
+        return {
+            "name": self.name,
+            "split": self.split,
+            "max_length": self.max_length,
+            "chars": list(self.chars),
+            "char2count": dict(self.char2count)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+
+        '''
+        :param data: dictionary created with charmap.to_dict() or FrozenCharmap.to_dict()
+        :return: FrozenCharmap object
+        '''
+
+        return cls(data["name"], data["chars"], split = data["split"], max_length = data["max_length"],
+                   char2count = data["char2count"])
+
+    @classmethod
+    def from_charmap(cls, mapping):
+
+        '''
+        :param mapping: charmap object
+        :return: FrozenCharmap object with the same entries
+        '''
+
+        return cls.from_dict(mapping.to_dict())
+
+    def thaw(self):
+
+        '''
+        :return: charmap object with the same entries (e.g. to add words)
+        '''
+
+        return charmap.from_dict(self.to_dict())
+
+    def to_json(self):
+
+        '''
+        :return: json string of to_dict()
+        '''
+
+        return json.dumps(self.to_dict(), ensure_ascii = False)
+
+    @classmethod
+    def from_json(cls, text):
+
+        '''
+        :param text: json string created with to_json()
+        :return: FrozenCharmap object
+        '''
+
+        return cls.from_dict(json.loads(text))
+
+def freeze(mapping):
+
+    '''
+    :param mapping: charmap or FrozenCharmap object
+    :return: FrozenCharmap object (the mapping itself if it is already frozen)
+    '''
+
+    return mapping if isinstance(mapping, FrozenCharmap) else FrozenCharmap.from_charmap(mapping)
+
+class _CharmapUnpickler(pickle.Unpickler):
+
+    '''Unpickler that only creates charmap objects'''
+
+    def find_class(self, module, name):
+
+        if (module, name) == ("phonorm.prepare", "charmap"):
+            return charmap
+
+        if (module, name) in [("builtins", "object"), ("copy_reg", "_reconstructor"), ("copyreg", "_reconstructor")]:
+            return super().find_class(module, name)
+
+        raise pickle.UnpicklingError("'{}.{}' is not allowed in a charmap pickle".format(module, name))
+
+def save_mappings(mappings, pathname):
+
+    '''
+    Store charmaps as json
+
+    :param mappings: list of charmap or FrozenCharmap objects (e.g. [mapping_input, mapping_output])
+    :param pathname: path of the json file (e.g. 'models/model_mappings.json')
+    '''
+
+    with open(pathname, "w", encoding = "utf-8") as outFile:
+        json.dump([mapping.to_dict() for mapping in mappings], outFile, ensure_ascii = False)
+
+def load_mappings(pathname):
+
+    '''
+    Load charmaps stored with save_mappings() or pickled by Seq2Seq.save()
+
+    Pickles are read with an unpickler that refuses everything but charmap objects.
+
+    :param pathname: path of the .json or pickle (.p) file
+    :return: list of FrozenCharmap objects
+    '''
+
+    if pathname.endswith(".json"):
+        with open(pathname, encoding = "utf-8") as inFile:
+            return [FrozenCharmap.from_dict(data) for data in json.load(inFile)]
+
+    with open(pathname, "rb") as inFile:
+        return [FrozenCharmap.from_charmap(mapping) for mapping in _CharmapUnpickler(inFile).load()]
+
+def convert_mappings(pathname, json_pathname = None):
+
+    '''
+    Convert pickled charmaps (e.g. models/cmudict/*_mappings.p) to json
+
+    :param pathname: path of the pickle
+    :param json_pathname: path of the json file. Defaults to pathname with the extension '.json'
+    :return: path of the json file
+    '''
+
+    if json_pathname is None:
+        json_pathname = pathname.rsplit(".", 1)[0] + ".json"
+
+    save_mappings(load_mappings(pathname), json_pathname)
+
+    return json_pathname
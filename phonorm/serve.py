@@ -0,0 +1,448 @@
+## Micro-batching HTTP/JSON server
+##  Words from concurrent requests are queued and decoded together, so that a single batched encode/decode
+##  runs per flush instead of one model call per request. Only the standard library (and numpy) is used.
+##
+##  Start a server with e.g.
+##   python -m phonorm.serve --bundle models/cmudict/multichar_model.phonorm --engine numpy --port 8080
+##  and query it with
+##   curl -X POST localhost:8080/predict -d '{"words": ["hello", "world"]}'
+##   curl localhost:8080/metrics
+
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+
+from phonorm.bundle import load_model
+
+class Metrics:
+
+    '''
+    Counters of a MicroBatcher
+
+    Keeps the batch size histogram and the latencies (from submit to result) of the last `window` words.
+    '''
+
+    def __init__(self, window = 10000):
+
+        '''
+        :param window: number of latencies used for the percentiles. Defaults to 10000
+        '''
+
+        self.window = window
+        self.reset()
+
+    def reset(self):
+
+        '''Reset all counters'''
+
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.words = 0
+        self.predicted = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen = self.window)
+
+    def queued(self, n):
+
+        self.queue_depth += n
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def cancelled(self, n):
+
+        self.queue_depth -= n
+
+    def flushed(self, predicted, latencies, failed = False):
+
+        self.queue_depth -= len(latencies)
+        self.words += len(latencies)
+        self.predicted += predicted
+        self.batches += 1
+        self.errors += int(failed)
+        self.batch_sizes[len(latencies)] += 1
+        self.latencies.extend(latencies)
+
+    def summary(self):
+
+        '''
+        :return: dictionary with the queue depth, the number of words (queued and, after removing duplicates within
+            a batch, predicted), batches and failed batches, the mean batch size, the batch size histogram and the
+            p50/p99 latency in milliseconds
+        '''
+
+        latencies = np.array(self.latencies) * 1000.
+
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "words": self.words,
+            "predicted": self.predicted,
+            "batches": self.batches,
+            "errors": self.errors,
+            "mean_batch_size": self.words / self.batches if self.batches > 0 else 0.,
+            "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if latencies.size > 0 else None,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if latencies.size > 0 else None
+        }
+
+class MicroBatcher:
+
+    '''
+    Coalesce words from concurrent callers into batches
+
+    A batch is flushed as soon as it holds max_batch_size words or the oldest word has waited max_wait seconds.
+    Every flush is a single call to predict_batch, which runs in an executor so that the event loop keeps
+    accepting requests. Words that are queued more than once in the same batch are only predicted once.
+    '''
+
+    def __init__(self, predict_batch, max_batch_size = 64, max_wait = 0.005, executor = None, window = 10000):
+
+        '''
+        :param predict_batch: function that maps a list of words to a list of pronunciations
+            (e.g. the predict_batch method of Seq2Seq, inference.NumpySeq2Seq, cache.CachedModel or lexicon.LexiconModel)
+        :param max_batch_size: maximum number of words per flush. Defaults to 64
+        :param max_wait: maximum time (in seconds) a word waits for the batch to fill up. Defaults to 0.005
+        :param executor: executor in which predict_batch runs. Defaults to a single thread, so that
+            the model is never called concurrently
+        :param window: number of latencies kept for the metrics. Defaults to 10000
+        '''
+
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers = 1) if executor is None else executor
+        self.metrics = Metrics(window = window)
+
+        self._queue = None
+        self._task = None
+        self._batch = []
+
+    def start(self):
+
+        '''Start the flush loop on the running event loop'''
+
+        if self._task is None:
+
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+
+        '''Stop the flush loop. Words that are still queued (or in the batch that is being flushed) are cancelled.'''
+
+        if self._task is not None:
+
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            pending = self._batch
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+
+            for _, future, _ in pending:
+                future.cancel()
+            self.metrics.cancelled(len(pending))
+
+            self._task = None
+            self._batch = []
+
+    async def submit(self, words):
+
+        '''
+        Queue a list of words and wait for their pronunciations
+
+        :param words: list of words
+        :return: list of pronunciations in the same order as the words
+        '''
+
+        self.start()
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for word in words:
+
+            future = loop.create_future()
+            self._queue.put_nowait((word, future, time.perf_counter()))
+            futures.append(future)
+
+        self.metrics.queued(len(words))
+
+        return list(await asyncio.gather(*futures))
+
+    async def _collect(self):
+
+        '''Wait for the first word, then fill the batch until it is full or max_wait has passed'''
+
+        ## The batch is kept on the object so that stop() can cancel it
+        batch = self._batch
+        batch.append(await self._queue.get())
+        deadline = batch[0][2] + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+
+            ## Take whatever is already queued without yielding to the event loop
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+
+            batch = await self._collect()
+            await self._flush(loop, batch)
+            self._batch = []
+
+    async def _flush(self, loop, batch):
+
+        '''Predict a batch and resolve its futures. Any error fails the futures of the batch, not the flush loop.'''
+
+        words = list(OrderedDict.fromkeys(word for word, _, _ in batch))
+
+        try:
+
+            predicted = list(await loop.run_in_executor(self.executor, self.predict_batch, words))
+            if len(predicted) != len(words):
+                raise ValueError("predict_batch returned {} pronunciations for {} words".format(len(predicted), len(words)))
+
+            pronunciations = dict(zip(words, predicted))
+            failed = False
+
+        except Exception as error:
+
+            failed = True
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+        done = time.perf_counter()
+        if not failed:
+            for word, future, _ in batch:
+                if not future.done():
+                    future.set_result(pronunciations[word])
+
+        try:
+            self.metrics.flushed(len(words), [done - queued for _, _, queued in batch], failed = failed)
+        except Exception:
+            ## The futures are resolved, so a broken metrics object must not stop the flush loop
+            pass
+
+class PhonormServer:
+
+    '''
+    Minimal HTTP/1.1 server in front of a MicroBatcher
+
+    Endpoints:
+        POST /predict   {"words": [...]}   --> {"pronunciations": [...]}
+        GET  /metrics                      --> see Metrics.summary()
+        GET  /health                       --> {"status": "ok"}
+    '''
+
+    def __init__(self, batcher, mapping_input = None, max_words = 1000):
+
+        '''
+        :param batcher: MicroBatcher object
+        :param mapping_input: charmap of the model. If given, words with unknown characters or that are longer than
+            mapping_input.max_length are rejected with status 400 instead of failing the whole batch. Defaults to None
+        :param max_words: maximum number of words per request. Defaults to 1000
+        '''
+
+        self.batcher = batcher
+        self.mapping_input = mapping_input
+        self.max_words = max_words
+        self.server = None
+
+    def _invalid(self, words):
+
+        '''Return an error message if the words cannot be predicted, else None'''
+
+        if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+            return "'words' must be a list of strings"
+
+        if len(words) > self.max_words:
+            return "at most {} words per request".format(self.max_words)
+
+        if self.mapping_input is not None:
+
+            for word in words:
+
+                if len(word) > self.mapping_input.max_length:
+                    return "'{}' is longer than {} characters".format(word, self.mapping_input.max_length)
+
+                if not all(char in self.mapping_input.char2index for char in word):
+                    return "'{}' contains unknown characters".format(word)
+
+        return None
+
+    async def dispatch(self, method, path, body):
+
+        '''
+        Handle a single request
+
+        :param method: HTTP method
+        :param path: request path
+        :param body: request body (bytes)
+        :return: tuple (status code, json serializable response)
+        '''
+
+        if method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics.summary()
+
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+
+        if path != "/predict":
+            return 404, {"error": "not found"}
+
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        try:
+            words = json.loads(body.decode("utf-8"))["words"]
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": "expected a json object with a 'words' list"}
+
+        error = self._invalid(words)
+        if error is not None:
+            return 400, {"error": error}
+
+        try:
+            pronunciations = await self.batcher.submit(words)
+        except Exception as error:
+            return 500, {"error": repr(error)}
+
+        return 200, {"pronunciations": pronunciations}
+
+    async def handle(self, reader, writer):
+
+        '''Serve the requests of a single (keep-alive) connection'''
+
+        try:
+
+            while True:
+
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self.dispatch(method.upper(), path.split("?")[0], body)
+
+                payload = json.dumps(response).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                    status, STATUS_TEXT.get(status, ""), len(payload), "keep-alive" if keep_alive else "close").encode("latin-1"))
+                writer.write(payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        finally:
+            writer.close()
+
+    async def start(self, host = "127.0.0.1", port = 8080):
+
+        '''
+        Start listening
+
+        :param host: host to bind to. Defaults to '127.0.0.1'
+        :param port: port to bind to (0 picks a free port). Defaults to 8080
+        :return: the port the server listens on
+        '''
+
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+
+        '''Stop listening and stop the batcher'''
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+        await self.batcher.stop()
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+async def serve(model, host = "127.0.0.1", port = 8080, max_batch_size = 64, max_wait = 0.005):
+
+    '''
+    Serve a model until the task is cancelled
+
+    :param model: object with a predict_batch method and a mapping_input charmap
+    :param host: host to bind to. Defaults to '127.0.0.1'
+    :param port: port to bind to. Defaults to 8080
+    :param max_batch_size: maximum number of words per flush. Defaults to 64
+    :param max_wait: maximum time (in seconds) a word waits for the batch to fill up. Defaults to 0.005
+    '''
+
+    batcher = MicroBatcher(lambda words: model.predict_batch(words, batch_size = max_batch_size),
+                           max_batch_size = max_batch_size, max_wait = max_wait)
+    server = PhonormServer(batcher, mapping_input = model.mapping_input)
+
+    port = await server.start(host, port)
+    print("Serving on http://{}:{}".format(host, port))
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Serve a phonorm model over HTTP")
+    parser.add_argument("--bundle", required = True, help = "path to the model bundle (see Seq2Seq.save_bundle())")
+    parser.add_argument("--engine", default = "numpy", choices = ["numpy", "keras"], help = "inference engine")
+    parser.add_argument("--host", default = "127.0.0.1", help = "host to bind to")
+    parser.add_argument("--port", type = int, default = 8080, help = "port to bind to")
+    parser.add_argument("--max-batch-size", type = int, default = 64, help = "maximum number of words per batch")
+    parser.add_argument("--max-wait", type = float, default = 0.005, help = "maximum wait (seconds) for a batch to fill up")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(load_model(args.bundle, engine = args.engine), host = args.host, port = args.port,
+                          max_batch_size = args.max_batch_size, max_wait = args.max_wait))
+    except KeyboardInterrupt:
+        pass
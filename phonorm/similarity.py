@@ -0,0 +1,285 @@
+## Phonetic similarity index
+##  Maps a (noisy) token to the known words whose pronunciation is closest to the predicted pronunciation
+##  of the token, e.g. to decide whether a misspelling "sounds like" the intended word.
+
+import numpy as np
+
+from phonorm.bundle import write_container, Container
+from phonorm.evaluate import codepoints, levenshtein_batch
+
+def pronunciation_ngrams(pronunciation, n = 2):
+
+    '''
+    Character n-grams of a pronunciation, including the start ('^') and end ('$') of the pronunciation
+
+    :param pronunciation: pronunciation string
+    :param n: n-gram length. Defaults to 2
+    :return: list of n-grams
+    '''
+
+    padded = "^" + pronunciation + "$"
+
+    return [padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))]
+
+class PronunciationIndex:
+
+    '''
+    n-gram inverted index over the pronunciations of a vocabulary
+
+    The index is stored as sorted numpy arrays in CSR layout: the postings (word numbers) of n-gram i are
+    postings[indptr[i]:indptr[i + 1]]. A query counts the distinct n-grams that every word shares with the
+    query pronunciation. A single edit removes at most n distinct n-grams, so
+
+        edit distance >= max(ceil((max(distinct n-grams of query, of word) - shared) / n), |length difference|)
+
+    Words are reranked by their exact edit distance (see evaluate.levenshtein_batch()) in order of this lower
+    bound, until the bound of the next word is larger than the k-th smallest distance found so far. The
+    result is the exact top k, while usually only a small part of the vocabulary is reranked.
+    Words that share no n-gram with the query are included with shared = 0.
+    '''
+
+    def __init__(self, words, pronunciations, n = 2):
+
+        '''
+        :param words: list of words
+        :param pronunciations: list with the pronunciation of every word (e.g. predicted with Seq2Seq.predict_batch())
+        :param n: n-gram length. Defaults to 2
+        '''
+
+        self.n = n
+        self.words = np.array(list(words), dtype = "U")
+        self.pronunciations = np.array(list(pronunciations), dtype = "U")
+
+        ## (n-gram, word) pairs
+        grams = [pronunciation_ngrams(str(pronunciation), n) for pronunciation in self.pronunciations]
+        word_ids = np.repeat(np.arange(len(grams), dtype = "int32"), [len(word_grams) for word_grams in grams])
+        all_grams = np.array([gram for word_grams in grams for gram in word_grams], dtype = "U{}".format(n))
+
+        self.ngrams, gram_ids = np.unique(all_grams, return_inverse = True)
+
+        ## A word is posted once per distinct n-gram
+        pairs = np.unique(gram_ids.astype("int64") * len(grams) + word_ids)
+        gram_ids, word_ids = pairs // len(grams), (pairs % len(grams)).astype("int32")
+
+        self.postings = word_ids
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(gram_ids, minlength = len(self.ngrams)))]).astype("int64")
+        self.gram_counts = np.bincount(word_ids, minlength = len(grams)).astype("int32")
+
+        ## Number of times every symbol occurs in every pronunciation (code point 0 is padding)
+        codes = self.pronunciations.view("uint32").reshape(len(self.pronunciations), -1)
+        rows, columns = np.nonzero(codes)
+        self.symbols, symbol_ids = np.unique(codes[rows, columns], return_inverse = True)
+        self.histograms = np.bincount(rows * len(self.symbols) + symbol_ids, minlength = len(codes) * len(self.symbols)
+                                      ).reshape(len(codes), len(self.symbols)).astype("uint8")
+
+        self._lengths = None
+
+    def __len__(self):
+
+        return len(self.words)
+
+    @classmethod
+    def from_model(cls, model, words, batch_size = 256, n = 2):
+
+        '''
+        Build an index from the pronunciations that a model predicts for a vocabulary
+
+        :param model: object with a predict_batch method (Seq2Seq, inference.NumpySeq2Seq or a wrapper)
+        :param words: list of words
+        :param batch_size: number of words that are decoded together. Defaults to 256
+        :param n: n-gram length. Defaults to 2
+        :return: PronunciationIndex object
+        '''
+
+        return cls(words, model.predict_batch(list(words), batch_size = batch_size), n = n)
+
+    @property
+    def lengths(self):
+
+        if self._lengths is None:
+            self._lengths = np.char.str_len(self.pronunciations).astype("int64")
+
+        return self._lengths
+
+    def nbytes(self):
+
+        '''
+        :return: memory used by the arrays of the index, in bytes
+        '''
+
+        return sum(array.nbytes for array in [self.words, self.pronunciations, self.ngrams, self.postings, self.indptr,
+                                              self.gram_counts, self.symbols, self.histograms])
+
+    def _distances(self, codes, length, word_ids, max_distance = None):
+
+        '''Edit distances between a single pronunciation and a number of words (see evaluate.levenshtein_batch())'''
+
+        lengths = self.lengths[word_ids]
+
+        ## Only the columns up to the longest of these words are compared
+        word_codes = self.pronunciations.view("uint32").reshape(len(self.pronunciations), -1)[word_ids, :max(lengths.max(initial = 0), 1)]
+
+        return levenshtein_batch(np.repeat(codes, len(word_ids), axis = 0), np.full(len(word_ids), length),
+                                 word_codes, lengths, max_distance = max_distance)
+
+    def _bag_distances(self, codes, length, word_ids):
+
+        '''
+        Lower bound of the edit distances between a single pronunciation and a number of words
+
+        Every edit changes the count of at most one symbol up and of at most one symbol down, so the edit distance
+        is at least the number of surplus symbols on either side.
+        '''
+
+        known = np.searchsorted(self.symbols, codes[0, :length])
+        known = np.minimum(known, len(self.symbols) - 1)
+        found = self.symbols[known] == codes[0, :length]
+
+        query = np.bincount(known[found], minlength = len(self.symbols)).astype("int16")
+        difference = query - self.histograms[word_ids].astype("int16")
+
+        return np.maximum(np.maximum(difference, 0).sum(axis = 1) + int(np.count_nonzero(~found)),
+                          np.maximum(-difference, 0).sum(axis = 1))
+
+    def _search(self, pronunciation, k, max_candidates):
+
+        '''Word numbers and edit distances of the k closest words, closest first'''
+
+        codes, length = codepoints([pronunciation])
+        length = int(length[0])
+
+        grams = np.unique(np.array(pronunciation_ngrams(pronunciation, self.n), dtype = self.ngrams.dtype))
+        position = np.minimum(np.searchsorted(self.ngrams, grams), len(self.ngrams) - 1)
+        position = position[self.ngrams[position] == grams]
+
+        ## Number of distinct n-grams every word shares with the query
+        if position.size > 0:
+            shared = np.bincount(np.concatenate([self.postings[self.indptr[i]:self.indptr[i + 1]] for i in position]),
+                                 minlength = len(self.words))
+        else:
+            shared = np.zeros(len(self.words), dtype = "int64")
+
+        ## Lower bound of the edit distance of every word. A stable sort of int16 is a radix sort.
+        bound = np.maximum((np.maximum(len(grams), self.gram_counts) - shared + self.n - 1) // self.n,
+                           np.abs(self.lengths - length)).astype("int16")
+        order = np.argsort(bound, kind = "stable")
+        bound = bound[order]
+
+        found = np.zeros(0, dtype = "int64")
+        distances = np.zeros(0, dtype = "int64")
+
+        start, block = 0, max(4 * k, 64)
+        while start < len(order):
+
+            if max_candidates is not None and start >= max_candidates:
+                break
+
+            ## All remaining words are further away than the current k-th word
+            if len(found) == k and bound[start] > distances[-1]:
+                break
+
+            stop = start + block if max_candidates is None else min(start + block, max_candidates)
+            if len(found) == k:
+                ## Only rerank words whose bound is at most the current k-th distance
+                stop = min(stop, int(np.searchsorted(bound, distances[-1], side = "right")))
+
+            ## Words that are further away than the current k-th word are not computed in full
+            word_ids = order[start:stop]
+            if len(found) == k:
+                word_ids = word_ids[self._bag_distances(codes, length, word_ids) <= distances[-1]]
+            found = np.concatenate([found, word_ids])
+            distances = np.concatenate([distances, self._distances(codes, length, word_ids,
+                                                                   distances[-1] if len(distances) == k else None)])
+
+            best = np.lexsort((found, distances))[:k]
+            found, distances = found[best], distances[best]
+
+            start = stop
+            block *= 2
+
+        return found, distances
+
+    def query_batch(self, pronunciations, k = 10, max_candidates = None):
+
+        '''
+        Find the k closest words for a number of pronunciations
+
+        :param pronunciations: list of pronunciation strings
+        :param k: number of words returned per pronunciation. Defaults to 10
+        :param max_candidates: maximum number of words that are reranked per pronunciation. If given, the result may
+            not be the exact top k. Defaults to None (exact)
+        :return: list with a list of (word, pronunciation, edit distance) tuples for every pronunciation, closest first.
+            Words at the same distance are ordered as in the vocabulary.
+        '''
+
+        out = []
+        for pronunciation in pronunciations:
+
+            found, distances = self._search(str(pronunciation), k, max_candidates)
+            out.append([(str(self.words[i]), str(self.pronunciations[i]), int(distance)) for i, distance in zip(found, distances)])
+
+        return out
+
+    def query(self, pronunciation, k = 10, max_candidates = None):
+
+        '''
+        Find the k closest words for a single pronunciation (see query_batch())
+
+        :param pronunciation: pronunciation string
+        :param k: number of words returned. Defaults to 10
+        :param max_candidates: maximum number of words that are reranked. Defaults to None (exact)
+        :return: list of (word, pronunciation, edit distance) tuples, closest first
+        '''
+
+        return self.query_batch([pronunciation], k = k, max_candidates = max_candidates)[0]
+
+    def search(self, model, tokens, k = 10, max_candidates = None, batch_size = 256):
+
+        '''
+        Find the known words that sound like a number of (possibly misspelled) tokens
+
+        :param model: model used to build the index (anything with a predict_batch method)
+        :param tokens: list of tokens
+        :param k: number of words returned per token. Defaults to 10
+        :param max_candidates: maximum number of words that are reranked per token. Defaults to None (exact)
+        :param batch_size: number of tokens that are decoded together. Defaults to 256
+        :return: list with a list of (word, pronunciation, edit distance) tuples for every token, closest first
+        '''
+
+        return self.query_batch(model.predict_batch(list(tokens), batch_size = batch_size), k = k, max_candidates = max_candidates)
+
+    def save(self, pathname = "models/pronunciation_index.phonorm"):
+
+        '''
+        Save the index as single file (see bundle.write_container())
+
+        :param pathname: path to store the index. Defaults to 'models/pronunciation_index.phonorm'
+        '''
+
+        write_container(pathname, {"format": "phonorm-pronunciation-index", "n": self.n},
+                        arrays = {"words": self.words, "pronunciations": self.pronunciations, "ngrams": self.ngrams,
+                                  "postings": self.postings, "indptr": self.indptr, "gram_counts": self.gram_counts,
+                                  "symbols": self.symbols, "histograms": self.histograms})
+
+    @classmethod
+    def load(cls, pathname = "models/pronunciation_index.phonorm"):
+
+        '''
+        Load an index saved with save(). The arrays are memory-mapped.
+
+        :param pathname: path where the index is stored
+        :return: PronunciationIndex object
+        '''
+
+        container = Container(pathname)
+        if container.meta.get("format") != "phonorm-pronunciation-index":
+            raise ValueError("'{}' is not a phonorm pronunciation index".format(pathname))
+
+        index = cls.__new__(cls)
+        index.n = container.meta["n"]
+        for name in ["words", "pronunciations", "ngrams", "postings", "indptr", "gram_counts", "symbols", "histograms"]:
+            setattr(index, name, container.array(name))
+
+        index._lengths = None
+
+        return index
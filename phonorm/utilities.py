@@ -1,7 +1,10 @@
 ## Useful functions
 
 # Import
-from phonorm.prepare import charmap
+from phonorm.prepare import charmap, FrozenCharmap
+from collections import Counter
+from itertools import islice
+import multiprocessing
 import numpy as np
 
 def create_mapping(input_language_name,
@@ -11,18 +14,171 @@ def create_mapping(input_language_name,
 
     '''Take word pairs and create input/output dictionaries'''
 
-    # Create dictionaries
-    input_mapping = charmap(input_language_name, split=False)
-    output_mapping = charmap(output_language_name, split=split)
+    # Same result as adding every pair to the charmaps, see build_mapping()
+    return(build_mapping(input_language_name, output_language_name, word_pairs, split = split))
 
-    # For each word in the word pairs, add to the charmap
-    for pair in word_pairs:
+def count_chars(words, split = False):
 
-        input_mapping.addWord(pair[0])
-        output_mapping.addWord(pair[1])
+    '''
+    Partial character counts of a chunk of words (the map step of build_mapping())
 
-    # Return
-    return(input_mapping, output_mapping)
+    @param words list of words
+    @param split if True, then dealing with phonemes separated by spaces
+
+    @return tuple (Counter with the characters in order of first occurrence, max length as in charmap.addWord())
+    '''
+
+    if len(words) == 0:
+
+        return(Counter(), 0)
+
+    ## Frequencies of all codepoints at once
+    joined = "".join(words)
+    codepoints = np.frombuffer(joined.encode("utf-32-le"), dtype='uint32')
+    frequencies = np.bincount(codepoints)
+    present = np.nonzero(frequencies)[0].tolist()
+
+    lengths = np.fromiter(map(len, words), dtype='int64', count=len(words))
+
+    if split:
+
+        ## Joining with spaces gives the same tokens as splitting every word at spaces
+        counts = Counter(" ".join(words).split(" "))
+
+        ## The max length does not count whitespace (see charmap.addWord())
+        kept = np.zeros(len(codepoints) + 1, dtype='int64')
+        np.cumsum(~np.isin(codepoints, [codepoint for codepoint in present if chr(codepoint).isspace()]), out=kept[1:])
+        ends = np.cumsum(lengths)
+
+        return(counts, int((kept[ends] - kept[ends - lengths]).max()))
+
+    ## Order of first occurrence
+    order = sorted(present, key=lambda codepoint: joined.find(chr(codepoint)))
+    counts = Counter({chr(codepoint): int(frequencies[codepoint]) for codepoint in order})
+
+    return(counts, int(lengths.max()))
+
+def merge_counts(partials):
+
+    '''
+    Merge partial counts of consecutive chunks (the reduce step of build_mapping())
+
+    @param partials iterable of (Counter, max length) tuples in the order of the chunks
+
+    @return tuple (Counter with the characters in order of first occurrence over all chunks, max length)
+    '''
+
+    counts, max_length = Counter(), 0
+    for partial, partial_max_length in partials:
+
+        ## Characters that are new to the merged counts are appended in the order of the chunk
+        counts.update(partial)
+        max_length = max(max_length, partial_max_length)
+
+    return(counts, max_length)
+
+def mapping_from_counts(name, counts, max_length, split = False):
+
+    '''
+    Create a charmap from merged counts
+
+    @param name name of the charmap
+    @param counts Counter with the characters in order of first occurrence (see merge_counts())
+    @param max_length length of the longest word
+    @param split if True, then dealing with phonemes separated by spaces
+
+    @return charmap with the same indices and counts as adding the words one at a time
+    '''
+
+    mapping = charmap(name, split = split)
+
+    for char, count in counts.items():
+
+        ## '\t' and '\n' are in every charmap and are not counted
+        if char in mapping.char2index:
+
+            continue
+
+        mapping.char2index[char] = mapping.n_chars
+        mapping.index2char[mapping.n_chars] = char
+        mapping.char2count[char] = count
+        mapping.n_chars += 1
+
+    mapping.max_length = max_length
+
+    return(mapping)
+
+def _count_pairs(args):
+
+    words, pronunciations, split = args
+
+    return(count_chars(words), count_chars(pronunciations, split = split))
+
+def _pair_chunks(word_pairs, split, chunk_size):
+
+    ## Take the columns of arrays and packed datasets (see dataset.PairDataset) at once
+    if (isinstance(word_pairs, np.ndarray) and word_pairs.ndim == 2) or hasattr(word_pairs, "pronunciations"):
+
+        for start in range(0, len(word_pairs), chunk_size):
+
+            chunk = word_pairs[start:start + chunk_size]
+            if isinstance(chunk, np.ndarray):
+
+                yield([str(word) for word in chunk[:, 0].tolist()], [str(word) for word in chunk[:, 1].tolist()], split)
+
+            else:
+
+                yield(chunk.words(), chunk.pronunciations(), split)
+
+        return
+
+    iterator = iter(word_pairs)
+    while True:
+
+        chunk = list(islice(iterator, chunk_size))
+        if len(chunk) == 0:
+
+            return
+
+        yield([str(pair[0]) for pair in chunk], [str(pair[1]) for pair in chunk], split)
+
+def build_mapping(input_language_name, output_language_name, word_pairs, split = False, processes = 1, chunk_size = 100000):
+
+    '''
+    Create input/output charmaps from chunks of word pairs, optionally in a pool of processes
+
+    Every chunk is counted separately (count_chars()) and the counts are merged in the order of the chunks
+    (merge_counts()), so the indices, counts and max lengths are the same as those of adding every pair
+    with charmap.addWord() for any number of processes and any chunk size.
+
+    @param input_language_name name of the input charmap
+    @param output_language_name name of the output charmap
+    @param word_pairs iterable of (word, pronunciation) pairs (e.g. a numpy array or dataset.PairDataset)
+    @param split if True, then the pronunciations are phonemes separated by spaces
+    @param processes number of processes. None uses one process per CPU. Defaults to 1 (no pool)
+    @param chunk_size number of pairs per chunk. Defaults to 100000
+
+    @return tuple (input charmap, output charmap)
+    '''
+
+    chunks = _pair_chunks(word_pairs, split, chunk_size)
+
+    if processes == 1:
+
+        partials = [_count_pairs(chunk) for chunk in chunks]
+
+    else:
+
+        ## imap keeps the order of the chunks
+        with multiprocessing.Pool(processes) as pool:
+
+            partials = list(pool.imap(_count_pairs, chunks))
+
+    input_counts, input_max_length = merge_counts(partial[0] for partial in partials)
+    output_counts, output_max_length = merge_counts(partial[1] for partial in partials)
+
+    return(mapping_from_counts(input_language_name, input_counts, input_max_length),
+           mapping_from_counts(output_language_name, output_counts, output_max_length, split = split))
 
 def index_from_word(mapping, word):
 
@@ -58,7 +214,93 @@ def tensor_from_pair(pair, mappings):
     # Return
     return(np.asarray(input_tensor), np.asarray(output_tensor))
 
-def one_hot_encode(data, mapping, one_timestep_ahead = False, split = False):
+def char_lookup_table(mapping):
+
+    '''
+    Create a dense lookup table from unicode codepoint --> integer index
+
+    Only single-character entries of the mapping are included. Phonemes (split = True) and the
+    special '<PAD>' / '<UNK>' entries are looked up in mapping.char2index instead.
+
+    @param mapping mapping created by create_mapping()
+
+    @return numpy int32 array. Codepoints that are not in the mapping are set to -1
+    '''
+
+    ## Frozen charmaps carry the table
+    if isinstance(mapping, FrozenCharmap):
+
+        return(mapping.table)
+
+    chars = [char for char in mapping.char2index if len(char) == 1]
+
+    table = np.full(max([ord(char) for char in chars] + [-1]) + 1, -1, dtype='int32')
+    table[[ord(char) for char in chars]] = [mapping.char2index[char] for char in chars]
+
+    return(table)
+
+def encode_positions(data, mapping, one_timestep_ahead = False, split = False, max_length = None):
+
+    '''
+    Map all words to their integer representation in bulk
+
+    @param data list of input words of length N
+    @param mapping mapping created by create_mapping()
+    @param one_timestep_ahead if True, then every position is shifted one timestep back and the first character is dropped
+    @param split if True, then dealing with phonemes separated by spaces
+    @param max_length maximum number of positions. Defaults to mapping.max_length
+
+    @return tuple (rows, positions, indices) of flat numpy arrays, one element per character.
+        The character at data[rows[i]][positions[i]] has integer representation indices[i].
+    '''
+
+    if split:
+
+        ## Phonemes are separated by spaces
+        tokens = [entry.split(" ") for entry in data]
+        lengths = np.fromiter(map(len, tokens), dtype='int64', count=len(tokens))
+
+        ## Convert input characters to integer representation
+        flat = [token for entry in tokens for token in entry]
+        indices = np.fromiter(map(mapping.char2index.__getitem__, flat), dtype='int64', count=len(flat))
+
+    else:
+
+        lengths = np.fromiter(map(len, data), dtype='int64', count=len(data))
+
+        ## Codepoints of all characters at once
+        codepoints = np.frombuffer("".join(data).encode("utf-32-le"), dtype='uint32')
+
+        ## Convert input characters to integer representation
+        table = char_lookup_table(mapping)
+        indices = table[np.minimum(codepoints, len(table) - 1)]
+        indices[codepoints >= len(table)] = -1
+
+        ## Raise the same error as a dictionary lookup for characters that are not in the mapping
+        if (indices < 0).any():
+
+            raise KeyError(chr(codepoints[np.argmax(indices < 0)]))
+
+    ## Row and position of every character
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    positions = np.arange(len(indices)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    if one_timestep_ahead:
+
+        keep = positions > 0
+        rows, positions, indices = rows[keep], positions[keep] - 1, indices[keep]
+
+    if max_length is None:
+
+        max_length = mapping.max_length
+
+    if len(positions) > 0 and positions.max() >= max_length:
+
+        raise IndexError("Input contains sequences that are longer than the max length ({})".format(max_length))
+
+    return(rows, positions, indices)
+
+def one_hot_encode(data, mapping, one_timestep_ahead = False, split = False, max_length = None):
     
     '''
     Create one-hot encoding 
@@ -66,6 +308,7 @@ def one_hot_encode(data, mapping, one_timestep_ahead = False, split = False):
     @param data list of input words of length N
     @param vocab mapping mapping created by create_mapping() function
     @param one_timestep_ahead if True, then the function will create a one-hot vector that is one timestep ahead
+    @param max_length pad to this length instead of mapping.max_length (e.g. the longest word in a length bucket)
     
     @return numpy array of dimensions (N, max_word_length, vocab_length)
     
@@ -76,61 +319,203 @@ def one_hot_encode(data, mapping, one_timestep_ahead = False, split = False):
     '''
     
     ## Retrieve values from the mapping
-    max_word_length = mapping.max_length
+    max_word_length = mapping.max_length if max_length is None else max_length
     vocab_length = mapping.n_chars
     
-    vocab_char2index = mapping.char2index
-    
     ## Empty numpy array of output dimensions
     out_ohe = np.zeros(
         (len(data), max_word_length, vocab_length),
         dtype='float32'
     )
     
-    # Populate the numpy array
-    for entry_pos, entry in enumerate(data):
-        
-        ## char_pos is the index value of the character that is being processed.
-        ##  e.g. if input is a word of length 4 then the first char_pos is 0 etc.
-        
-        ## char is the actual character value
-        if split:
+    ## Populate the numpy array with a single assignment
+    rows, positions, indices = encode_positions(data, mapping, one_timestep_ahead = one_timestep_ahead, split = split,
+                                                max_length = max_word_length)
+    out_ohe[rows, positions, indices] = 1.
+                
+    ## Return
+    return(out_ohe)
 
-            for char_pos, char in enumerate(entry.split(" ")):
+def index_encode(data, mapping, one_timestep_ahead = False, split = False, max_length = None):
 
-                ## Convert input character to integer representation
-                char_integer_repr = vocab_char2index[char]
+    '''
+    Create integer (index) encoding. This is the compact counterpart of one_hot_encode()
 
-                ## Set value to 1
-                if one_timestep_ahead:
+    @param data list of input words of length N
+    @param mapping mapping created by create_mapping() function
+    @param one_timestep_ahead if True, then the function will create an index sequence that is one timestep ahead
+    @param split if True, then dealing with phonemes separated by spaces
+    @param max_length pad to this length instead of mapping.max_length (e.g. the longest word in a length bucket)
 
-                    if char_pos > 0:
-                        out_ohe[entry_pos, char_pos - 1, char_integer_repr] = 1.
+    @return numpy int32 array of dimensions (N, max_word_length). Padding is encoded as mapping.char2index['<PAD>'] (0)
+    '''
 
-                else:
+    ## Retrieve values from the mapping
+    max_word_length = mapping.max_length if max_length is None else max_length
 
-                    out_ohe[entry_pos, char_pos, char_integer_repr] = 1.
+    ## Padded integer array of output dimensions
+    out_idx = np.full(
+        (len(data), max_word_length),
+        mapping.char2index['<PAD>'],
+        dtype='int32'
+    )
 
-        else:
+    ## Populate the numpy array with a single assignment
+    rows, positions, indices = encode_positions(data, mapping, one_timestep_ahead = one_timestep_ahead, split = split,
+                                                max_length = max_word_length)
+    out_idx[rows, positions] = indices
 
-            for char_pos, char in enumerate(entry):
+    ## Return
+    return(out_idx)
 
-                ## Convert input character to integer representation
-                char_integer_repr = vocab_char2index[char]
+def sequence_lengths(data, split = False):
 
-                ## Set value to 1
-                if one_timestep_ahead:
+    '''
+    Number of timesteps of every entry
 
-                    if char_pos > 0:
+    @param data list of words of length N
+    @param split if True, then dealing with phonemes separated by spaces
 
-                        out_ohe[entry_pos, char_pos - 1, char_integer_repr] = 1.
+    @return numpy int64 array of length N
+    '''
 
-                else:
+    if split:
 
-                    out_ohe[entry_pos, char_pos, char_integer_repr] = 1.
-                
-    ## Return
-    return(out_ohe)
+        return(np.fromiter((len(entry.split(" ")) for entry in data), dtype='int64', count=len(data)))
+
+    return(np.fromiter(map(len, data), dtype='int64', count=len(data)))
+
+def length_buckets(lengths, batch_size):
+
+    '''
+    Group entries of similar length into batches
+
+    Entries are sorted by length (ties keep their original order) and cut into batches of batch_size,
+    so that every batch only needs to be padded to the length of its longest entry.
+
+    @param lengths numpy array with the length of every entry (see sequence_lengths())
+    @param batch_size maximum number of entries per batch
+
+    @return list of numpy arrays with the positions of the entries in each batch
+    '''
+
+    order = np.argsort(lengths, kind='stable')
+
+    return([order[start:start + batch_size] for start in range(0, len(order), batch_size)])
+
+def unique_rows(*arrays):
+
+    '''
+    Find rows that are bit-for-bit identical across a number of arrays
+
+    @param arrays numpy arrays with the same number of rows
+
+    @return tuple (first, inverse). first contains the position of the first occurrence of every unique row,
+        inverse the number of the unique row for every row
+    '''
+
+    rows = np.hstack([np.ascontiguousarray(array).reshape(len(array), -1).view("uint8") for array in arrays])
+    rows = np.ascontiguousarray(rows)
+
+    ## View every row as a single opaque value so that np.unique compares whole rows
+    keys = rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index = True, return_inverse = True)
+
+    return(first, inverse)
+
+class PrefixSharing:
+
+    '''
+    Share the decoder steps of rows in a batch that will produce the same output
+
+    Greedy decoding is deterministic: two rows that emitted the same prefix and reached the same decoder
+    state will emit the same tokens from then on. The emitted prefixes are kept in a trie; rows that
+    are on the same trie node are compared on their states, and every row that matches an earlier row is
+    dropped from the batch. Its output is copied from that row when decoding is finished.
+    '''
+
+    def __init__(self, n_rows, stats = None):
+
+        '''
+        @param n_rows number of rows in the batch
+        @param stats dictionary in which the counters are accumulated (see finish()). Defaults to None
+        '''
+
+        self.stats = stats
+
+        ## Trie of emitted prefixes: (parent node, token) --> node. Node 0 is the empty prefix.
+        self.nodes = {}
+        self.prefixes = np.zeros(n_rows, dtype = "int64")
+
+        self.merges = []
+        self.computed = 0
+
+    def merge(self, active, h, c):
+
+        '''
+        Drop the rows that have the same prefix and states as an earlier row
+
+        @param active numpy array with the rows that are still being decoded
+        @param h decoder hidden state of the active rows
+        @param c decoder memory cell of the active rows
+
+        @return boolean numpy array that is True for the active rows that must still be computed
+        '''
+
+        keep = np.ones(active.size, dtype = bool)
+
+        ## Only rows that share a trie node can have the same future
+        prefixes = self.prefixes[active]
+        _, inverse, counts = np.unique(prefixes, return_inverse = True, return_counts = True)
+        candidates = np.flatnonzero(counts[inverse] > 1)
+
+        if candidates.size > 0:
+
+            first, inverse = unique_rows(prefixes[candidates], h[candidates], c[candidates])
+            leaders = candidates[first][inverse]
+
+            followers = leaders != candidates
+            self.merges += list(zip(active[candidates[followers]], active[leaders[followers]]))
+            keep[candidates[followers]] = False
+
+        self.computed += int(keep.sum())
+
+        return(keep)
+
+    def extend(self, active, sampled):
+
+        '''
+        Add the tokens that were sampled for the active rows to their prefixes
+
+        @param active numpy array with the rows that were decoded
+        @param sampled numpy array with the sampled token of every active row
+        '''
+
+        for row, token in zip(active, sampled):
+            self.prefixes[row] = self.nodes.setdefault((int(self.prefixes[row]), int(token)), len(self.nodes) + 1)
+
+    def finish(self, decoded):
+
+        '''
+        Copy the output of every dropped row from the row it was merged into and update the counters
+
+        The counters are 'rows', 'merged' (rows that were dropped), 'steps' (row-steps needed without sharing),
+        'computed' (row-steps that were run) and 'saved_rate' (fraction of the steps that were shared).
+
+        @param decoded list with the sampled tokens of every row. Updated in place.
+        '''
+
+        ## A row can be merged into a row that is merged later on, so resolve the latest merges first
+        for follower, leader in reversed(self.merges):
+            decoded[follower] = list(decoded[leader])
+
+        if self.stats is not None:
+
+            for key, value in [("rows", len(decoded)), ("merged", len(self.merges)),
+                               ("steps", sum(len(tokens) for tokens in decoded)), ("computed", self.computed)]:
+                self.stats[key] = self.stats.get(key, 0) + value
+
+            self.stats["saved_rate"] = 1. - self.stats["computed"] / self.stats["steps"] if self.stats["steps"] > 0 else 0.
 
 def decode_position(position, mapping):
     
@@ -4,140 +4,36 @@
 import numpy as np
 import urllib.request
 import os
-from preprocessing.utils import cv_splits, to_pairs, filter_homophone
+from preprocessing.utils import cv_splits, filter_homophone
+from preprocessing.wiktionary_stream import extract_dump, load_pairs
+from preprocessing.wiktionary_parallel import extract_dump_parallel
 import re
 from numpy.random import shuffle
 import math
 from collections import Counter # for word frequencies
 from pywiktionary import Wiktionary
 
-#%% ------ Preprocessing functions
-
-def preprocess_data(data, language, max_word_length=False, one_per_observation=False):
-    '''
-    Take wikt2pron output (list containing pronunciations in English), and:
-     - Remove 'IPA not present' / 'Language not found'
-     - Turn the data into a rectangular format
-
-    @param data result of wikit2pron
-    @param language language for which to filter (ex. 'en')
-    @param max_word_length remove tail ends from word lengths; defaults to False; calculates the sd of word lengths and removes mean+-2*sd
-    @param one_per_observation every element in the wikt2pron output can contain multiple pronunciations (e.g. for different dialects). It is not specified for which dialect these occur. If True, this parameter takes on the first observation of the list of possible values.
-
-    @return pandas data frame containing n * k_n rows and 5 columns.
-     tuple containing :
-        1. the result (list containing a dict per one word-pronunciation mapping)
-        2. number of languages found in the master dataset
-    '''
-
-    # Filter results where pronunciation is a string --> these are 'not found' messages
-    data_filter = [co for co in data if not isinstance(co["pronunciation"], str)]
-
-    # If maximum length, calculate upper bound
-    if max_word_length:
-        wl = [len(df['title']) for df in data_filter]
-        upper_bound = np.mean(wl) + 1 * np.sqrt(np.var(wl))
-
-        # Subset data
-        data_filter = [entry for entry in data_filter if len(entry['title']) <= upper_bound]
-
-    # Unlist each pronunciation result s.t. it is associated with a word and unique id
-    data_flattened = [flatten_word_list(df, one_per_observation=one_per_observation) for df in data_filter]
-
-    # Flatten the list of lists that is the output of col_decomp
-    res = [word_list for entry in data_flattened for word_list in entry]
-
-    # Retrieve languages found in results
-    langs = set([elem["lang"] for elem in res])
-
-    # Filter for reference language
-    res_lang_filter = [elem for elem in res if elem["lang"] == language]
-
-    # If length == 0, then raise error
-    if len(res_lang_filter) == 0:
-        raise phonormException("Language {} not present in data".format(language))
-
-    # Return
-    return ((res, langs))
-
-def flatten_word_list(word_list, one_per_observation=False):
-    '''
-    Unnest the wikt2pron data
-
-    @param word_list one element of original wikt2pron dataset
-    @param one_per_observation see same parameter under 'preprocess_data()' function
-
-    @return: list containing dictionary entry for each word-pronunciation mapping found
-    '''
-
-    # Save word name + id
-    _id = word_list["id"]
-    word = word_list["title"].lower()
-
-    # Check length of pronunciation
-    # If one per observation, then only return first one
-    if len(word_list["pronunciation"]) == 1 or one_per_observation:
-
-        lang = word_list["pronunciation"][0]["lang"]
-        IPA = word_list["pronunciation"][0]["IPA"]
-        X_SAMPA = "\t" + word_list["pronunciation"][0]["X-SAMPA"] + "\n"
-
-        # Create dict
-        res = {
-            "_id": _id,
-            "word": word,
-            "lang": lang,
-            "IPA": IPA,
-            "X_SAMPA": X_SAMPA
-        }
-
-        # Return
-        return ([res])
-
-    # Else multiple entries
-    else:
-
-        # Open results
-        res = [None] * len(word_list["pronunciation"])
-
-        # Unroll dict
-        max_len = len(word_list["pronunciation"])
-
-        # For each element, ...
-        for elem_iter in range(0, max_len):
-            # Subset
-            elem = word_list["pronunciation"][elem_iter]
-
-            # Compile new dict
-            res_current = {
-                "_id": _id,
-                "word": word,
-                "lang": elem["lang"],
-                "IPA": elem["IPA"],
-                "X_SAMPA": "\t" + elem["X-SAMPA"] + "\n"
-            }
-
-            # Save to res
-            res[elem_iter] = res_current
-
-        # Return
-        return (res)
-
 #%%
 
 '''
-Download wikipedia dump file and preprocess if it does not already exist in the data folder
+Download wikipedia dump file and extract the pronunciations if they do not already exist in the data folder
 
 See general url for wiki dumps: https://dumps.wikimedia.org/enwiktionary/
 
+The dump is processed as a stream (see preprocessing/wiktionary_stream.py): memory use does not depend on the
+size of the dump, and an interrupted extraction continues from the checkpoint in data/raw/wikt2pron_chunks.
 '''
 
-# If not exists, download
-if "wikt2pron.npy" in os.listdir("data/raw"):
+fp = "data/raw/enwiktionary-20181101-pages-meta-current.xml.bz2"
 
-    pron = np.load("data/raw/wikt2pron.npy")
+# If the multistream dump and its index are in the data folder, they are extracted in parallel instead
+# (see preprocessing/wiktionary_parallel.py)
+fp_multistream = "data/raw/enwiktionary-20181101-pages-articles-multistream.xml.bz2"
+fp_index = "data/raw/enwiktionary-20181101-pages-articles-multistream-index.txt.bz2"
+multistream = os.path.exists(fp_multistream) and os.path.exists(fp_index)
 
-elif not "enwiktionary-20181101-pages-meta-current.xml.bz2" in os.listdir("data/raw"):
+# If not exists, download
+if not "wikt2pron.npy" in os.listdir("data/raw") and not multistream and not "enwiktionary-20181101-pages-meta-current.xml.bz2" in os.listdir("data/raw"):
 
     print("Downloading wikipedia data. This takes approximately 10 minutes")
 
@@ -145,58 +41,40 @@ elif not "enwiktionary-20181101-pages-meta-current.xml.bz2" in os.listdir("data/
     file = "https://dumps.wikimedia.org/enwiktionary/20181101/enwiktionary-20181101-pages-meta-current.xml.bz2"
 
     # Download
-    urllib.request.urlretrieve(file, "data/raw/enwiktionary-20181101-pages-meta-current.xml.bz2")
-
-    # Set file path
-    fp = "data/raw/enwiktionary-20181101-pages-meta-current.xml.bz2"
-
-    '''Extract english words + pronunciation. This takes a LONG time'''
+    urllib.request.urlretrieve(file, fp)
 
-    # Extract only English words
-    wikt = Wiktionary(lang="English", XSAMPA=True)
+#%% ------ Extract English words + pronunciation and save to file
 
-    # Save dict to python object
-    pron = wikt.extract_IPA(fp)
+if not "wikt2pron.npy" in os.listdir("data/raw"):
 
-    np.save("data/raw/wikt2pron.npy", pron)
+    # Filter for this language
+    language = "en"
+    # Only one word per observation (not multiple for different dialects, e.g. american v. british english)
+    one_per_example = True
+    # Words with special characters are removed
+    pattern = '[^a-zA-Z]'
 
-#%% ------ Preprocess data and save to file
-
-# Filter for this language
-language = "en"
-# Words beyond this length are cut
-max_word_length = False
-# Only one word per observation (not multiple for different dialects, e.g. american v. british english)
-one_per_example = True
-
-# Prep datset
-prep = preprocess_data(pron, language,
-                       max_word_length=max_word_length,
-                       one_per_observation=one_per_example)
-
-# Take words with special characters and remove these
-prep = np.array(prep[0])
-pattern = '[^a-zA-Z]'
-
-# Filter
-mask = np.array([bool(re.search(pattern, item['word'])) for item in prep])
-prep_masked = prep[mask == False]
-
-# To from / to pairs and save
-import random
-
-# To numpy array
-pairs = to_pairs(prep_masked)
-pairs = np.array(pairs)
-
-# Check a random subset of the data
-dl = np.arange(0, len(pairs)-1)
-shuffle(dl)
-for i in dl[:100]:
-    print('[%s] => [%s]' % (pairs[i,0], pairs[i,1]))
-
-# Save
-np.save('data/raw/wikt2pron.npy', pairs)
+    # Stream the dump and write (word, X-SAMPA) pairs in chunks
+    if multistream:
+        checkpoint = extract_dump_parallel(fp_multistream, "data/raw/wikt2pron_chunks", index_pathname=fp_index,
+                                           language=language, one_per_observation=one_per_example, pattern=pattern)
+    else:
+        checkpoint = extract_dump(fp, "data/raw/wikt2pron_chunks", language=language,
+                                  one_per_observation=one_per_example, pattern=pattern,
+                                  wiktionary=Wiktionary(lang="English", XSAMPA=True))
+    print("Extracted {} pairs".format(checkpoint["pairs"]))
+
+    # To numpy array
+    pairs = load_pairs("data/raw/wikt2pron_chunks")
+
+    # Check a random subset of the data
+    dl = np.arange(0, len(pairs)-1)
+    shuffle(dl)
+    for i in dl[:100]:
+        print('[%s] => [%s]' % (pairs[i,0], pairs[i,1]))
+
+    # Save
+    np.save('data/raw/wikt2pron.npy', pairs)
 
 #%% Make train/dev/test splits
 
@@ -3,6 +3,8 @@
 import random
 from numpy.random import shuffle
 import numpy as np
+import hashlib
+from collections import Counter
 import time
 import math
 import matplotlib.pyplot as plt
@@ -57,15 +59,179 @@ def filter_homophone(pairs, dev_pronunciation_words, test_pronunciation_words):
     :return: (train, dev, test) splits for homophones
     '''
 
+    # Hash sets, so that every lookup takes constant time
+    dev_pronunciation_words = set(dev_pronunciation_words)
+    test_pronunciation_words = set(test_pronunciation_words)
+
     # Subset data
     dev = [pair for pair in pairs if pair[1] in dev_pronunciation_words]
     tst = [pair for pair in pairs if pair[1] in test_pronunciation_words]
 
     # Make word list that should be removed from the data
-    remove = dev_pronunciation_words + test_pronunciation_words
+    remove = dev_pronunciation_words | test_pronunciation_words
 
     # Subset
     trn = np.array([list(pair) for pair in pairs if pair[1] not in remove])
 
     # Return
     return ((trn, dev, tst))
+
+#%% Hash-based splits
+
+# Splits made by split_pairs() and the file suffix they are saved with (see write_splits())
+SPLITS = {"train": "train", "dev": "dev", "test": "test", "homophone_dev": "homophone_dev", "homophone_test": "homophone_tst"}
+
+def hash_fraction(key, seed = "phonorm"):
+
+    '''
+    Map a string to a number in [0, 1) that is the same on every machine and in every python session
+
+    :param key: string (e.g. a pronunciation)
+    :param seed: string that selects a different, independent mapping. Defaults to 'phonorm'
+    :return: float in [0, 1)
+    '''
+
+    digest = hashlib.md5((seed + "\x00" + key).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+def assign_split(pronunciation, homophone, homophone_dev = 0.02, homophone_test = 0.02, dev = 0.01, test = 0.01,
+                 seed = "phonorm"):
+
+    '''
+    Assign a pronunciation group to a split
+
+    All pairs with the same pronunciation end up in the same split. Homophones (groups of more than one pair) go to
+    homophone_dev or homophone_test with probability homophone_dev and homophone_test; all other groups go to
+    dev or test with probability dev and test, else to train. The split only depends on the pronunciation, the
+    seed and whether it is a homophone, so appending data only moves a group if it becomes a homophone.
+
+    :param pronunciation: pronunciation string
+    :param homophone: True if more than one word has this pronunciation
+    :param homophone_dev: fraction of the homophone groups in homophone_dev. Defaults to 0.02
+    :param homophone_test: fraction of the homophone groups in homophone_test. Defaults to 0.02
+    :param dev: fraction of the other groups in dev. Defaults to 0.01
+    :param test: fraction of the other groups in test. Defaults to 0.01
+    :param seed: seed of the hash (see hash_fraction()). Defaults to 'phonorm'
+    :return: one of the keys of SPLITS
+    '''
+
+    if homophone:
+
+        fraction = hash_fraction(pronunciation, seed + "/homophone")
+        if fraction < homophone_dev:
+            return "homophone_dev"
+        if fraction < homophone_dev + homophone_test:
+            return "homophone_test"
+
+    fraction = hash_fraction(pronunciation, seed)
+    if fraction < dev:
+        return "dev"
+    if fraction < dev + test:
+        return "test"
+
+    return "train"
+
+def count_pronunciations(pairs):
+
+    '''
+    Count the pairs of every pronunciation
+
+    :param pairs: iterable of (word, pronunciation) pairs
+    :return: Counter pronunciation --> number of pairs
+    '''
+
+    return Counter(pair[1] for pair in pairs)
+
+def split_pairs(pairs, counts, **kwargs):
+
+    '''
+    Assign every pair to a split in one pass (see assign_split())
+
+    :param pairs: iterable of (word, pronunciation) pairs
+    :param counts: Counter with the number of pairs per pronunciation over all data (see count_pronunciations())
+    :param kwargs: fractions and seed passed on to assign_split()
+    :return: generator of (split, pair) tuples
+    '''
+
+    # Every group is hashed once
+    splits = {}
+
+    for pair in pairs:
+
+        split = splits.get(pair[1])
+        if split is None:
+            split = splits[pair[1]] = assign_split(pair[1], counts[pair[1]] > 1, **kwargs)
+
+        yield split, pair
+
+def hash_splits(pairs, **kwargs):
+
+    '''
+    Make train/dev/test/homophone splits in memory (see assign_split())
+
+    :param pairs: list or array of (word, pronunciation) pairs
+    :param kwargs: fractions and seed passed on to assign_split()
+    :return: dict split --> array of shape (N, 2) with the pairs of the split, in input order
+    '''
+
+    out = {split: [] for split in SPLITS}
+    for split, pair in split_pairs(pairs, count_pronunciations(pairs), **kwargs):
+        out[split].append(list(pair))
+
+    return {split: np.array(split_rows, dtype = "U").reshape(len(split_rows), 2) for split, split_rows in out.items()}
+
+def write_splits(pair_files, prefix, **kwargs):
+
+    '''
+    Make train/dev/test/homophone splits from .npy pair files without loading them all at once
+
+    The files are read twice. The first pass counts the pronunciations (which gives the size of every split) and
+    finds the longest word and pronunciation; the second pass writes every pair straight to its memory-mapped
+    output file. Memory use grows with the number of distinct pronunciations, not with the number of pairs.
+
+    :param pair_files: list of paths of .npy files with arrays of (word, pronunciation) pairs
+        (e.g. the chunks written by wiktionary_stream.write_pairs())
+    :param prefix: output path prefix. The splits are saved as '<prefix>_<suffix>.npy' (see SPLITS)
+    :param kwargs: fractions and seed passed on to assign_split()
+    :return: dict split --> number of pairs
+    '''
+
+    def read():
+        for pathname in pair_files:
+            yield from np.load(pathname)
+
+    # First pass: groups and the longest word and pronunciation
+    counts = Counter()
+    width = 1
+    for pair in read():
+        counts[pair[1]] += 1
+        width = max(width, len(pair[0]), len(pair[1]))
+
+    # Split sizes follow from the groups
+    sizes = Counter()
+    for pronunciation, count in counts.items():
+        sizes[assign_split(pronunciation, count > 1, **kwargs)] += count
+
+    # Second pass: write every pair to its split
+    outputs = {}
+    for split, suffix in SPLITS.items():
+
+        pathname = "{}_{}.npy".format(prefix, suffix)
+
+        # Empty files cannot be memory-mapped
+        if sizes[split] == 0:
+            np.save(pathname, np.zeros((0, 2), dtype = "U{}".format(width)))
+        else:
+            outputs[split] = np.lib.format.open_memmap(pathname, mode = "w+", dtype = "U{}".format(width),
+                                                       shape = (sizes[split], 2))
+
+    positions = Counter()
+
+    for split, pair in split_pairs(read(), counts, **kwargs):
+        outputs[split][positions[split]] = pair
+        positions[split] += 1
+
+    for output in outputs.values():
+        output.flush()
+
+    return {split: sizes[split] for split in SPLITS}
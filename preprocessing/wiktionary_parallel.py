@@ -0,0 +1,313 @@
+## Parallel extraction of pronunciations from a multistream wiktionary dump
+##  A multistream dump (e.g. enwiktionary-YYYYMMDD-pages-articles-multistream.xml.bz2) is a concatenation of
+##  independent bz2 streams of about 100 pages each. Groups of streams are decompressed and parsed by a pool
+##  of worker processes with the stages of wiktionary_stream, and the results are written in dump order, so
+##  the output is the same as that of wiktionary_stream.extract_dump() for any number of workers.
+##
+##  e.g.
+##   python -m preprocessing.wiktionary_parallel data/raw/enwiktionary-20181101-pages-articles-multistream.xml.bz2 \
+##       --index data/raw/enwiktionary-20181101-pages-articles-multistream-index.txt.bz2 --workers 32
+
+from collections import deque
+import argparse
+import bz2
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+from preprocessing.wiktionary_stream import parse_pages, extract_pronunciations, flatten_entries, select_language, \
+    filter_words, read_checkpoint, write_pairs, phonormException
+
+## Every bz2 stream starts with the header 'BZh', the block size and the magic number of the first block
+STREAM_HEADER = b"1AY&SY"
+
+## Extraction settings of the worker process (see _init_worker())
+_wiktionary = None
+_options = None
+
+def read_index_offsets(index_pathname):
+
+    '''
+    Byte offsets of the streams from the index of a multistream dump
+
+    Every line of the index is 'offset:page id:title', where offset is the start of the stream with the page.
+
+    :param index_pathname: path to the (bz2 compressed) index file
+    :return: sorted list of unique offsets
+    '''
+
+    opener = bz2.open if index_pathname.endswith(".bz2") else open
+    offsets = set()
+
+    with opener(index_pathname, "rt", encoding = "utf-8") as inFile:
+        for line in inFile:
+            offsets.add(int(line.split(":", 1)[0]))
+
+    return sorted(offsets)
+
+def find_stream_offsets(pathname, block_size = 1 << 24):
+
+    '''
+    Byte offsets of the streams of a multistream dump without index
+
+    Looks for the stream header 'BZh[1-9]1AY&SY'. A header can in principle also occur inside compressed data,
+    so only use this if the index is not available.
+
+    :param pathname: path to the dump
+    :param block_size: number of bytes that are read at a time. Defaults to 16MB
+    :return: sorted list of offsets
+    '''
+
+    offsets = []
+    overlap = b""
+    position = 0
+
+    with open(pathname, "rb") as inFile:
+
+        while True:
+
+            block = inFile.read(block_size)
+            if len(block) == 0:
+                break
+
+            data = overlap + block
+            start = position - len(overlap)
+
+            index = data.find(STREAM_HEADER)
+            while index != -1:
+
+                if index >= 4 and data[index - 4:index - 1] == b"BZh" and data[index - 1:index] in b"123456789":
+                    offsets.append(start + index - 4)
+
+                index = data.find(STREAM_HEADER, index + 1)
+
+            ## Keep enough bytes to find a header that is split over two blocks
+            overlap = data[-(len(STREAM_HEADER) + 3):]
+            position += len(block)
+
+    return sorted(set(offsets))
+
+def stream_ranges(offsets, file_size, streams_per_task = 20):
+
+    '''
+    Group consecutive streams into tasks
+
+    :param offsets: sorted list of stream offsets
+    :param file_size: size of the dump in bytes
+    :param streams_per_task: number of streams per task. Defaults to 20
+    :return: list of (start, end) byte ranges
+    '''
+
+    if len(offsets) == 0 or offsets[0] != 0:
+        ## The first stream holds the siteinfo and is not always in the index
+        offsets = [0] + list(offsets)
+
+    boundaries = list(offsets[::streams_per_task]) + [file_size]
+
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+def parse_fragment(data):
+
+    '''
+    Parse the pages in a piece of decompressed dump
+
+    :param data: bytes with zero or more complete <page> elements (and possibly the start or end of the dump)
+    :return: generator of (page number within the piece, page dict) tuples
+    '''
+
+    first = data.find(b"<page>")
+    last = data.rfind(b"</page>")
+    if first == -1 or last == -1:
+        return iter([])
+
+    return parse_pages(io.BytesIO(b"<pages>" + data[first:last + len(b"</page>")] + b"</pages>"))
+
+def _init_worker(language, one_per_observation, pattern, wiktionary = None):
+
+    '''Create the pronunciation extractor once per worker process'''
+
+    global _wiktionary, _options
+
+    if wiktionary is None:
+        from pywiktionary import Wiktionary
+        wiktionary = Wiktionary(lang = "English", XSAMPA = True)
+
+    _wiktionary = wiktionary
+    _options = {"language": language, "one_per_observation": one_per_observation, "pattern": pattern}
+
+def _extract_range(pathname, start, end):
+
+    '''
+    Decompress and parse one task in a worker. Returns the rows, the number of pages, the number of bytes and
+    the number of pronunciations in the language (before the word filter).
+    '''
+
+    with open(pathname, "rb") as inFile:
+        inFile.seek(start)
+        compressed = inFile.read(end - start)
+
+    ## bz2.decompress() decompresses concatenated streams
+    pages = list(parse_fragment(bz2.decompress(compressed)))
+
+    entries = extract_pronunciations(iter(pages), _wiktionary)
+    rows = flatten_entries(entries, one_per_observation = _options["one_per_observation"])
+    rows = list(select_language(rows, _options["language"]))
+    found = sum(len(page_rows) for _, page_rows in rows)
+    rows = filter_words(rows, pattern = _options["pattern"])
+
+    return [row for _, page_rows in rows for row in page_rows], len(pages), len(compressed), found
+
+def extract_dump_parallel(pathname, directory, index_pathname = None, workers = None, streams_per_task = 20,
+                          max_in_flight = None, language = "en", one_per_observation = True, pattern = "[^a-zA-Z]",
+                          chunk_size = 50000, report_every = 10., stats = None, wiktionary = None):
+
+    '''
+    Extract (word, X-SAMPA) pairs from a multistream wiktionary dump with a pool of worker processes
+
+    Tasks of streams_per_task consecutive streams are processed in parallel and written in dump order (see
+    wiktionary_stream.write_pairs()). The checkpoint counts tasks, so an interrupted extraction is resumed with
+    the same streams_per_task. If the dump has no pronunciations for the language, phonormException is raised
+    and nothing is marked as done.
+
+    :param pathname: path to the multistream .xml.bz2 dump
+    :param directory: output directory for the chunks and the checkpoint
+    :param index_pathname: path to the index of the dump. Defaults to None (search the dump for stream headers)
+    :param workers: number of worker processes. 0 extracts in the current process. Defaults to the number of CPUs
+    :param streams_per_task: number of streams per task. Defaults to 20
+    :param max_in_flight: maximum number of tasks queued or being processed. Defaults to 4 * workers
+    :param language: language code (ex. 'en'). Defaults to 'en'
+    :param one_per_observation: if True, only keep the first pronunciation of every word. Defaults to True
+    :param pattern: words that match this regular expression are removed. Defaults to '[^a-zA-Z]'
+    :param chunk_size: minimum number of pairs per chunk. Defaults to 50000
+    :param report_every: seconds between progress reports on stderr. None disables the reports. Defaults to 10
+    :param stats: dictionary in which the number of tasks, pages, bytes, pairs and pronunciations in the language
+        are counted. Defaults to None
+    :param wiktionary: pywiktionary Wiktionary object (must be picklable if workers > 0).
+        Defaults to Wiktionary(lang = "English", XSAMPA = True)
+    :return: checkpoint dict (see wiktionary_stream.read_checkpoint())
+    '''
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if max_in_flight is None:
+        max_in_flight = 4 * max(workers, 1)
+
+    if stats is None:
+        stats = {}
+
+    checkpoint = read_checkpoint(directory)
+    if checkpoint["done"]:
+        return checkpoint
+
+    if checkpoint["position"] > 0 and checkpoint.get("streams_per_task") != streams_per_task:
+        raise ValueError("The extraction in '{}' was started with other settings (streams_per_task = {})".format(
+            directory, checkpoint.get("streams_per_task")))
+
+    offsets = read_index_offsets(index_pathname) if index_pathname is not None else find_stream_offsets(pathname)
+    ranges = stream_ranges(offsets, os.path.getsize(pathname), streams_per_task = streams_per_task)
+
+    stats.update({"tasks": checkpoint["position"], "total_tasks": len(ranges), "pages": 0, "bytes": 0, "pairs": 0,
+                  "language_rows": 0})
+    remaining = sum(end - start for start, end in ranges[checkpoint["position"]:])
+    started = last_report = time.perf_counter()
+
+    def report(final = False):
+
+        nonlocal last_report
+
+        seconds = time.perf_counter() - started
+        if report_every is None or (not final and time.perf_counter() - last_report < report_every):
+            return
+
+        last_report = time.perf_counter()
+        rate = stats["bytes"] / seconds if seconds > 0 else 0.
+        eta = (remaining - stats["bytes"]) / rate if rate > 0 else float("nan")
+        print("{tasks}/{total_tasks} tasks, {pages} pages, {pairs} pairs".format(**stats) +
+              " | {:.1f} pages/s, {:.1f} MB/s | elapsed {:.0f}s, eta {:.0f}s".format(
+                  stats["pages"] / seconds if seconds > 0 else 0., rate / 1e6, seconds, eta), file = sys.stderr)
+
+    def count(number, result):
+
+        rows, pages, n_bytes, found = result
+        stats["tasks"] += 1
+        stats["language_rows"] += found
+        stats["pages"] += pages
+        stats["bytes"] += n_bytes
+        stats["pairs"] += len(rows)
+        report()
+
+        return number, rows
+
+    tasks = [(number, start, end) for number, (start, end) in enumerate(ranges)][checkpoint["position"]:]
+    initargs = (language, one_per_observation, pattern, wiktionary)
+
+    def check_language():
+
+        ## Raised before write_pairs() marks the extraction as done. A chunk is only written once pairs
+        #  were found, so a resumed run has already seen the language
+        if checkpoint["pairs"] == 0 and stats["language_rows"] == 0:
+            raise phonormException("Language {} not present in data".format(language))
+
+    def results():
+
+        ## Extract in the current process
+        if workers == 0:
+
+            _init_worker(*initargs)
+            for number, start, end in tasks:
+                yield count(number, _extract_range(pathname, start, end))
+
+            check_language()
+            return
+
+        pool = multiprocessing.Pool(workers, initializer = _init_worker, initargs = initargs)
+        try:
+
+            pending = deque()
+            for number, start, end in tasks:
+
+                ## Write the oldest task before more work is queued
+                if len(pending) >= max_in_flight:
+                    oldest, result = pending.popleft()
+                    yield count(oldest, result.get())
+
+                pending.append((number, pool.apply_async(_extract_range, (pathname, start, end))))
+
+            while pending:
+                number, result = pending.popleft()
+                yield count(number, result.get())
+
+            pool.close()
+            check_language()
+
+        finally:
+
+            pool.terminate()
+            pool.join()
+
+    ## The checkpoint records streams_per_task, so that a resumed run uses the same tasks
+    checkpoint = write_pairs(results(), directory, chunk_size = chunk_size, settings = {"streams_per_task": streams_per_task})
+    report(final = True)
+
+    return checkpoint
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Extract pronunciations from a multistream wiktionary dump")
+    parser.add_argument("dump", help = "path to the multistream .xml.bz2 dump")
+    parser.add_argument("-o", "--output", default = "data/raw/wikt2pron_chunks", help = "output directory")
+    parser.add_argument("--index", default = None, help = "path to the index of the dump")
+    parser.add_argument("--workers", type = int, default = None, help = "number of worker processes (0: no pool)")
+    parser.add_argument("--streams-per-task", type = int, default = 20, help = "number of bz2 streams per task")
+    parser.add_argument("--language", default = "en", help = "language code")
+    parser.add_argument("--chunk-size", type = int, default = 50000, help = "minimum number of pairs per output chunk")
+    args = parser.parse_args()
+
+    checkpoint = extract_dump_parallel(args.dump, args.output, index_pathname = args.index, workers = args.workers,
+                                       streams_per_task = args.streams_per_task, language = args.language,
+                                       chunk_size = args.chunk_size)
+
+    print("Extracted {pairs} pairs in {chunks} chunks".format(**checkpoint), file = sys.stderr)
@@ -0,0 +1,369 @@
+## Streaming extraction of pronunciations from a wiktionary dump
+##  Pages are parsed one at a time from the bz2 compressed xml dump and passed through generator stages
+##  (pronunciation extraction, flattening, language selection, word filter). Pairs are written in chunks
+##  together with a checkpoint, so memory use does not depend on the size of the dump and an interrupted
+##  run continues where it stopped.
+
+import bz2
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+import numpy as np
+
+CHECKPOINT = "checkpoint.json"
+
+class phonormException(Exception):
+
+    '''Raised when the dump has no pronunciations for the requested language'''
+
+def _tag(element):
+
+    '''Tag of an xml element without the mediawiki namespace'''
+
+    return element.tag.rsplit("}", 1)[-1]
+
+def _page(element):
+
+    '''
+    Convert a <page> element to a dictionary
+
+    :param element: <page> element
+    :return: dict with the id, title, namespace and wiki text of the page
+    '''
+
+    page = {"id": None, "title": None, "ns": None, "text": ""}
+
+    for child in element:
+
+        tag = _tag(child)
+        if tag in ("id", "title", "ns"):
+            page[tag] = child.text
+        elif tag == "revision":
+            for item in child:
+                if _tag(item) == "text":
+                    page["text"] = item.text or ""
+
+    return page
+
+def parse_pages(stream, start_page = 0):
+
+    '''
+    Parse the pages of a mediawiki xml stream one at a time
+
+    Every page is removed from the tree once it is yielded, so memory use does not grow with the number of pages.
+
+    :param stream: binary file object with the xml
+    :param start_page: number of the first page that is yielded. Earlier pages are parsed but skipped. Defaults to 0
+    :return: generator of (page number, page dict) tuples (see _page())
+    '''
+
+    context = ET.iterparse(stream, events = ("start", "end"))
+    _, root = next(context)
+
+    number = 0
+    for event, element in context:
+
+        if event != "end" or _tag(element) != "page":
+            continue
+
+        if number >= start_page:
+            yield number, _page(element)
+
+        number += 1
+
+        ## Drop the pages that were parsed
+        root.clear()
+
+def read_dump(pathname, start_page = 0):
+
+    '''
+    Parse the pages of a (bz2 compressed) wiktionary dump one at a time
+
+    :param pathname: path to the .xml or .xml.bz2 dump
+    :param start_page: number of the first page that is yielded. Defaults to 0
+    :return: generator of (page number, page dict) tuples
+    '''
+
+    opener = bz2.open if pathname.endswith(".bz2") else open
+    with opener(pathname, "rb") as stream:
+        yield from parse_pages(stream, start_page = start_page)
+
+def extract_pronunciations(pages, wiktionary):
+
+    '''
+    Extract the pronunciations of every page
+
+    :param pages: generator of (page number, page dict) tuples
+    :param wiktionary: pywiktionary Wiktionary object (e.g. Wiktionary(lang = "English", XSAMPA = True))
+    :return: generator of (page number, entry) tuples, where entry has the format of the elements of
+        Wiktionary.extract_IPA() or is None for pages that are not dictionary entries
+    '''
+
+    for number, page in pages:
+
+        ## Only the main namespace holds dictionary entries
+        if page["ns"] not in (None, "0") or page["title"] is None:
+            yield number, None
+            continue
+
+        yield number, {"id": page["id"], "title": page["title"],
+                       "pronunciation": wiktionary.get_entry_pronunciation(page["text"])}
+
+def flatten_word_list(word_list, one_per_observation=False):
+    '''
+    Unnest the wikt2pron data
+
+    @param word_list one element of original wikt2pron dataset
+    @param one_per_observation every element in the wikt2pron output can contain multiple pronunciations (e.g. for different dialects). If True, only the first one is used.
+
+    @return: list containing dictionary entry for each word-pronunciation mapping found
+    '''
+
+    # Save word name + id
+    _id = word_list["id"]
+    word = word_list["title"].lower()
+
+    # Check length of pronunciation
+    # If one per observation, then only return first one
+    if len(word_list["pronunciation"]) == 1 or one_per_observation:
+
+        lang = word_list["pronunciation"][0]["lang"]
+        IPA = word_list["pronunciation"][0]["IPA"]
+        X_SAMPA = "\t" + word_list["pronunciation"][0]["X-SAMPA"] + "\n"
+
+        # Create dict
+        res = {
+            "_id": _id,
+            "word": word,
+            "lang": lang,
+            "IPA": IPA,
+            "X_SAMPA": X_SAMPA
+        }
+
+        # Return
+        return ([res])
+
+    # Else multiple entries
+    else:
+
+        # Open results
+        res = [None] * len(word_list["pronunciation"])
+
+        # Unroll dict
+        max_len = len(word_list["pronunciation"])
+
+        # For each element, ...
+        for elem_iter in range(0, max_len):
+            # Subset
+            elem = word_list["pronunciation"][elem_iter]
+
+            # Compile new dict
+            res_current = {
+                "_id": _id,
+                "word": word,
+                "lang": elem["lang"],
+                "IPA": elem["IPA"],
+                "X_SAMPA": "\t" + elem["X-SAMPA"] + "\n"
+            }
+
+            # Save to res
+            res[elem_iter] = res_current
+
+        # Return
+        return (res)
+
+def flatten_entries(entries, one_per_observation = False):
+
+    '''
+    Turn every entry into a list of word-pronunciation mappings
+
+    :param entries: generator of (page number, entry) tuples
+    :param one_per_observation: if True, only keep the first pronunciation of every entry. Defaults to False
+    :return: generator of (page number, list of dicts) tuples. Entries without pronunciation (pywiktionary returns
+        a 'not found' message instead of a list) give an empty list
+    '''
+
+    for number, entry in entries:
+
+        if entry is None or isinstance(entry["pronunciation"], str) or len(entry["pronunciation"]) == 0:
+            yield number, []
+        else:
+            yield number, flatten_word_list(entry, one_per_observation = one_per_observation)
+
+def select_language(rows, language, required = False):
+
+    '''
+    Keep the pronunciations of a single language
+
+    :param rows: generator of (page number, list of dicts) tuples
+    :param language: language code (ex. 'en')
+    :param required: if True, raise phonormException once the rows are exhausted if none of them had the
+        language. Defaults to False
+    :return: generator of (page number, list of dicts) tuples
+    '''
+
+    found = False
+    for number, page_rows in rows:
+
+        page_rows = [row for row in page_rows if row["lang"] == language]
+        found = found or len(page_rows) > 0
+
+        yield number, page_rows
+
+    if required and not found:
+        raise phonormException("Language {} not present in data".format(language))
+
+def filter_words(rows, pattern = "[^a-zA-Z]"):
+
+    '''
+    Remove words that contain special characters
+
+    :param rows: generator of (page number, list of dicts) tuples
+    :param pattern: words that match this regular expression are removed. Defaults to '[^a-zA-Z]'
+    :return: generator of (page number, list of dicts) tuples
+    '''
+
+    regex = re.compile(pattern)
+
+    for number, page_rows in rows:
+        yield number, [row for row in page_rows if not regex.search(row["word"])]
+
+def read_checkpoint(directory):
+
+    '''
+    :param directory: output directory of write_pairs()
+    :return: dict with the position to continue from, the number of chunks and pairs written and whether
+        the extraction is done
+    '''
+
+    pathname = os.path.join(directory, CHECKPOINT)
+    if not os.path.exists(pathname):
+        return {"position": 0, "chunks": 0, "pairs": 0, "done": False}
+
+    with open(pathname) as inFile:
+        return json.load(inFile)
+
+def _write_checkpoint(directory, checkpoint):
+
+    pathname = os.path.join(directory, CHECKPOINT)
+    with open(pathname + ".tmp", "w") as outFile:
+        json.dump(checkpoint, outFile)
+
+    os.replace(pathname + ".tmp", pathname)
+
+def _flush(directory, pairs, checkpoint):
+
+    '''Write a chunk of pairs, then the checkpoint that points past it'''
+
+    if len(pairs) > 0:
+
+        pathname = os.path.join(directory, "pairs_{:05d}.npy".format(checkpoint["chunks"]))
+        with open(pathname + ".tmp", "wb") as outFile:
+            np.save(outFile, np.array(pairs, dtype = "U"))
+
+        os.replace(pathname + ".tmp", pathname)
+        checkpoint["chunks"] += 1
+        checkpoint["pairs"] += len(pairs)
+
+    _write_checkpoint(directory, checkpoint)
+
+def write_pairs(rows, directory, chunk_size = 50000, settings = None):
+
+    '''
+    Write (word, X-SAMPA) pairs in chunks of .npy files
+
+    A chunk is only written after the last page of the chunk, and the checkpoint is updated after every chunk.
+    After an interruption, continue from read_checkpoint(directory)["position"]: the pages after the last chunk
+    are processed again and no pair is written twice.
+
+    :param rows: generator of (position, list of dicts) tuples, where position is the number of the page
+        (or of the unit of work, see wiktionary_parallel) that the rows come from
+    :param directory: output directory
+    :param chunk_size: minimum number of pairs per chunk. Defaults to 50000
+    :param settings: dictionary that is stored in the checkpoint (e.g. to check that a resumed run uses the same
+        settings). Defaults to None
+    :return: checkpoint dict (see read_checkpoint())
+    '''
+
+    os.makedirs(directory, exist_ok = True)
+    checkpoint = read_checkpoint(directory)
+    checkpoint.update(settings or {})
+
+    pairs = []
+    for position, page_rows in rows:
+
+        pairs += [[row["word"], row["X_SAMPA"]] for row in page_rows]
+        checkpoint["position"] = position + 1
+
+        if len(pairs) >= chunk_size:
+            _flush(directory, pairs, checkpoint)
+            pairs = []
+
+    checkpoint["done"] = True
+    _flush(directory, pairs, checkpoint)
+
+    return checkpoint
+
+def load_pairs(directory):
+
+    '''
+    Read all chunks written by write_pairs()
+
+    :param directory: output directory of write_pairs()
+    :return: array of shape (N, 2) with (word, X-SAMPA) pairs in the order of the dump
+    '''
+
+    chunks = [np.load(os.path.join(directory, "pairs_{:05d}.npy".format(chunk)))
+              for chunk in range(read_checkpoint(directory)["chunks"])]
+
+    if len(chunks) == 0:
+        return np.zeros((0, 2), dtype = "U1")
+
+    return np.concatenate(chunks)
+
+def extract_dump(pathname, directory, language = "en", one_per_observation = True, pattern = "[^a-zA-Z]",
+                 chunk_size = 50000, wiktionary = None):
+
+    '''
+    Extract (word, X-SAMPA) pairs from a wiktionary dump with bounded memory
+
+    The pipeline is read_dump() --> extract_pronunciations() --> flatten_entries() --> select_language()
+    --> filter_words() --> write_pairs(). An interrupted extraction is resumed from the checkpoint in directory.
+
+    A bz2 dump cannot be entered at a page, so a resumed run decompresses and parses every page before the
+    checkpoint again (it only skips the pronunciation extraction of those pages). A resume therefore costs a
+    full scan of the dump up to the checkpoint. The multistream dump can be resumed without a scan
+    (see wiktionary_parallel.extract_dump_parallel()).
+
+    If the dump has no pronunciations for the language, phonormException is raised and nothing is marked as done.
+
+    :param pathname: path to the .xml or .xml.bz2 dump
+    :param directory: output directory for the chunks and the checkpoint
+    :param language: language code (ex. 'en'). Defaults to 'en'
+    :param one_per_observation: if True, only keep the first pronunciation of every word. Defaults to True
+    :param pattern: words that match this regular expression are removed. Defaults to '[^a-zA-Z]'
+    :param chunk_size: minimum number of pairs per chunk. Defaults to 50000
+    :param wiktionary: pywiktionary Wiktionary object. Defaults to Wiktionary(lang = "English", XSAMPA = True)
+    :return: checkpoint dict (see read_checkpoint())
+    '''
+
+    checkpoint = read_checkpoint(directory)
+    if checkpoint["done"]:
+        return checkpoint
+
+    if "streams_per_task" in checkpoint:
+        raise ValueError("The extraction in '{}' was started by wiktionary_parallel.extract_dump_parallel()".format(directory))
+
+    if wiktionary is None:
+        from pywiktionary import Wiktionary
+        wiktionary = Wiktionary(lang = "English", XSAMPA = True)
+
+    pages = read_dump(pathname, start_page = checkpoint["position"])
+    entries = extract_pronunciations(pages, wiktionary)
+    rows = flatten_entries(entries, one_per_observation = one_per_observation)
+    ## A chunk is only written once pairs were found, so a resumed run has already seen the language
+    rows = select_language(rows, language, required = checkpoint["pairs"] == 0)
+    rows = filter_words(rows, pattern = pattern)
+
+    return write_pairs(rows, directory, chunk_size = chunk_size)